@@ -0,0 +1,136 @@
+"""
+Структурированное логирование бота
+
+Поверх стандартного logging: уровень и формат задаются переменными окружения,
+к каждой записи добавляются поля контекста (user_id, thread_id, run_id),
+а отладочные записи можно прореживать. Сообщения форматируются только если
+запись действительно выводится, поэтому выключенный DEBUG почти ничего не стоит.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+
+# Уровень логирования: DEBUG, INFO, WARNING, ERROR
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Формат вывода: 'text' или 'json'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+# Доля отладочных записей, которые попадают в лог (от 0 до 1)
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1.0'))
+
+_context = contextvars.ContextVar('log_context', default={})
+
+
+def bind_log_context(**fields):
+    """
+    Добавляет поля в контекст логирования текущей задачи
+    """
+    _context.set({**_context.get(), **fields})
+
+
+def reset_log_context(**fields):
+    """
+    Начинает новый контекст логирования, например в начале обработки обновления
+    """
+    _context.set(fields)
+
+
+def fields(**values):
+    """
+    Готовит дополнительные поля записи: logger.info("...", extra=fields(duration=0.5))
+    """
+    return {'fields': values}
+
+
+class ContextFilter(logging.Filter):
+    """
+    Объединяет поля контекста задачи с полями конкретной записи
+    """
+
+    def filter(self, record):
+        context = _context.get()
+        own = getattr(record, 'fields', None)
+        if context:
+            record.fields = {**context, **own} if own else context
+        elif own is None:
+            record.fields = {}
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю rate отладочных записей
+    """
+
+    def __init__(self, rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Человекочитаемый формат: время, уровень, модуль, сообщение и поля key=value
+    """
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        extra = getattr(record, 'fields', None)
+        if extra:
+            line += ' ' + ' '.join(f"{key}={format_value(value)}" for key, value in extra.items())
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Одна JSON запись на строку для сбора логов
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
+
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT, stream=None):
+    """
+    Настраивает вывод логов бота (повторный вызов заменяет прежние настройки)
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JSONFormatter() if log_format == 'json' else TextFormatter())
+    handler.addFilter(SamplingFilter())
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    # Логи библиотек нужны только при разборе их собственных проблем
+    for name in ('urllib3', 'TeleBot'):
+        logging.getLogger(name).setLevel(logging.WARNING)
@@ -0,0 +1,155 @@
+"""
+Автоматический выключатель (circuit breaker) для запросов к OpenAI
+
+Пока OpenAI отвечает, выключатель замкнут и пропускает все запросы. После
+BREAKER_FAILURES неудач подряд (ошибка соединения, таймаут, ответ 5xx или
+ответ медленнее BREAKER_SLOW_CALL секунд) он размыкается: запросы сразу
+завершаются ошибкой CircuitOpenError, а обработчики не висят на таймаутах
+и повторах. Через BREAKER_RESET_TIMEOUT секунд выключатель становится
+полуоткрытым и пропускает пробный запрос: успех замыкает его, неудача снова
+размыкает. Если пробный запрос не вернул результат за BREAKER_RESET_TIMEOUT
+секунд, его место освобождается для следующего пробного запроса.
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from bot_logging import fields
+from metrics import CIRCUIT_OPENED, CIRCUIT_REJECTED
+
+logger = logging.getLogger(__name__)
+
+# Сколько неудачных запросов подряд размыкают выключатель (0 — выключатель отключен)
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+
+# Запрос дольше этого порога, секунды, считается неудачным (0 — не учитывать задержку)
+BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', '20'))
+
+# Сколько секунд выключатель остается разомкнутым до пробного запроса
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+
+# Сколько пробных запросов одновременно пропускает полуоткрытый выключатель
+BREAKER_PROBES = 1
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Числовые значения состояний для метрики
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Запрос не отправлен: выключатель разомкнут
+    Наследует ConnectionError, поэтому обрабатывается там же, где недоступность API
+    """
+
+
+class CircuitBreaker:
+    """
+    Выключатель с состояниями closed, open и half_open
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, slow_call=BREAKER_SLOW_CALL,
+                 reset_timeout=BREAKER_RESET_TIMEOUT, probes=BREAKER_PROBES):
+        self.name = name
+        self.failure_threshold = failures
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = 0
+        self.probe_started = 0.0
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    def _current_state(self, now):
+        # Разомкнутый выключатель по истечении таймаута готов пропустить пробный запрос
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self.probing = 0
+            logger.info("Выключатель полуоткрыт, пропускаем пробный запрос", extra=fields(api=self.name))
+        elif self.state == HALF_OPEN and self.probing and now - self.probe_started >= self.reset_timeout:
+            # Результат пробного запроса так и не был учтен: не держим выключатель полуоткрытым навсегда
+            self.probing = 0
+            logger.warning("Пробный запрос завис, пропускаем следующий", extra=fields(api=self.name))
+        return self.state
+
+    def current_state(self):
+        with self.lock:
+            return self._current_state(time.monotonic())
+
+    def available(self):
+        """
+        False, пока выключатель разомкнут и запрос все равно был бы отклонен
+        """
+        return self.current_state() != OPEN
+
+    def before_call(self):
+        """
+        Проверяет, можно ли отправить запрос, иначе выбрасывает CircuitOpenError
+        В полуоткрытом состоянии занимает место пробного запроса
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self.probing < self.probes:
+                self.probing += 1
+                self.probe_started = time.monotonic()
+                return
+            self.rejected += 1
+            retry_in = max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+        CIRCUIT_REJECTED.inc(api=self.name)
+        raise CircuitOpenError(f"{self.name} API is unavailable, retry in {retry_in:.0f}s")
+
+    def record(self, ok, duration=0.0):
+        """
+        Учитывает результат отправленного запроса
+        """
+        if not self.enabled:
+            return
+        if ok and self.slow_call > 0 and duration > self.slow_call:
+            ok = False
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = max(0, self.probing - 1)
+            if ok:
+                if self.state != CLOSED:
+                    logger.info("Выключатель замкнут: API снова отвечает", extra=fields(api=self.name))
+                self.state = CLOSED
+                self.failures = 0
+                return
+
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.opened += 1
+                CIRCUIT_OPENED.inc(api=self.name)
+                logger.warning("Выключатель разомкнут: запросы к API временно не отправляются", extra=fields(
+                    api=self.name, failures=self.failures, duration=duration, reset_timeout=self.reset_timeout
+                ))
+
+    def stats(self):
+        with self.lock:
+            state = self._current_state(time.monotonic())
+            return {
+                'state': state,
+                'failures': self.failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
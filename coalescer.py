@@ -0,0 +1,167 @@
+"""
+Объединение сообщений, которые пользователь отправляет подряд
+
+Изучающие язык часто пишут мысль несколькими короткими сообщениями. Каждое
+сообщение по-прежнему ставится в очередь пользователя, но при регистрации
+попадает в текущую группу: когда до сообщения доходит очередь, обработчик
+забирает всю группу и отправляет ассистенту одним ходом, а задачи остальных
+сообщений группы ничего не делают. Поэтому сообщения, пришедшие пока
+ассистент отвечал на предыдущее, получают один общий ответ.
+
+Если задано окно COALESCE_WINDOW, обработчик дополнительно ждет, пока
+пользователь не перестанет писать на это время (но не дольше
+COALESCE_MAX_DELAY от первого сообщения группы). Команды и нажатия кнопок
+закрывают группу, чтобы порядок событий пользователя не менялся.
+
+Сообщение, которое отменило запуск ассистента (inflight.py), продлевает
+окно своей группы до SUPERSEDE_WINDOW: пользователь, скорее всего, еще
+пишет, и без паузы каждое сообщение серии отменяло бы запуск предыдущего.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+# Объединять ли сообщения, пришедшие подряд
+COALESCE_MESSAGES = os.getenv('COALESCE_MESSAGES', '1') == '1'
+
+# Сколько секунд тишины ждать перед ответом (0 — отвечать сразу,
+# объединяя только сообщения, пришедшие во время предыдущего ответа)
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0'))
+
+# Максимальная задержка ответа из-за ожидания новых сообщений, секунды
+COALESCE_MAX_DELAY = float(os.getenv('COALESCE_MAX_DELAY', '3'))
+
+# Максимальное количество сообщений в одном ходе
+COALESCE_MAX_MESSAGES = int(os.getenv('COALESCE_MAX_MESSAGES', '10'))
+
+
+class MessageGroup:
+    def __init__(self, now):
+        self.messages = []
+        self.first_at = now
+        self.last_at = now
+        self.sealed = False
+        # Окно тишины группы, если оно больше общего (см. extend_window)
+        self.window = 0.0
+
+
+class MessageCoalescer:
+    """
+    Группы сообщений пользователей, ожидающих ответа
+    """
+
+    def __init__(self, enabled=COALESCE_MESSAGES, window=COALESCE_WINDOW,
+                 max_delay=COALESCE_MAX_DELAY, max_messages=COALESCE_MAX_MESSAGES):
+        self.enabled = enabled
+        self.window = window
+        self.max_delay = max_delay
+        self.max_messages = max_messages
+        self.condition = threading.Condition()
+        self.groups = {}
+        self.absorbed = {}
+        self.turns = 0
+        self.messages = 0
+
+    def add(self, key, message):
+        """
+        Регистрирует сообщение пользователя до постановки его в очередь
+        """
+        if not self.enabled:
+            return
+        with self.condition:
+            now = time.monotonic()
+            groups = self.groups.setdefault(key, deque())
+            if not groups or groups[-1].sealed or len(groups[-1].messages) >= self.max_messages:
+                groups.append(MessageGroup(now))
+            group = groups[-1]
+            group.messages.append(message)
+            group.last_at = now
+            self.condition.notify_all()
+
+    def seal(self, key):
+        """
+        Закрывает текущую группу: следующие сообщения попадут в новую
+        Вызывается для команд и нажатий кнопок, чтобы не менять порядок событий
+        """
+        with self.condition:
+            groups = self.groups.get(key)
+            if groups:
+                groups[-1].sealed = True
+                self.condition.notify_all()
+
+    def extend_window(self, key, window):
+        """
+        Продлевает окно тишины текущей группы пользователя до window секунд
+        Вызывается, когда новое сообщение отменило запуск ассистента
+        """
+        if not self.enabled or window <= 0:
+            return
+        with self.condition:
+            groups = self.groups.get(key)
+            if groups and not groups[-1].sealed:
+                groups[-1].window = max(groups[-1].window, window)
+                self.condition.notify_all()
+
+    def discard(self, key, message):
+        """
+        Убирает сообщение, которое не удалось поставить в очередь
+        """
+        with self.condition:
+            for group in self.groups.get(key, ()):
+                group.messages = [other for other in group.messages if other is not message]
+            self._drop_empty(key)
+
+    def take(self, key, message):
+        """
+        Возвращает сообщения, на которые нужно ответить одним ходом, начиная с message
+        Возвращает None, если message уже вошло в ход, начатый более ранним сообщением
+        """
+        with self.condition:
+            absorbed = self.absorbed.get(key)
+            if absorbed and id(message) in absorbed:
+                absorbed.discard(id(message))
+                if not absorbed:
+                    del self.absorbed[key]
+                return None
+
+            groups = self.groups.get(key)
+            group = next((group for group in groups or () if any(other is message for other in group.messages)), None)
+            if group is None:
+                # Сообщение не регистрировалось (объединение выключено или это неизвестная команда)
+                return [message]
+
+            # Ждем паузы в наборе, пока группа не закрыта и не заполнена
+            while not group.sealed and len(group.messages) < self.max_messages:
+                now = time.monotonic()
+                window = max(self.window, group.window)
+                wait = min(group.last_at + window, group.first_at + self.max_delay) - now
+                if wait <= 0:
+                    break
+                self.condition.wait(wait)
+
+            groups.remove(group)
+            self._drop_empty(key)
+            others = {id(other) for other in group.messages if other is not message}
+            if others:
+                self.absorbed.setdefault(key, set()).update(others)
+            self.turns += 1
+            self.messages += len(group.messages)
+            return list(group.messages)
+
+    def _drop_empty(self, key):
+        groups = self.groups.get(key)
+        if groups is not None:
+            while groups and not groups[0].messages:
+                groups.popleft()
+            if not groups:
+                del self.groups[key]
+
+    def stats(self):
+        with self.condition:
+            return {
+                'turns': self.turns,
+                'messages': self.messages,
+                'coalesced': self.messages - self.turns,
+                'waiting_users': len(self.groups),
+            }
@@ -1,4 +1,32 @@
+"""
+Конфигурация кнопок, промптов и текстов бота
+
+Значения по умолчанию заданы ниже. Файл JSON из BOT_CONFIG_PATH может
+заменить список кнопок ("keyboard") и переопределить отдельные промпты
+("prompts") и тексты ("texts"). Конфигурация проверяется при загрузке, и
+для каждой ее версии один раз собираются клавиатура в JSON и таблица
+обработчиков кнопок. Файл перечитывается без перезапуска бота, если он
+изменился (проверка не чаще раза в CONFIG_RELOAD_INTERVAL секунд); файл с
+ошибкой не применяется, бот продолжает работать с прежней версией.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# Файл JSON, переопределяющий кнопки, промпты и тексты (пусто — только значения по умолчанию)
+BOT_CONFIG_PATH = os.getenv('BOT_CONFIG_PATH', '')
+
+# Как часто проверять, изменился ли файл конфигурации, секунды (0 — не перечитывать)
+CONFIG_RELOAD_INTERVAL = float(os.getenv('CONFIG_RELOAD_INTERVAL', '5'))
+
 # Конфигурация кнопок клавиатуры
+# action — действие кнопки (по умолчанию совпадает с callback_data), prompt — промпт действия 'desc'
 KEYBOARD_CONFIG = [
     {
         'label': '🔄 Restart Conversation',
@@ -13,5 +41,162 @@ KEYBOARD_CONFIG = [
 # Промпты для различных функций бота
 PROMPTS = {
     'desc': "Пожалуйста, объясните последнее сообщение подробно. Обратите внимание на грамматику, лексику и предложите улучшения для моего английского.",
-    'initial': " "
+    'initial': " ",
+    # Инструкции для движка Chat Completions (у Assistants они заданы в самом ассистенте)
+    'system': "You are a friendly English conversation partner for a language learner. Keep the conversation going with natural, engaging replies and gently point out mistakes in the learner's English.",
+    'summary': "Summarize the conversation between the English learner and the tutor in a few sentences. Keep the topics discussed, facts about the learner and their recurring mistakes."
+}
+
+# Тексты сообщений бота
+TEXTS = {
+    'welcome': "👋 Welcome to English Practice Bot! Let's chat in English to improve your skills. What would you like to talk about today?",
+    'restarted': "Conversation has been restarted! Let's practice your English.",
+    'api_warning': "⚠️ Warning: Could not establish connection with OpenAI API. Please check your API keys in .env file.",
+    'no_messages': "There are no messages to explain yet.",
+    'unavailable': "Sorry, I'm having trouble connecting to the language model. Please check your API keys or try again later.",
+    'error': "Something went wrong. Please try again later.",
 }
+
+# Действия, которые можно назначить кнопкам (обработчики — в main.py)
+CALLBACK_ACTIONS = ('start', 'desc')
+
+# Ограничение Telegram на размер callback_data, байты
+MAX_CALLBACK_DATA_BYTES = 64
+
+
+class ConfigError(ValueError):
+    """
+    Конфигурация не прошла проверку
+    """
+
+
+def validate_config(data):
+    """
+    Проверяет конфигурацию и возвращает ее с заполненными значениями по умолчанию
+    """
+    if not isinstance(data, dict):
+        raise ConfigError("Конфигурация должна быть объектом JSON")
+    unknown = set(data) - {'keyboard', 'prompts', 'texts'}
+    if unknown:
+        raise ConfigError(f"Неизвестные разделы конфигурации: {', '.join(sorted(unknown))}")
+
+    sections = {}
+    for name, defaults in (('prompts', PROMPTS), ('texts', TEXTS)):
+        values = data.get(name, {})
+        if not isinstance(values, dict):
+            raise ConfigError(f"Раздел {name} должен быть объектом")
+        for key, value in values.items():
+            if not isinstance(value, str) or not value:
+                raise ConfigError(f"{name}.{key} должен быть непустой строкой")
+        sections[name] = dict(defaults, **values)
+
+    keyboard = data.get('keyboard', KEYBOARD_CONFIG)
+    if not isinstance(keyboard, list) or not keyboard:
+        raise ConfigError("Раздел keyboard должен быть непустым списком кнопок")
+    buttons = []
+    for index, button in enumerate(keyboard):
+        if not isinstance(button, dict):
+            raise ConfigError(f"keyboard[{index}] должен быть объектом")
+        label = button.get('label')
+        callback_data = button.get('callback_data')
+        if not isinstance(label, str) or not label:
+            raise ConfigError(f"keyboard[{index}].label должен быть непустой строкой")
+        if not isinstance(callback_data, str) or not 0 < len(callback_data.encode('utf-8')) <= MAX_CALLBACK_DATA_BYTES:
+            raise ConfigError(f"keyboard[{index}].callback_data должен быть строкой от 1 до {MAX_CALLBACK_DATA_BYTES} байт")
+        if any(other['callback_data'] == callback_data for other in buttons):
+            raise ConfigError(f"keyboard[{index}].callback_data '{callback_data}' повторяется")
+        action = button.get('action', callback_data)
+        if action not in CALLBACK_ACTIONS:
+            raise ConfigError(f"keyboard[{index}].action '{action}' неизвестно, допустимо: {', '.join(CALLBACK_ACTIONS)}")
+        prompt = button.get('prompt', 'desc')
+        if prompt not in sections['prompts']:
+            raise ConfigError(f"keyboard[{index}].prompt '{prompt}' не найден в prompts")
+        buttons.append({'label': label, 'callback_data': callback_data, 'action': action, 'prompt': prompt})
+
+    return {'keyboard': buttons, 'prompts': sections['prompts'], 'texts': sections['texts']}
+
+
+class BotConfig:
+    """
+    Проверенная версия конфигурации с заранее собранной клавиатурой и таблицей кнопок
+    """
+
+    def __init__(self, data=None, version=1):
+        data = validate_config({} if data is None else data)
+        self.version = version
+        self.keyboard = data['keyboard']
+        self.prompts = data['prompts']
+        self.texts = data['texts']
+        # callback_data -> кнопка с действием и промптом
+        self.callbacks = {button['callback_data']: button for button in self.keyboard}
+
+        markup = InlineKeyboardMarkup()
+        for button in self.keyboard:
+            markup.add(InlineKeyboardButton(text=button['label'], callback_data=button['callback_data']))
+        # telebot передает строку в reply_markup как есть, без повторной сериализации
+        self.keyboard_json = markup.to_json()
+
+    def button(self, callback_data):
+        return self.callbacks.get(callback_data)
+
+    def action(self, callback_data):
+        button = self.callbacks.get(callback_data)
+        return button['action'] if button else None
+
+
+def read_config_file(path):
+    with open(path, encoding='utf-8') as config_file:
+        try:
+            return json.load(config_file)
+        except ValueError as e:
+            raise ConfigError(f"Файл {path} не является корректным JSON: {e}") from e
+
+
+class ConfigLoader:
+    """
+    Текущая версия конфигурации; файл перечитывается, когда меняется время его изменения
+    """
+
+    def __init__(self, path=BOT_CONFIG_PATH, reload_interval=CONFIG_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.mtime = self._mtime()
+        # Ошибка в конфигурации при запуске не дает боту стартовать
+        self.config = BotConfig(read_config_file(path) if path else None)
+        self.next_check = time.monotonic() + reload_interval
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime if self.path else None
+        except OSError:
+            return None
+
+    def current(self):
+        """
+        Возвращает текущую версию конфигурации, при необходимости перечитав файл
+        """
+        if not self.path or self.reload_interval <= 0 or time.monotonic() < self.next_check:
+            return self.config
+        with self.lock:
+            if time.monotonic() >= self.next_check:
+                self.next_check = time.monotonic() + self.reload_interval
+                mtime = self._mtime()
+                if mtime is not None and mtime != self.mtime:
+                    self.mtime = mtime
+                    self.reload()
+        return self.config
+
+    def reload(self):
+        try:
+            config = BotConfig(read_config_file(self.path), self.config.version + 1)
+        except (OSError, ConfigError) as e:
+            logger.error("Конфигурация не применена, остается версия %s: %s", self.config.version, e)
+            return False
+        self.config = config
+        logger.info("Конфигурация обновлена до версии %s", config.version)
+        return True
+
+
+# Конфигурация бота (значения по умолчанию и файл BOT_CONFIG_PATH)
+bot_config = ConfigLoader()
@@ -0,0 +1,130 @@
+"""
+Постепенная доставка ответа ассистента в Telegram
+
+Сначала отправляется сообщение-заглушка, затем оно редактируется по мере
+поступления текста. Правки объединяются, чтобы не превышать лимиты Telegram
+на редактирование сообщений в одном чате, а длинный ответ делится на
+несколько сообщений по 4096 символов. Сами запросы к Telegram выполняет
+очередь отправки (outbox.py), она же выдерживает паузы после ответа 429.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+# Минимальный интервал между правками одного сообщения, секунды
+EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+
+# Текст сообщения-заглушки до появления ответа
+PLACEHOLDER_TEXT = "✍️ ..."
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Делит текст на части не длиннее limit, по возможности по границе строки или слова
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n ')
+    parts.append(text)
+    return parts
+
+
+class ProgressiveReply:
+    """
+    Ответ, который показывается пользователю по мере генерации
+    Сообщения отправляются и редактируются через очередь отправки (outbox.py),
+    поэтому обработчик не ждет ответов Telegram
+    """
+
+    def __init__(self, outbox, chat_id, reply_markup=None, edit_interval=EDIT_INTERVAL):
+        self.outbox = outbox
+        self.chat_id = chat_id
+        self.reply_markup = reply_markup
+        self.edit_interval = edit_interval
+        self.text = ''
+        self.messages = []
+        self.shown = []
+        self.last_edit = 0.0
+        self.started_at = time.monotonic()
+        self.first_text_at = None
+
+    @property
+    def first_text_latency(self):
+        """
+        Время от начала обработки до передачи первого текста ответа в очередь отправки, секунды
+        """
+        if self.first_text_at is None:
+            return None
+        return self.first_text_at - self.started_at
+
+    def start(self):
+        """
+        Ставит в очередь сообщение-заглушку
+        """
+        self.messages.append(self.outbox.send_message(self.chat_id, PLACEHOLDER_TEXT))
+        self.shown.append(PLACEHOLDER_TEXT)
+
+    def feed(self, chunk):
+        """
+        Добавляет очередной фрагмент текста и при необходимости обновляет сообщение
+        Первый фрагмент показывается сразу, остальные не чаще edit_interval
+        """
+        if not chunk:
+            return
+        self.text += chunk
+        if self.first_text_at is None or time.monotonic() - self.last_edit >= self.edit_interval:
+            self.flush()
+
+    def finish(self, text=None):
+        """
+        Показывает окончательный текст ответа и добавляет клавиатуру к последнему сообщению
+        """
+        if text is not None:
+            self.text = text
+        self.flush(final=True)
+
+    def discard(self):
+        """
+        Удаляет сообщения ответа, который больше не нужен
+        """
+        for message in self.messages:
+            self.outbox.delete_message(message)
+        self.messages = []
+        self.shown = []
+        self.text = ''
+
+    def flush(self, final=False):
+        """
+        Ставит в очередь правки, которые синхронизируют сообщения с накопленным текстом
+        """
+        parts = split_message(self.text) if self.text else [PLACEHOLDER_TEXT]
+        for index, part in enumerate(parts):
+            is_last = index == len(parts) - 1
+            markup = self.reply_markup if final and is_last else None
+            if index >= len(self.messages):
+                self.messages.append(self.outbox.send_message(self.chat_id, part, reply_markup=markup))
+                self.shown.append(part)
+            elif self.shown[index] != part or markup is not None:
+                self.outbox.edit_message_text(self.messages[index], part, reply_markup=markup)
+                self.shown[index] = part
+        if final and len(self.messages) > len(parts):
+            # Окончательный текст короче показанного (например, ошибка после длинного ответа):
+            # лишние сообщения с устаревшим текстом удаляются
+            for message in self.messages[len(parts):]:
+                self.outbox.delete_message(message)
+            del self.messages[len(parts):]
+            del self.shown[len(parts):]
+        self.last_edit = time.monotonic()
+        if self.first_text_at is None and self.text:
+            self.first_text_at = self.last_edit
@@ -0,0 +1,185 @@
+"""
+Параллельная обработка обновлений Telegram
+
+Обновления разных пользователей обрабатываются одновременно в ограниченном
+пуле потоков, а обновления одного пользователя — строго по очереди, потому что
+у одного треда OpenAI может быть только один активный запуск.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Количество потоков-обработчиков
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '8'))
+
+# Максимальное количество ожидающих обработки задач (0 — без ограничения)
+BOT_MAX_PENDING = int(os.getenv('BOT_MAX_PENDING', '1000'))
+
+
+def update_user_key(update):
+    """
+    Возвращает ключ очереди для обновления: id пользователя или id самого обновления
+    """
+    for field in ('message', 'edited_message', 'callback_query'):
+        event = getattr(update, field, None)
+        user = getattr(event, 'from_user', None)
+        if user is not None:
+            return user.id
+    return f"update_{update.update_id}"
+
+
+class UpdateDispatcher:
+    """
+    Пул потоков с отдельной очередью задач для каждого ключа
+
+    Задачи с одним ключом выполняются последовательно в порядке поступления,
+    задачи с разными ключами — параллельно. После каждой задачи очередь ключа
+    встает в конец общей очереди пула, поэтому пользователь с длинной очередью
+    не занимает поток надолго.
+    """
+
+    def __init__(self, max_workers=BOT_WORKERS, max_pending=BOT_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='bot-worker')
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.pending = 0
+        self.active = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_pending_seen = 0
+        self.wait_time_total = 0.0
+        self.closed = False
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Ставит задачу в очередь ключа
+        Если ожидающих задач больше max_pending, вызывающий поток ждет освобождения места
+        """
+        self._enqueue(key, (fn, args, kwargs), block=True)
+
+    def try_submit(self, key, fn, *args, **kwargs):
+        """
+        Ставит задачу в очередь ключа без ожидания
+        Возвращает False, если очередь заполнена (для вызова из цикла asyncio)
+        """
+        return self._enqueue(key, (fn, args, kwargs), block=False)
+
+    def _enqueue(self, key, task, block):
+        with self.condition:
+            while not self.closed and self.max_pending and self.pending >= self.max_pending:
+                if not block:
+                    return False
+                self.condition.wait()
+            if self.closed:
+                logger.warning("Диспетчер остановлен, задача для %s не принята", key)
+                return False
+
+            queue = self.queues.get(key)
+            schedule = queue is None
+            if schedule:
+                queue = self.queues[key] = deque()
+            queue.append((*task, time.monotonic()))
+
+            self.pending += 1
+            self.max_pending_seen = max(self.max_pending_seen, self.pending)
+
+        if schedule:
+            self._schedule(key)
+        return True
+
+    def _schedule(self, key):
+        """
+        Передает очередную задачу ключа пулу потоков
+        Если пул уже остановлен, оставшиеся задачи ключа отбрасываются с предупреждением
+        """
+        try:
+            self.executor.submit(self._run_next, key)
+        except RuntimeError:
+            with self.condition:
+                dropped = len(self.queues.pop(key, ()))
+                self.pending -= dropped
+                self.condition.notify_all()
+            logger.warning("Пул обработчиков остановлен, задач для %s не выполнено: %s", key, dropped)
+
+    def _run_next(self, key):
+        """
+        Выполняет очередную задачу ключа и планирует следующую, если она есть
+        """
+        with self.condition:
+            fn, args, kwargs, enqueued_at = self.queues[key].popleft()
+            self.pending -= 1
+            self.active += 1
+            self.wait_time_total += time.monotonic() - enqueued_at
+            self.condition.notify()
+
+        failed = False
+        try:
+            # Каждая задача выполняется в чистом контексте, чтобы поля логов не переходили между пользователями
+            contextvars.Context().run(fn, *args, **kwargs)
+        except Exception as e:
+            failed = True
+            logger.error("Ошибка при обработке задачи для %s: %s", key, e, exc_info=True)
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.processed += 1
+                self.failed += failed
+                if self.queues[key]:
+                    reschedule = True
+                else:
+                    del self.queues[key]
+                    reschedule = False
+                self.condition.notify_all()
+
+        if reschedule:
+            self._schedule(key)
+
+    def stats(self):
+        """
+        Возвращает метрики очереди для подбора размера пула
+        """
+        with self.condition:
+            return {
+                'workers': self.max_workers,
+                'active': self.active,
+                'pending': self.pending,
+                'queued_keys': len(self.queues),
+                'max_pending_seen': self.max_pending_seen,
+                'processed': self.processed,
+                'failed': self.failed,
+                'avg_wait': self.wait_time_total / self.processed if self.processed else 0.0,
+            }
+
+    def join(self, timeout=None):
+        """
+        Ждет, пока все поставленные задачи будут выполнены
+        Возвращает False, если за timeout секунд очередь не опустела
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.queues:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Перестает принимать задачи, с wait дожидается выполнения поставленных
+        (не дольше timeout секунд) и останавливает пул
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if wait and not self.join(timeout):
+            logger.warning("Не все задачи выполнены до остановки: %s", self.stats()['pending'])
+        self.executor.shutdown(wait=wait)
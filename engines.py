@@ -0,0 +1,218 @@
+"""
+Движки диалога
+
+Движок получает новое сообщение пользователя и возвращает ответ модели в виде
+{"content": ..., "message_id": ...} или {"error": ...}, поэтому обработчики
+main.py не зависят от того, как устроен диалог. Движок выбирается настройкой
+CONVERSATION_ENGINE:
+
+- 'assistants' — треды и запуски Assistants API (AssistantsEngine в main.py):
+  добавление сообщения, запуск и получение ответа, контекст хранит OpenAI;
+- 'chat' — Chat Completions: контекст собирается из истории сессии
+  session['messages'], а ход — это один потоковый запрос.
+
+Контекст движка 'chat' ограничен бюджетом токенов: в запрос попадают самые
+новые сообщения, которые в него помещаются, а сообщения, которые вот-вот
+вытеснит SESSION_HISTORY_LIMIT, после ответа сворачиваются в краткое
+содержание session['summary'].
+"""
+import json
+import logging
+import os
+
+from bot_logging import bind_log_context, fields
+from config import bot_config
+from inflight import superseded_result
+from metrics import stage
+from openai_client import iter_sse_events
+from session_store import SESSION_HISTORY_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Движок диалога: 'assistants' или 'chat'
+CONVERSATION_ENGINE = os.getenv('CONVERSATION_ENGINE', 'assistants')
+
+# Модель Chat Completions
+OPENAI_CHAT_MODEL = os.getenv('OPENAI_CHAT_MODEL', 'gpt-4o-mini')
+
+# Бюджет токенов контекста запроса и максимальная длина ответа
+CHAT_CONTEXT_TOKENS = int(os.getenv('CHAT_CONTEXT_TOKENS', '3000'))
+CHAT_MAX_TOKENS = int(os.getenv('CHAT_MAX_TOKENS', '800'))
+
+# Сворачивать ли старые сообщения в краткое содержание и сколько последних оставлять как есть
+CHAT_SUMMARIZE = os.getenv('CHAT_SUMMARIZE', '1') == '1'
+CHAT_KEEP_MESSAGES = int(os.getenv('CHAT_KEEP_MESSAGES', '6'))
+
+# Оценка токенов без токенизатора: около 4 символов на токен и служебные токены каждого сообщения
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """
+    Приблизительное количество токенов в тексте
+    """
+    return (len(text or '') + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_tokens(message):
+    return MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get('content'))
+
+
+def fit_history(messages, budget):
+    """
+    Возвращает самые новые сообщения, которые помещаются в budget токенов
+    Последнее сообщение остается, даже если бюджета не хватает и на него
+    """
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        cost = message_tokens(message)
+        if kept and used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept
+
+
+class ChatCompletionsEngine:
+    """
+    Диалог через Chat Completions с контекстом из локальной истории сессии
+    """
+    name = 'chat'
+
+    def __init__(self, client, model=OPENAI_CHAT_MODEL, system_prompt=None,
+                 context_tokens=CHAT_CONTEXT_TOKENS, max_tokens=CHAT_MAX_TOKENS,
+                 summarize=CHAT_SUMMARIZE, keep_messages=CHAT_KEEP_MESSAGES):
+        self.client = client
+        self.model = model
+        self.system_prompt = system_prompt
+        self.context_tokens = context_tokens
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.keep_messages = keep_messages
+
+    def current_conversation(self, user_id, session):
+        # Отдельного объекта диалога на стороне OpenAI нет: ключом служит пользователь
+        return f"chat_{user_id}"
+
+    def ensure_conversation(self, user_id, session):
+        return self.current_conversation(user_id, session)
+
+    def build_messages(self, session, content):
+        """
+        Собирает сообщения запроса: инструкции, краткое содержание и помещающаяся в бюджет история
+        История может уже заканчиваться новым сообщением content (его добавляет обработчик)
+        """
+        # Без явного system_prompt инструкции берутся из текущей версии конфигурации
+        head = [{"role": "system", "content": self.system_prompt or bot_config.current().prompts['system']}]
+        if session.get('summary'):
+            head.append({"role": "system", "content": f"Summary of the earlier conversation: {session['summary']}"})
+
+        history = session.get('messages') or []
+        latest = {"role": "user", "content": content}
+        if not history or history[-1] != latest:
+            history = history + [latest]
+
+        budget = self.context_tokens - sum(message_tokens(message) for message in head)
+        return head + fit_history(history, budget)
+
+    def run(self, conversation_id, session, content, on_delta=None, cancelled=None):
+        """
+        Отправляет один потоковый запрос и собирает ответ
+        Если выставлено событие cancelled, поток закрывается (генерация прекращается) и
+        возвращается результат с признаком superseded
+        """
+        messages = self.build_messages(session, content)
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "stream": True,
+        }
+
+        completion_id = None
+        chunks = []
+        finish_reason = None
+        try:
+            with stage('chat_stream'), self.client.post(
+                "/chat/completions", json=data, stream=True, headers={"Accept": "text/event-stream"}
+            ) as response:
+                if response.status_code != 200:
+                    logger.warning("Chat Completions вернул ошибку", extra=fields(status=response.status_code))
+                    logger.debug("Ответ API: %s", response.text)
+                    return {"error": f"API error: {response.status_code}"}
+
+                for event, payload in iter_sse_events(response.iter_lines(decode_unicode=False)):
+                    if cancelled is not None and cancelled.is_set():
+                        logger.info("Ответ прерван: пользователь написал снова или перезапустил диалог")
+                        return superseded_result()
+                    if payload == '[DONE]':
+                        break
+
+                    chunk = json.loads(payload)
+                    if 'error' in chunk:
+                        return {"error": f"API error: {(chunk['error'] or {}).get('message', payload)}"}
+                    if completion_id is None and chunk.get('id'):
+                        completion_id = chunk['id']
+                        bind_log_context(completion_id=completion_id)
+                    for choice in chunk.get('choices') or []:
+                        text = (choice.get('delta') or {}).get('content')
+                        if text:
+                            chunks.append(text)
+                            if on_delta:
+                                on_delta(text)
+                        finish_reason = choice.get('finish_reason') or finish_reason
+        except Exception as e:
+            logger.warning("Ошибка при запросе Chat Completions: %s", e)
+            return {"error": f"Error running chat completion: {str(e)}"}
+
+        text = ''.join(chunks)
+        if not text:
+            return {"error": "No assistant messages found"}
+        logger.debug("Ответ получен", extra=fields(
+            messages=len(messages), prompt_tokens=sum(message_tokens(message) for message in messages),
+            finish_reason=finish_reason
+        ))
+        result = {"content": text}
+        if completion_id:
+            result['message_id'] = completion_id
+        return result
+
+    def after_turn(self, session):
+        """
+        Сворачивает старые сообщения в краткое содержание, пока их не вытеснил SESSION_HISTORY_LIMIT
+        Возвращает True, если сессия изменилась
+        """
+        messages = session.get('messages') or []
+        # За следующий ход добавятся два сообщения, после чего история обрежется
+        if not self.summarize or len(messages) + 2 <= SESSION_HISTORY_LIMIT or len(messages) <= self.keep_messages:
+            return False
+
+        folded = messages[:len(messages) - self.keep_messages]
+        transcript = '\n'.join(f"{message['role']}: {message['content']}" for message in folded)
+        if session.get('summary'):
+            transcript = f"Earlier summary: {session['summary']}\n\n{transcript}"
+
+        try:
+            with stage('chat_summary'):
+                response = self.client.post("/chat/completions", json={
+                    "model": self.model,
+                    "messages": [
+                        {"role": "system", "content": bot_config.current().prompts['summary']},
+                        {"role": "user", "content": transcript},
+                    ],
+                    "max_tokens": self.max_tokens,
+                })
+            response.raise_for_status()
+            summary = response.json()['choices'][0]['message']['content']
+        except Exception as e:
+            # История все равно обрезается по бюджету токенов, поэтому ход не ломается
+            logger.warning("Не удалось свернуть историю диалога: %s", e)
+            return False
+
+        session['summary'] = summary
+        del messages[:len(folded)]
+        logger.info("История диалога свернута", extra=fields(folded=len(folded), summary_chars=len(summary)))
+        return True
@@ -0,0 +1,96 @@
+"""
+Учет запусков ассистента, которые выполняются для пользователей
+
+Обработчики одного пользователя выполняются по очереди, поэтому новое
+сообщение начинает обрабатываться только после того, как ассистент ответит
+на предыдущее. Чтобы не ждать устаревший ответ, событие, которое его
+заменяет (новое сообщение, /start или перезапуск диалога кнопкой), помечает
+текущий запуск пользователя как замененный еще при приеме обновления.
+Обработчик, увидев отметку, отменяет запуск в OpenAI, перестает ждать его
+результат и не показывает ответ. Ответ на заменившее сообщение начинается
+после паузы SUPERSEDE_WINDOW, чтобы остальные сообщения серии вошли в тот же
+ход (см. coalescer.py), а не отменяли каждое свой запуск.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+# Отменять ли запуск ассистента, если пользователь отправил новое сообщение
+SUPERSEDE_RUNS = os.getenv('SUPERSEDE_RUNS', '1') == '1'
+
+# Сколько секунд тишины ждать перед ответом на сообщения, заменившие запуск
+# (не дольше COALESCE_MAX_DELAY от первого из них; 0 — отвечать сразу)
+SUPERSEDE_WINDOW = float(os.getenv('SUPERSEDE_WINDOW', '1'))
+
+
+def superseded_result():
+    """
+    Результат запуска, отмененного из-за нового сообщения пользователя
+    """
+    return {"error": "Superseded by a newer message", "superseded": True}
+
+
+class InflightRun:
+    """
+    Запуск, выполняющийся для пользователя; cancelled выставляется, когда запуск заменен
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.cancelled = threading.Event()
+
+    @property
+    def superseded(self):
+        return self.cancelled.is_set()
+
+
+class InflightRuns:
+    """
+    Текущие запуски ассистента по ключам пользователей
+    """
+
+    def __init__(self, enabled=SUPERSEDE_RUNS):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.started = 0
+        self.superseded = 0
+
+    @contextmanager
+    def track(self, key):
+        """
+        Регистрирует запуск пользователя на время блока with
+        """
+        run = InflightRun(key)
+        with self.lock:
+            self.runs[key] = run
+            self.started += 1
+        try:
+            yield run
+        finally:
+            with self.lock:
+                if self.runs.get(key) is run:
+                    del self.runs[key]
+
+    def supersede(self, key):
+        """
+        Помечает текущий запуск пользователя как замененный, возвращает True, если он был
+        Не блокирует, поэтому вызывается прямо при приеме обновления
+        """
+        if not self.enabled:
+            return False
+        with self.lock:
+            run = self.runs.get(key)
+            if run is None or run.superseded:
+                return False
+            run.cancelled.set()
+            self.superseded += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'active': len(self.runs),
+                'started': self.started,
+                'superseded': self.superseded,
+            }
@@ -1,27 +1,213 @@
 import os
 import json
+import logging
+import signal
+import threading
+import time
+from contextlib import contextmanager, nullcontext
 import telebot
 import requests
-from dotenv import load_dotenv
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config import KEYBOARD_CONFIG, PROMPTS
 
-# Загрузка переменных окружения из .env файла
-load_dotenv()
+def find_env_file():
+    """
+    Ищет файл .env в каталоге бота и выше, как load_dotenv()
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(directory, '.env')
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+# Загрузка переменных окружения из .env файла (до импорта модулей бота, которые читают настройки);
+# python-dotenv импортируется, только если файл есть
+ENV_FILE = find_env_file()
+if ENV_FILE:
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
+
+from bot_logging import bind_log_context, fields, reset_log_context, setup_logging
+from circuit_breaker import CLOSED, STATE_VALUES, CircuitBreaker
+from coalescer import MessageCoalescer
+from config import bot_config
+from delivery import ProgressiveReply
+from dispatcher import UpdateDispatcher, update_user_key
+from engines import CONVERSATION_ENGINE, OPENAI_CHAT_MODEL, ChatCompletionsEngine
+from inflight import SUPERSEDE_WINDOW, InflightRuns, superseded_result
+from metrics import FALLBACK_THREADS, RUN_POLLS, STAGE_SECONDS, TURN_OPENAI_CALLS, TURN_SECONDS, SlowTurnProfiler, registry, stage, start_metrics_server
+from openai_client import OpenAIClient, iter_sse_events
+from outbox import TelegramOutbox
+from rate_limit import TelegramRequestSender, create_openai_limiter, create_telegram_limiter
+from session_store import create_session_store, trim_history
+from response_cache import ResponseCache
+from run_lock import create_run_lock
+from sharding import ShardRouter, update_payload
+from thread_pool import ThreadPrewarmer
+from tracing import trace_note, trace_poll, trace_recorder, trace_result
+from webhook import WEBHOOK_DRAIN_TIMEOUT, WEBHOOK_SECRET, run_webhook
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 # Получение API ключей из переменных окружения
 TELEGRAM_API_KEY = os.getenv('TELEGRAM_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
-# Инициализация бота
-bot = telebot.TeleBot(TELEGRAM_API_KEY)
+# Базовый адрес OpenAI API (можно указать локальный стенд, см. tools/mock_openai.py)
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
 
-# Словарь для хранения состояний диалогов пользователей
-user_sessions = {}
+# Режим получения ответа ассистента: 'stream' (события SSE) или 'poll' (опрос статуса)
+OPENAI_RUN_MODE = os.getenv('OPENAI_RUN_MODE', 'stream')
 
-def check_api_keys():
+# Добавлять сообщение (и создавать новый тред) тем же запросом, что и запуск ассистента
+# Если API этого не поддерживает, бот сам переходит к отдельным запросам
+COMBINED_RUNS = os.getenv('COMBINED_RUNS', '1') == '1'
+
+# Параметры опроса статуса запуска с адаптивной задержкой
+RUN_POLL_INITIAL_DELAY = float(os.getenv('RUN_POLL_INITIAL_DELAY', '0.25'))
+RUN_POLL_MAX_DELAY = float(os.getenv('RUN_POLL_MAX_DELAY', '2.0'))
+RUN_POLL_BACKOFF = 1.5
+RUN_TIMEOUT = float(os.getenv('RUN_TIMEOUT', '60'))
+
+# Базовый адрес Telegram Bot API (можно указать локальный стенд, см. tools/mock_telegram.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '').rstrip('/')
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
+# Способ получения обновлений: 'polling' (getUpdates) или 'webhook' (см. webhook.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Публичный адрес webhook, который регистрируется в Telegram при запуске (если задан)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+
+# Ограничение частоты запросов: запросы ждут своей очереди вместо 429 (rate_limit.py)
+openai_limiter = create_openai_limiter()
+telegram_limiter = create_telegram_limiter()
+telebot.apihelper.CUSTOM_REQUEST_SENDER = TelegramRequestSender(telegram_limiter)
+
+# Выключатель: во время сбоя OpenAI запросы сразу завершаются ошибкой, а не ждут таймаутов
+openai_breaker = CircuitBreaker('openai')
+
+# Общий клиент OpenAI API с пулом keep-alive соединений, таймаутами и повторами
+openai_client = OpenAIClient(OPENAI_API_KEY, OPENAI_API_BASE, limiter=openai_limiter, breaker=openai_breaker)
+
+# Инициализация бота (обработчики запускает наш диспетчер, а не встроенный пул telebot)
+bot = telebot.TeleBot(TELEGRAM_API_KEY, threaded=False)
+
+# Пул обработчиков: разные пользователи обслуживаются параллельно, один пользователь — по очереди
+update_dispatcher = UpdateDispatcher()
+process_updates_inline = bot.process_new_updates
+
+# Очередь исходящих сообщений: обработчики не ждут ответов Telegram, операции одного чата идут по порядку
+outbox = TelegramOutbox(bot)
+
+# Объединение сообщений, которые пользователь отправляет подряд, в один ход диалога
+coalescer = MessageCoalescer()
+
+# Запуски ассистента, которые отменяются, если пользователь написал снова или перезапустил диалог
+inflight_runs = InflightRuns()
+
+def register_update(key, update):
     """
-    Проверяет наличие и валидность API ключей
+    Передает текстовые сообщения в объединитель, а остальные события закрывают группу сообщений пользователя
+    Новое сообщение и перезапуск диалога заменяют запуск ассистента, который еще выполняется
+    """
+    message = update.message
+    if message is not None and message.content_type == 'text' and not (message.text or '').startswith('/'):
+        coalescer.add(key, message)
+        if inflight_runs.supersede(key):
+            # Пользователь еще пишет: следующие сообщения серии войдут в тот же ход
+            coalescer.extend_window(key, SUPERSEDE_WINDOW)
+        return
+    
+    coalescer.seal(key)
+    if message is not None and (message.text or '').split(maxsplit=1)[:1] == ['/start']:
+        inflight_runs.supersede(key)
+    elif update.callback_query is not None and bot_config.current().action(update.callback_query.data) == 'start':
+        inflight_runs.supersede(key)
+
+# Распределение пользователей между экземплярами бота (SHARD_INDEX, SHARD_COUNT, SHARD_PEERS)
+shard_router = ShardRouter(secret=WEBHOOK_SECRET)
+
+def process_updates_concurrently(updates):
+    """
+    Раздает полученные обновления по очередям пользователей в пуле обработчиков
+    Обновления пользователей другого экземпляра бота пересылаются ему в той же очереди
+    """
+    for update in updates:
+        # Смещение для getUpdates сдвигаем сразу, иначе polling получит те же обновления повторно
+        if update.update_id > bot.last_update_id:
+            bot.last_update_id = update.update_id
+        key = update_user_key(update)
+        if shard_router.owns(key):
+            register_update(key, update)
+            update_dispatcher.submit(key, process_updates_inline, [update])
+        else:
+            update_dispatcher.submit(key, forward_update, key, update_payload(update))
+
+bot.process_new_updates = process_updates_concurrently
+
+def accept_webhook_update(data, forwarded=False):
+    """
+    Принимает обновление из webhook и ставит его в очередь пользователя без ожидания
+    Возвращает False, если очередь обработчиков заполнена
+    """
+    update = telebot.types.Update.de_json(data)
+    key = update_user_key(update)
+    # Пересланное другим экземпляром обновление обрабатываем здесь, даже если шарды настроены по-разному
+    if forwarded or shard_router.owns(key):
+        register_update(key, update)
+        if update_dispatcher.try_submit(key, process_updates_inline, [update]):
+            return True
+        if update.message is not None:
+            coalescer.discard(key, update.message)
+        return False
+    return update_dispatcher.try_submit(key, forward_update, key, data)
+
+def forward_update(key, data):
+    """
+    Пересылает обновление экземпляру-владельцу, а если он недоступен, обрабатывает на месте
+    """
+    if not shard_router.forward(key, data):
+        process_updates_inline([telebot.types.Update.de_json(data)])
+
+# Хранилище состояний диалогов пользователей (кэш в памяти и, по умолчанию, SQLite)
+session_store = create_session_store()
+
+# Аренда треда на время запуска ассистента, общая для экземпляров бота при RUN_LOCK=sqlite
+run_lock = create_run_lock()
+
+# Кэш объяснений последнего сообщения по ключу (тред, последнее сообщение)
+explanation_cache = ResponseCache()
+
+# Текущее состояние бота для метрик (считается при каждом запросе /metrics)
+registry.gauge('bot_sessions', "Сохраненные сессии пользователей, не старше SESSION_TTL", function=lambda: len(session_store))
+registry.gauge('bot_active_runs', "Запуски ассистента, которые выполняются сейчас",
+               function=lambda: inflight_runs.stats()['active'])
+registry.gauge('bot_queued_updates', "Обновления в очередях пользователей",
+               function=lambda: update_dispatcher.stats()['pending'])
+registry.gauge('bot_outbox_pending', "Операции в очереди отправки Telegram",
+               function=lambda: outbox.stats()['pending'])
+registry.gauge('bot_rate_limit_delay_seconds', "Ожидание, которое получил бы новый запрос в общей очереди", ('api',),
+               function=lambda: {('openai',): openai_limiter.delay(), ('telegram',): telegram_limiter.delay()})
+registry.gauge('bot_circuit_state', "Состояние выключателя: 0 — замкнут, 1 — полуоткрыт, 2 — разомкнут", ('api',),
+               function=lambda: {('openai',): STATE_VALUES[openai_breaker.current_state()]})
+
+# Выборочный профилировщик медленных ходов (PROFILE_SLOW_TURN)
+turn_profiler = SlowTurnProfiler()
+
+# Через сколько секунд повторять создание треда для сессии с временным fallback-тредом
+THREAD_RETRY_INTERVAL = float(os.getenv('THREAD_RETRY_INTERVAL', '30'))
+
+# Быстрый запуск: ключи проверяются в фоне, после того как бот начал принимать обновления
+FAST_START = os.getenv('FAST_START', '0') == '1'
+
+def check_required_keys():
+    """
+    Проверяет, что обязательные ключи заданы (без запросов к API)
     """
     missing_keys = []
     
@@ -32,124 +218,222 @@ def check_api_keys():
     if not OPENAI_API_KEY:
         missing_keys.append("OPENAI_API_KEY")
     
+    # Ассистент нужен только движку Assistants API
     assistant_id = os.getenv('OPENAI_ASSISTANT_ID')
-    if not assistant_id:
+    if not assistant_id and CONVERSATION_ENGINE == 'assistants':
         missing_keys.append("OPENAI_ASSISTANT_ID")
     
     if missing_keys:
-        print("ОШИБКА: Следующие ключи API отсутствуют в .env файле:")
-        for key in missing_keys:
-            print(f"- {key}")
-        print("Пожалуйста, добавьте эти ключи в файл .env")
+        logger.error("Следующие ключи API отсутствуют в .env файле: %s. Пожалуйста, добавьте эти ключи в файл .env", ', '.join(missing_keys))
+        return False
+    return True
+
+def validate_openai_key():
+    """
+    Проверяет ключ OpenAI легким запросом: ассистент бота (или модель движка chat), а не весь список моделей
+    Возвращает True, False, если ключ или ассистент отклонены, и None, если API недоступен
+    """
+    if CONVERSATION_ENGINE == 'assistants':
+        path = f"/assistants/{os.getenv('OPENAI_ASSISTANT_ID')}"
+    else:
+        path = f"/models/{OPENAI_CHAT_MODEL}"
+    try:
+        response = openai_client.get(path)
+    except Exception as e:
+        logger.error("Ошибка при проверке OpenAI API ключа: %s", e)
+        return None
+    if response.status_code >= 500:
+        logger.error("OpenAI API недоступен при проверке ключа. Код ответа: %s", response.status_code)
+        return None
+    if response.status_code != 200:
+        logger.error("OpenAI API ключ или ассистент недействителен. Код ответа: %s. Ответ API: %s", response.status_code, response.text)
+        return False
+    return True
+
+def validate_telegram_key():
+    """
+    Проверяет ключ Telegram запросом getMe; результат сохраняется в bot.user, и polling его не повторяет
+    Возвращает True, False, если ключ отклонен, и None, если API недоступен
+    """
+    try:
+        bot.user
+    except telebot.apihelper.ApiTelegramException as e:
+        logger.error("Telegram API ключ недействителен: %s", e)
+        return False if e.error_code in (401, 404) else None
+    except Exception as e:
+        logger.error("Ошибка при проверке Telegram API ключа: %s", e)
+        return None
+    return True
+
+def check_api_keys():
+    """
+    Проверяет наличие и валидность API ключей
+    Ключи OpenAI и Telegram проверяются одновременно
+    """
+    if not check_required_keys():
         return False
     
-    # Проверка валидности OpenAI API ключа
-    if OPENAI_API_KEY:
-        try:
-            headers = {
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "OpenAI-Beta": "assistants=v2"  # Обновлено на v2
-            }
-            response = requests.get("https://api.openai.com/v1/models", headers=headers)
-            
-            if response.status_code != 200:
-                print(f"ОШИБКА: OpenAI API ключ недействителен. Код ответа: {response.status_code}")
-                print(f"Ответ API: {response.text}")
-                return False
-        except Exception as e:
-            print(f"ОШИБКА при проверке OpenAI API ключа: {e}")
-            return False
+    telegram_result = []
+    telegram_check = threading.Thread(target=lambda: telegram_result.append(validate_telegram_key()), name='telegram-key-check')
+    telegram_check.start()
+    openai_ok = validate_openai_key()
+    telegram_check.join()
+    return openai_ok is True and telegram_result == [True]
+
+def stop_bot():
+    """
+    Останавливает прием обновлений: polling завершается, webhook сервер останавливается по SIGTERM
+    """
+    if BOT_MODE == 'webhook':
+        os.kill(os.getpid(), signal.SIGTERM)
+    else:
+        bot.stop_polling()
+
+# Выставляется, если фоновая проверка отклонила ключ: процесс завершится с ошибкой
+api_keys_rejected = threading.Event()
+
+def check_api_keys_in_background():
+    """
+    Проверяет ключ OpenAI в фоне, пока бот уже принимает обновления (FAST_START)
+    Ключ Telegram проверяет сам запуск polling; бот останавливается, только если ключ отклонен,
+    а недоступность API обрабатывают повторы и выключатель
+    """
+    def check():
+        if validate_openai_key() is False:
+            logger.critical("Ключ OpenAI отклонен, бот останавливается")
+            api_keys_rejected.set()
+            stop_bot()
+        else:
+            logger.info("API keys validated successfully!")
     
-    return True
+    threading.Thread(target=check, name='api-key-check', daemon=True).start()
 
 def create_keyboard():
     """
-    Создает клавиатуру с кнопками из конфигурационного файла
+    Возвращает клавиатуру с кнопками из конфигурации
+    Разметка собирается и сериализуется в JSON один раз для каждой версии конфигурации
     """
-    markup = InlineKeyboardMarkup()
-    for button in KEYBOARD_CONFIG:
-        markup.add(InlineKeyboardButton(
-            text=button['label'],
-            callback_data=button['callback_data']
-        ))
-    return markup
+    return bot_config.current().keyboard_json
 
 def create_session(user_id):
     """
     Создает новую сессию для пользователя
+    Тред OpenAI создается позже, при первом сообщении (см. ensure_thread)
     """
-    import time  # Импортируем модуль time
-    
     # Инициализируем сессию с базовыми значениями
-    user_sessions[user_id] = {
+    session = {
         'thread_id': None,
         'messages': []
     }
     
-    try:
-        # Создаем новый thread в OpenAI API
-        thread = create_openai_thread()
-        
-        # Проверяем, есть ли ключ 'id' в ответе
-        if thread and isinstance(thread, dict) and 'id' in thread:
-            user_sessions[user_id]['thread_id'] = thread['id']
-        else:
-            # Если id не получен, используем временный идентификатор
-            fallback_id = f"fallback_{user_id}_{int(time.time())}"
-            user_sessions[user_id]['thread_id'] = fallback_id
-            print(f"Ответ API не содержит id, используем временный id треда: {fallback_id}")
-            print(f"Полученный ответ от API: {thread}")
-    except Exception as e:
-        # В случае ошибки используем временный идентификатор
-        fallback_id = f"fallback_{user_id}_{int(time.time())}"
-        user_sessions[user_id]['thread_id'] = fallback_id
-        print(f"Ошибка при создании треда: {e}. Используем временный id: {fallback_id}")
+    session_store.put(user_id, session)
+    return session
+
+def ensure_thread(user_id, session, defer=False):
+    """
+    Возвращает id треда сессии, при необходимости получая его из пула или создавая новый
+    Временный fallback-тред заменяется настоящим, как только API снова доступен
+    С defer=True, если пул пуст, тред не создается и возвращается None: его создаст
+    запрос запуска (см. AssistantsEngine.run)
+    """
+    thread_id = session.get('thread_id')
+    if thread_id and 'fallback' not in str(thread_id):
+        return thread_id
+    
+    # После неудачи не пытаемся создавать тред на каждом сообщении
+    if thread_id and time.time() < session.get('thread_retry_at', 0):
+        return thread_id
+    
+    new_thread_id = thread_prewarmer.take()
+    if not new_thread_id and defer and not thread_id:
+        return None
+    if not new_thread_id:
+        try:
+            # Создаем новый thread в OpenAI API
+            thread = create_openai_thread()
+            
+            # Проверяем, есть ли ключ 'id' в ответе
+            if thread and isinstance(thread, dict) and 'fallback' not in str(thread.get('id', 'fallback')):
+                new_thread_id = thread['id']
+            else:
+                logger.warning("Ответ API не содержит id треда")
+        except Exception as e:
+            logger.warning("Ошибка при создании треда: %s", e)
+        thread_prewarmer.report(bool(new_thread_id))
     
-    return user_sessions[user_id]
+    if new_thread_id:
+        if thread_id:
+            logger.info("Соединение с API восстановлено, временный тред заменен", extra=fields(fallback_thread_id=thread_id, thread_id=new_thread_id))
+        session['thread_id'] = new_thread_id
+        session.pop('thread_retry_at', None)
+    else:
+        # Если id не получен, используем временный идентификатор
+        if not thread_id:
+            thread_id = f"fallback_{user_id}_{int(time.time())}"
+            FALLBACK_THREADS.inc()
+            logger.warning("Используем временный id треда", extra=fields(thread_id=thread_id))
+        session['thread_id'] = thread_id
+        session['thread_retry_at'] = time.time() + THREAD_RETRY_INTERVAL
+    
+    session_store.put(user_id, session)
+    return session['thread_id']
+
+def prewarm_thread():
+    """
+    Создает тред для пула заранее созданных тредов, возвращает его id или None
+    """
+    thread = create_openai_thread()
+    thread_id = thread.get('id') if isinstance(thread, dict) else None
+    if not thread_id or 'fallback' in thread_id:
+        return None
+    return thread_id
+
+# Пул заранее созданных тредов, пополняется в фоне после запуска бота
+thread_prewarmer = ThreadPrewarmer(prewarm_thread)
 
 def get_session(user_id):
     """
     Получает текущую сессию пользователя или создает новую, если её нет
     """
-    if user_id not in user_sessions:
+    session = session_store.get(user_id)
+    if session is None:
         return create_session(user_id)
-    return user_sessions[user_id]
+    return session
+
+def add_to_history(user_id, session, role, content):
+    """
+    Добавляет сообщение в историю сессии, обрезает историю и сохраняет сессию
+    """
+    session['messages'].append({"role": role, "content": content})
+    trim_history(session)
+    session_store.put(user_id, session)
 
 def create_openai_thread():
     """
     Создает новый thread в OpenAI API
     """
-    import time  # Импортируем модуль time
-    
-    url = "https://api.openai.com/v1/threads"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-        "OpenAI-Beta": "assistants=v2"  # Обновлено на v2
-    }
+    path = "/threads"
     
     try:
-        response = requests.post(url, headers=headers, json={})
+        response = openai_client.post(path, json={})
         response.raise_for_status()  # Проверка на HTTP ошибки
         response_data = response.json()
         
         # Проверка наличия id в ответе
         if not response_data or not isinstance(response_data, dict) or 'id' not in response_data:
-            print(f"OpenAI API вернул ответ без id: {response_data}")
+            logger.warning("OpenAI API вернул ответ без id треда")
             # Создаем фиктивный id для предотвращения ошибки
             return {"id": f"fallback_unknown_{int(time.time())}"}
         
         return response_data
     except requests.exceptions.RequestException as e:
-        print(f"Ошибка HTTP при создании треда OpenAI: {e}")
+        logger.warning("Ошибка HTTP при создании треда OpenAI: %s", e)
         if 'response' in locals() and hasattr(response, 'text'):
-            print(f"Ответ API: {response.text}")
-        else:
-            print("Ответ API не получен")
+            logger.debug("Ответ API: %s", response.text)
         # Создаем фиктивный id для предотвращения ошибки
         return {"id": f"fallback_unknown_{int(time.time())}"}
     except Exception as e:
-        print(f"Неожиданная ошибка при создании треда OpenAI: {e}")
+        logger.error("Неожиданная ошибка при создании треда OpenAI: %s", e)
         # Создаем фиктивный id для предотвращения ошибки
         return {"id": f"fallback_unknown_{int(time.time())}"}
 
@@ -161,15 +445,10 @@ def add_message_to_thread(thread_id, content):
     """
     # Если id треда содержит 'fallback', используем локальное хранение
     if 'fallback' in str(thread_id):
-        print(f"Используем локальное хранение для сообщения в треде {thread_id}")
+        logger.debug("Используем локальное хранение для сообщения", extra=fields(thread_id=thread_id))
         return {"role": "user", "content": content}
     
-    url = f"https://api.openai.com/v1/threads/{thread_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-        "OpenAI-Beta": "assistants=v2"
-    }
+    path = f"/threads/{thread_id}/messages"
     
     # В API v2 может потребоваться другая структура данных
     data = {
@@ -178,193 +457,426 @@ def add_message_to_thread(thread_id, content):
     }
     
     try:
-        # Отладка
-        print(f"Отправляем сообщение в тред: {content}")
-        
-        response = requests.post(url, headers=headers, json=data)
+        started = time.perf_counter()
+        with stage('add_message'):
+            response = openai_client.post(path, json=data)
         response.raise_for_status()
         response_data = response.json()
         
-        # Отладка
-        print(f"Ответ на добавление сообщения: {json.dumps(response_data, indent=2)}")
+        # Отладка: только размеры, без текста пользователя
+        logger.debug("Сообщение добавлено в тред", extra=fields(
+            thread_id=thread_id, message_id=response_data.get('id'), chars=len(content),
+            bytes=len(response.content), duration=time.perf_counter() - started
+        ))
         
         return response_data
     except Exception as e:
-        print(f"Ошибка при добавлении сообщения в тред: {e}")
-        print(f"Ответ API: {response.text if 'response' in locals() else 'Нет ответа'}")
+        logger.warning("Ошибка при добавлении сообщения в тред: %s", e, extra=fields(thread_id=thread_id))
+        if 'response' in locals():
+            logger.debug("Ответ API: %s", response.text)
         return {"role": "user", "content": content, "error": str(e)}
 
-def run_assistant(thread_id, prompt=None):
+def cancel_run(thread_id, run_id):
     """
-    Запускает ассистента и получает его ответ
-    Если передан prompt, он будет использован как инструкция для ассистента
+    Отменяет запуск ассистента, возвращает True, если OpenAI принял отмену
+    Уже завершившийся запуск отменить нельзя, тогда возвращается False
     """
-    # Если id треда содержит 'fallback', используем локальное хранение
-    if 'fallback' in str(thread_id):
-        print(f"Используем локальную обработку для треда {thread_id}")
-        return {"content": "I'm sorry, there seems to be an issue connecting to the language model. Please try restarting the conversation or try again later."}
-    
-    url = f"https://api.openai.com/v1/threads/{thread_id}/runs"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-        "OpenAI-Beta": "assistants=v2"  # Обновлено на v2
-    }
-    
-    # ID вашего ассистента OpenAI
-    assistant_id = os.getenv('OPENAI_ASSISTANT_ID')
-    
-    # Проверка наличия assistant_id
-    if not assistant_id:
-        print("ОШИБКА: OPENAI_ASSISTANT_ID не найден в .env файле")
-        return {"error": "Assistant ID is missing. Please check your .env file."}
-    
-    data = {
-        "assistant_id": assistant_id
-    }
-    
-    # Если передан prompt, добавляем его как инструкцию
-    if prompt:
-        data["instructions"] = prompt
-    
     try:
-        # Запускаем ассистента
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        run_data = response.json()
-        
-        if 'id' not in run_data:
-            print(f"API не вернул ID для запуска: {run_data}")
-            return {"error": "Could not start assistant run. Please check your API credentials."}
-            
-        run_id = run_data.get('id')
-        
-        # Ждем завершения выполнения
-        return wait_for_run_completion(thread_id, run_id)
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP ошибка: {e}")
-        print(f"Детали ответа: {response.text if 'response' in locals() else 'Нет ответа'}")
-        return {"error": f"API error: {str(e)}"}
+        response = openai_client.post(f"/threads/{thread_id}/runs/{run_id}/cancel")
     except Exception as e:
-        print(f"Ошибка при запуске ассистента: {e}")
-        return {"error": f"Error running assistant: {str(e)}"}
+        logger.warning("Ошибка при отмене запуска: %s", e, extra=fields(run_id=run_id))
+        return False
+    if response.status_code != 200:
+        logger.info("Запуск не отменен", extra=fields(run_id=run_id, status=response.status_code))
+        return False
+    logger.info("Запуск отменен: пользователь написал снова или перезапустил диалог", extra=fields(run_id=run_id))
+    return True
 
-def wait_for_run_completion(thread_id, run_id):
+def wait_for_run_completion(thread_id, run_id, cancelled=None, deadline=None):
     """
     Ожидает завершения выполнения ассистента и получает результат
+    Ждет не дольше RUN_TIMEOUT или до deadline (time.monotonic()), если он передан
+    Интервал опроса начинается с RUN_POLL_INITIAL_DELAY и растет до RUN_POLL_MAX_DELAY,
+    поэтому быстрые ответы забираются почти сразу, а долгие не тратят лишние запросы
+    Если выставлено событие cancelled, запуск отменяется, и после его остановки
+    возвращается результат с признаком superseded
     """
-    import time  # Импортируем модуль time
-    
-    url = f"https://api.openai.com/v1/threads/{thread_id}/runs/{run_id}"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "OpenAI-Beta": "assistants=v2"  # Обновлено на v2
-    }
+    path = f"/threads/{thread_id}/runs/{run_id}"
     
-    max_retries = 30  # Максимальное количество попыток
-    retry_count = 0
+    if deadline is None:
+        deadline = time.monotonic() + RUN_TIMEOUT
+    delay = RUN_POLL_INITIAL_DELAY
+    polls = 0
+    cancel_requested = False
     
-    while retry_count < max_retries:
+    while True:
         try:
-            response = requests.get(url, headers=headers)
+            polls += 1
+            RUN_POLLS.inc()
+            trace_poll()
+            with stage('run_poll'):
+                response = openai_client.get(path)
             response.raise_for_status()
             run_data = response.json()
             status = run_data.get('status')
             
-            if status == 'completed':
+            if status == 'cancelled' and cancel_requested:
+                return superseded_result()
+            elif status == 'completed':
+                logger.debug("Запуск завершен", extra=fields(run_id=run_id, polls=polls))
                 # Получаем сообщения из треда
-                return get_thread_messages(thread_id)
-            elif status in ['failed', 'expired', 'cancelled']:
-                error_info = run_data.get('last_error', {}).get('message', 'No specific error message')
-                print(f"Run завершился с ошибкой: {status}. Детали: {error_info}")
+                return get_thread_messages(thread_id, run_id)
+            elif status in ['failed', 'expired', 'cancelled', 'incomplete']:
+                error_info = (run_data.get('last_error') or {}).get('message', 'No specific error message')
+                logger.warning("Run завершился с ошибкой: %s. Детали: %s", status, error_info, extra=fields(run_id=run_id, polls=polls))
                 return {"error": f"Run ended with status: {status}. Details: {error_info}"}
-            
-            # Ждем немного перед следующей проверкой
-            time.sleep(2)
-            retry_count += 1
         except Exception as e:
-            print(f"Ошибка при проверке статуса выполнения: {e}")
+            logger.warning("Ошибка при проверке статуса выполнения: %s", e, extra=fields(run_id=run_id))
             return {"error": f"Error checking run status: {str(e)}"}
+        
+        # Запуск заменен новым сообщением: отменяем его и ждем остановки, чтобы освободить тред
+        if cancelled is not None and cancelled.is_set() and not cancel_requested:
+            cancel_requested = True
+            if cancel_run(thread_id, run_id):
+                delay = RUN_POLL_INITIAL_DELAY
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        
+        # Ждем перед следующей проверкой, постепенно увеличивая интервал
+        if cancelled is not None and not cancel_requested:
+            cancelled.wait(min(delay, remaining))
+        else:
+            time.sleep(min(delay, remaining))
+        delay = min(delay * RUN_POLL_BACKOFF, RUN_POLL_MAX_DELAY)
     
     return {"error": "Timeout waiting for assistant response"}
 
-def get_thread_messages(thread_id):
+def extract_message_text(content_list):
+    """
+    Извлекает текст из списка блоков content сообщения или дельты API v2
+    """
+    parts = []
+    for block in content_list or []:
+        if isinstance(block, dict) and block.get('type', 'text') == 'text':
+            text = block.get('text')
+            if isinstance(text, dict):
+                parts.append(text.get('value') or '')
+            elif isinstance(text, str):
+                parts.append(text)
+        elif isinstance(block, str):
+            parts.append(block)
+    return ''.join(parts)
+
+def combined_run_rejected(response, data):
+    """
+    True, если API не принял запуск вместе с сообщениями: не знает additional_messages
+    или не умеет создавать тред тем же запросом (POST /threads/runs)
+    """
+    keys = [key for key in ('additional_messages', 'thread') if key in data]
+    if not keys:
+        return False
+    if response.status_code == 404 and 'thread' in keys:
+        return True
+    if response.status_code != 400:
+        return False
+    try:
+        error = response.json().get('error') or {}
+    except (ValueError, AttributeError):
+        return False
+    message = str(error.get('message') or '')
+    return error.get('param') in keys or any(f"argument supplied: {key}" in message for key in keys)
+
+def combined_run_unsupported_result():
+    """
+    Результат запуска, который API отклонил из-за additional_messages или создания треда
+    """
+    return {"error": "Combined runs are not supported by the API", "combined_unsupported": True}
+
+def stream_rejected(response):
+    """
+    True, если API отклонил потоковый запуск из-за параметра stream; запуск при этом не создан
+    """
+    if response.status_code != 400:
+        return False
+    try:
+        error = response.json().get('error') or {}
+    except (ValueError, AttributeError):
+        return False
+    return error.get('param') == 'stream'
+
+def stream_run(thread_id, data, on_delta=None, cancelled=None):
+    """
+    Запускает ассистента в потоковом режиме и собирает ответ из событий SSE
+    Ответ возвращается сразу после события завершения, без опроса статуса и
+    отдельного запроса списка сообщений
+    Если thread_id не задан, тред создается тем же запросом (data['thread']), а его id
+    возвращается в результате под ключом thread_id
+    Если передан on_delta, он вызывается для каждого нового фрагмента текста
+    Если выставлено событие cancelled, запуск отменяется, а поток дочитывается до его остановки
+    Запуск вместе с дочитыванием опросом ждет не дольше RUN_TIMEOUT, меньшего срока аренды треда
+    Возвращает None, только если API отклонил параметр stream и запуск не создан; ошибки
+    HTTP и соединения возвращаются как результат с ошибкой, без повторного запуска
+    """
+    path = f"/threads/{thread_id}/runs" if thread_id else "/threads/runs"
+    new_thread = not thread_id
+    deadline = time.monotonic() + RUN_TIMEOUT
+    # Ожидание очередного события тоже не дольше общего срока
+    timeout = (openai_client.timeout[0], min(openai_client.timeout[1], RUN_TIMEOUT))
+    
+    run_id = None
+    message_id = None
+    chunks = []
+    final_text = None
+    cancel_requested = False
+    cancelling = False
+    result = None
+    
+    try:
+        started = time.perf_counter()
+        with openai_client.post(path, json=dict(data, stream=True), stream=True, timeout=timeout,
+                                headers={"Accept": "text/event-stream"}) as response:
+            if combined_run_rejected(response, data):
+                return combined_run_unsupported_result()
+            if stream_rejected(response):
+                # Запуск не создан: его можно создать заново в режиме опроса
+                return None
+            response.raise_for_status()
+            
+            if 'text/event-stream' not in response.headers.get('Content-Type', ''):
+                # API не умеет отвечать потоком и вернул созданный запуск: дожидаемся его опросом,
+                # а не создаем второй
+                run_data = response.json()
+                run_id = run_data.get('id')
+                thread_id = thread_id or run_data.get('thread_id')
+                if not run_id or not thread_id:
+                    return {"error": "Could not start assistant run. Please check your API credentials."}
+                bind_log_context(run_id=run_id, thread_id=thread_id)
+                logger.info("API вернул запуск без потока событий, переходим к опросу")
+                events = ()
+            else:
+                events = iter_sse_events(response.iter_lines(decode_unicode=False))
+            
+            for event, payload in events:
+                if payload == '[DONE]':
+                    break
+                
+                event_data = json.loads(payload)
+                
+                if time.monotonic() >= deadline:
+                    logger.warning("Запуск не завершился за RUN_TIMEOUT", extra=fields(run_id=run_id))
+                    result = {"error": "Timeout waiting for assistant response"}
+                    break
+                
+                # Запуск заменен новым сообщением: отменяем его один раз и больше не показываем фрагменты
+                if cancelled is not None and cancelled.is_set() and run_id and not cancel_requested:
+                    cancel_requested = True
+                    cancelling = cancel_run(thread_id, run_id)
+                
+                if event == 'thread.run.created':
+                    run_id = event_data.get('id')
+                    thread_id = thread_id or event_data.get('thread_id')
+                    bind_log_context(run_id=run_id, thread_id=thread_id)
+                    STAGE_SECONDS.observe(time.perf_counter() - started, stage='run_create')
+                elif event == 'thread.message.delta':
+                    delta = event_data.get('delta', {})
+                    chunk = extract_message_text(delta.get('content'))
+                    chunks.append(chunk)
+                    if on_delta and chunk and not cancelling:
+                        on_delta(chunk)
+                elif event == 'thread.message.completed':
+                    final_text = extract_message_text(event_data.get('content'))
+                    message_id = event_data.get('id')
+                elif event == 'thread.run.completed':
+                    text = final_text if final_text is not None else ''.join(chunks)
+                    if not text:
+                        result = {"error": "No assistant messages found"}
+                    else:
+                        result = {"content": text}
+                        if message_id:
+                            result['message_id'] = message_id
+                    break
+                elif event == 'thread.run.cancelled' and cancelling:
+                    result = superseded_result()
+                    break
+                elif event in ['thread.run.failed', 'thread.run.expired', 'thread.run.cancelled', 'thread.run.incomplete']:
+                    status = event.rsplit('.', 1)[-1]
+                    error_info = (event_data.get('last_error') or {}).get('message', 'No specific error message')
+                    logger.warning("Run завершился с ошибкой: %s. Детали: %s", status, error_info)
+                    result = {"error": f"Run ended with status: {status}. Details: {error_info}"}
+                    break
+                elif event == 'thread.run.requires_action':
+                    result = {"error": "Run requires an action that is not supported by this bot"}
+                    break
+                elif event == 'error':
+                    error_info = event_data.get('message', payload) if isinstance(event_data, dict) else payload
+                    result = {"error": f"API error: {error_info}"}
+                    break
+    except requests.exceptions.HTTPError as e:
+        logger.warning("HTTP ошибка: %s", e, extra=fields(thread_id=thread_id))
+        return {"error": f"API error: {str(e)}"}
+    except Exception as e:
+        logger.warning("Ошибка при чтении потока событий: %s", e)
+        if not run_id:
+            # Создан ли запуск, неизвестно: повторный запрос мог бы создать второй запуск
+            # и второй раз добавить сообщение пользователя
+            return {"error": f"Error running assistant: {str(e)}"}
+    
+    if result is None:
+        # Поток оборвался до завершения запуска: дожидаемся результата опросом
+        if events:
+            logger.warning("Поток событий завершился без результата, переходим к опросу запуска")
+        result = wait_for_run_completion(thread_id, run_id, cancelled, deadline)
+    # Тред создан этим запросом: сессия должна его запомнить, даже если запуск завершился ошибкой
+    if new_thread and thread_id:
+        result['thread_id'] = thread_id
+    return result
+
+def parse_assistant_message(message):
+    """
+    Извлекает текст из сообщения ассистента с учетом разных форматов API v2
+    """
+    # Проверка формата ответа в зависимости от версии API
+    content_list = message.get('content', [])
+    if content_list and len(content_list) > 0:
+        # Проверяем формат сообщения для v2
+        if isinstance(content_list[0], dict) and 'text' in content_list[0]:
+            text_value = content_list[0].get('text', {}).get('value', 'No response')
+            return {"content": text_value}
+        # Формат может быть другим в v2
+        elif isinstance(content_list[0], dict) and 'type' in content_list[0]:
+            if content_list[0].get('type') == 'text':
+                return {"content": content_list[0].get('text', {}).get('value', 'No response')}
+        # Простой текстовый формат (может использоваться в v2)
+        elif isinstance(content_list, list) and all(isinstance(item, str) for item in content_list):
+            return {"content": ' '.join(content_list)}
+        # Пробуем извлечь текст напрямую, если структура сложная
+        else:
+            try:
+                return {"content": str(content_list)}
+            except:
+                return {"content": "Received response in unknown format"}
+    # Проверяем, есть ли текст напрямую в message
+    elif 'text' in message:
+        return {"content": message.get('text')}
+    else:
+        return {"content": "Received empty response from assistant"}
+    
+    # Блок не текстовый: пропускаем сообщение
+    return None
+
+def get_thread_messages(thread_id, run_id=None):
     """
     Получает сообщения из треда после завершения выполнения ассистента
+    Запрашивается только самое новое сообщение (limit=1, order=desc), а если известен
+    run_id — только сообщения этого запуска, поэтому размер ответа не растет с длиной диалога
     Поддерживает обработку ответов от API v2
     """
-    url = f"https://api.openai.com/v1/threads/{thread_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "OpenAI-Beta": "assistants=v2"
-    }
+    path = f"/threads/{thread_id}/messages"
+    params = {"limit": 1, "order": "desc"}
+    if run_id:
+        params["run_id"] = run_id
     
     try:
-        response = requests.get(url, headers=headers)
+        with stage('get_messages'):
+            response = openai_client.get(path, params=params)
         response.raise_for_status()
         messages_data = response.json()
         
-        # Отладочная информация
-        print(f"Полученные сообщения: {json.dumps(messages_data, indent=2)}")
+        # Отладочная информация: только размеры, без содержимого переписки
+        logger.debug("Получены сообщения треда", extra=fields(
+            thread_id=thread_id, count=len(messages_data.get('data', [])), bytes=len(response.content)
+        ))
         
         # Возвращаем последнее сообщение от ассистента
         for message in messages_data.get('data', []):
             if message.get('role') == 'assistant':
-                # Проверка формата ответа в зависимости от версии API
-                content_list = message.get('content', [])
-                if content_list and len(content_list) > 0:
-                    # Проверяем формат сообщения для v2
-                    if isinstance(content_list[0], dict) and 'text' in content_list[0]:
-                        text_value = content_list[0].get('text', {}).get('value', 'No response')
-                        return {"content": text_value}
-                    # Формат может быть другим в v2
-                    elif isinstance(content_list[0], dict) and 'type' in content_list[0]:
-                        if content_list[0].get('type') == 'text':
-                            return {"content": content_list[0].get('text', {}).get('value', 'No response')}
-                    # Простой текстовый формат (может использоваться в v2)
-                    elif isinstance(content_list, list) and all(isinstance(item, str) for item in content_list):
-                        return {"content": ' '.join(content_list)}
-                    # Пробуем извлечь текст напрямую, если структура сложная
-                    else:
-                        try:
-                            return {"content": str(content_list)}
-                        except:
-                            return {"content": "Received response in unknown format"}
-                # Проверяем, есть ли текст напрямую в message
-                elif 'text' in message:
-                    return {"content": message.get('text')}
-                else:
-                    return {"content": "Received empty response from assistant"}
+                result = parse_assistant_message(message)
+                if result is None:
+                    continue
+                if message.get('id'):
+                    result['message_id'] = message['id']
+                return result
         
         return {"error": "No assistant messages found"}
     except Exception as e:
-        print(f"Ошибка при получении сообщений: {e}")
-        print(f"Ответ API: {response.text if 'response' in locals() else 'Нет ответа'}")
+        logger.warning("Ошибка при получении сообщений: %s", e, extra=fields(thread_id=thread_id))
+        if 'response' in locals():
+            logger.debug("Ответ API: %s", response.text)
         return {"error": f"Error getting thread messages: {str(e)}"}
+
+def list_thread_messages(thread_id, after=None, page_size=100):
+    """
+    Загружает сообщения треда в хронологическом порядке, начиная после сообщения after
+    Возвращает пару (сообщения, курсор); курсор передается в следующий вызов,
+    чтобы не скачивать уже полученные сообщения повторно
+    """
+    path = f"/threads/{thread_id}/messages"
+    messages = []
     
-def run_assistant(thread_id, prompt=None):
+    while True:
+        params = {"limit": page_size, "order": "asc"}
+        if after:
+            params["after"] = after
+        response = openai_client.get(path, params=params)
+        response.raise_for_status()
+        page = response.json()
+        
+        data = page.get('data', [])
+        messages.extend(data)
+        if data:
+            after = data[-1].get('id') or after
+        if not page.get('has_more') or not data:
+            return messages, after
+
+def sync_thread_history(user_id, session):
+    """
+    Догружает новые сообщения треда по сохраненному в сессии курсору
+    Возвращает общее количество сообщений в треде
+    """
+    thread_id = session.get('thread_id')
+    if not thread_id or 'fallback' in str(thread_id):
+        return 0
+    
+    # Курсор действителен только для того треда, в котором был получен
+    if session.get('history_thread_id') != thread_id:
+        session['history_thread_id'] = thread_id
+        session['history_cursor'] = None
+        session['history_count'] = 0
+    
+    messages, cursor = list_thread_messages(thread_id, after=session.get('history_cursor'))
+    session['history_cursor'] = cursor
+    session['history_count'] = session.get('history_count', 0) + len(messages)
+    session_store.put(user_id, session)
+    
+    logger.debug("История треда синхронизирована", extra=fields(thread_id=thread_id, new=len(messages)))
+    return session['history_count']
+
+def run_assistant(thread_id, prompt=None, on_delta=None, cancelled=None, messages=None):
     """
     Запускает ассистента и получает его ответ
     Если передан prompt, он будет использован как инструкция для ассистента
+    Если переданы messages, они добавляются в тред тем же запросом (additional_messages);
+    без thread_id тред с этими сообщениями создается вместе с запуском, и его id
+    возвращается в результате под ключом thread_id
+    Если передан on_delta, в потоковом режиме он получает фрагменты ответа по мере генерации
+    Если выставлено событие cancelled, запуск отменяется (см. inflight.py)
     """
     # Если id треда содержит 'fallback', используем локальное хранение
     if 'fallback' in str(thread_id):
-        print(f"Используем локальную обработку для треда {thread_id}")
+        logger.debug("Используем локальную обработку", extra=fields(thread_id=thread_id))
         return {"content": "I'm sorry, there seems to be an issue connecting to the language model. Please try restarting the conversation or try again later."}
     
-    url = f"https://api.openai.com/v1/threads/{thread_id}/runs"
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-        "OpenAI-Beta": "assistants=v2"
-    }
+    path = f"/threads/{thread_id}/runs" if thread_id else "/threads/runs"
+    new_thread = not thread_id
     
     # ID вашего ассистента OpenAI
     assistant_id = os.getenv('OPENAI_ASSISTANT_ID')
     
     # Проверка наличия assistant_id
     if not assistant_id:
-        print("ОШИБКА: OPENAI_ASSISTANT_ID не найден в .env файле")
+        logger.error("OPENAI_ASSISTANT_ID не найден в .env файле")
         return {"error": "Assistant ID is missing. Please check your .env file."}
     
     data = {
@@ -375,35 +887,173 @@ def run_assistant(thread_id, prompt=None):
     if prompt:
         data["instructions"] = prompt
     
+    # Сообщения пользователя уходят в том же запросе, что и запуск
+    if messages and thread_id:
+        data["additional_messages"] = messages
+    elif messages:
+        data["thread"] = {"messages": messages}
+    
+    # В потоковом режиме ответ приходит событиями сразу после завершения запуска
+    if OPENAI_RUN_MODE == 'stream':
+        with stage('run_stream'):
+            result = stream_run(thread_id, data, on_delta, cancelled)
+        if result is not None:
+            return result
+        logger.warning("Потоковый режим недоступен, запускаем ассистента в режиме опроса")
+    
     try:
-        # Отладка
-        print(f"Отправляем запрос на запуск ассистента с данными: {json.dumps(data, indent=2)}")
-        
         # Запускаем ассистента
-        response = requests.post(url, headers=headers, json=data)
+        with stage('run_create'):
+            response = openai_client.post(path, json=data)
+        if combined_run_rejected(response, data):
+            return combined_run_unsupported_result()
         response.raise_for_status()
         run_data = response.json()
         
-        # Отладка
-        print(f"Ответ на запуск ассистента: {json.dumps(run_data, indent=2)}")
-        
-        if 'id' not in run_data:
-            print(f"API не вернул ID для запуска: {run_data}")
+        thread_id = thread_id or run_data.get('thread_id')
+        if 'id' not in run_data or not thread_id:
+            logger.warning("API не вернул ID для запуска", extra=fields(thread_id=thread_id))
             return {"error": "Could not start assistant run. Please check your API credentials."}
             
         run_id = run_data.get('id')
+        bind_log_context(run_id=run_id)
+        logger.debug("Запуск создан", extra=fields(thread_id=thread_id, status=run_data.get('status')))
         
         # Ждем завершения выполнения
-        return wait_for_run_completion(thread_id, run_id)
+        result = wait_for_run_completion(thread_id, run_id, cancelled)
+        if new_thread:
+            result['thread_id'] = thread_id
+        return result
     except requests.exceptions.HTTPError as e:
-        print(f"HTTP ошибка: {e}")
-        print(f"Детали ответа: {response.text if 'response' in locals() else 'Нет ответа'}")
+        logger.warning("HTTP ошибка: %s", e, extra=fields(thread_id=thread_id))
+        if 'response' in locals():
+            logger.debug("Детали ответа: %s", response.text)
         return {"error": f"API error: {str(e)}"}
     except Exception as e:
-        print(f"Ошибка при запуске ассистента: {e}")
+        logger.error("Ошибка при запуске ассистента: %s", e, extra=fields(thread_id=thread_id))
         return {"error": f"Error running assistant: {str(e)}"}
 
+class AssistantsEngine:
+    """
+    Диалог через треды и запуски Assistants API (см. engines.py)
+    """
+    name = 'assistants'
+
+    def __init__(self, combined_runs=COMBINED_RUNS):
+        # Сбрасывается, если API отклонил запуск вместе с сообщениями
+        self.combined_runs = combined_runs
+
+    def current_conversation(self, user_id, session):
+        return session.get('thread_id')
+
+    def ensure_conversation(self, user_id, session):
+        # Новый тред создаст сам запуск, если пул пуст
+        return ensure_thread(user_id, session, defer=self.combined_runs)
+
+    def run(self, thread_id, session, content, on_delta=None, cancelled=None):
+        """
+        Добавляет сообщение в тред и запускает ассистента
+        Если thread_id не задан, тред создается для этого хода, а его id возвращается в результате
+        Сообщение (и новый тред) по возможности создаются тем же запросом, что и запуск
+        """
+        superseded = cancelled is not None and cancelled.is_set()
+        # Уже замененный ход не запускаем, но его сообщение должно попасть в тред отдельным запросом
+        if self.combined_runs and not superseded:
+            result = run_assistant(thread_id, on_delta=on_delta, cancelled=cancelled,
+                                   messages=[{"role": "user", "content": content}])
+            if not result.get('combined_unsupported'):
+                return result
+            self.combined_runs = False
+            logger.warning("API не поддерживает запуск вместе с сообщениями, переходим к отдельным запросам")
+        
+        new_thread = not thread_id
+        if new_thread:
+            thread_id = create_openai_thread().get('id')
+            if 'fallback' in str(thread_id):
+                return {"error": "Could not create a conversation thread. Please try again later."}
+        add_message_to_thread(thread_id, content)
+        # Сообщение остается в треде, и на него ответит запуск для нового сообщения
+        if cancelled is not None and cancelled.is_set():
+            result = superseded_result()
+        else:
+            result = run_assistant(thread_id, on_delta=on_delta, cancelled=cancelled)
+        if new_thread:
+            result['thread_id'] = thread_id
+        return result
+
+    def after_turn(self, session):
+        # Историю диалога хранит OpenAI
+        return False
+
+
+def create_conversation_engine(kind=CONVERSATION_ENGINE):
+    """
+    Создает движок диалога по настройке CONVERSATION_ENGINE
+    """
+    if kind == 'assistants':
+        return AssistantsEngine()
+    if kind == 'chat':
+        return ChatCompletionsEngine(openai_client)
+    raise ValueError(f"Неизвестный движок диалога: {kind}")
 
+# Движок диалога: Assistants API или Chat Completions с локальной историей
+conversation_engine = create_conversation_engine()
+
+def send_and_run(user_id, conversation_id, session, content, on_delta=None):
+    """
+    Передает сообщение движку диалога и получает ответ, удерживая аренду диалога
+    Пока аренда у другого запуска (например, в другом экземпляре бота), новый не начинается
+    Если пользователь успел написать снова, запуск отменяется и возвращается результат с признаком superseded
+    """
+    # Треда, который создаст сам запуск, еще нет, и занять его никто другой не может
+    lease = run_lock.hold(conversation_id) if conversation_id else nullcontext(True)
+    with inflight_runs.track(user_id) as run, lease as acquired:
+        if not acquired:
+            return {"error": "The previous request in this conversation is still running. Please try again in a moment."}
+        started = time.monotonic()
+        response = conversation_engine.run(conversation_id, session, content, on_delta=on_delta, cancelled=run.cancelled)
+        trace_note(engine=conversation_engine.name, mode=OPENAI_RUN_MODE, run=round(time.monotonic() - started, 4))
+    
+    # Тред создан вместе с запуском: запоминаем его в сессии
+    new_thread_id = response.pop('thread_id', None)
+    if new_thread_id and new_thread_id != session.get('thread_id'):
+        session['thread_id'] = new_thread_id
+        session.pop('thread_retry_at', None)
+        session_store.put(user_id, session)
+        thread_prewarmer.report(True)
+        bind_log_context(thread_id=new_thread_id)
+        logger.debug("Тред создан вместе с запуском", extra=fields(thread_id=new_thread_id))
+    return response
+
+@contextmanager
+def count_openai_calls(kind):
+    """
+    Учитывает в метрике, сколько запросов к OpenAI обработчик отправил за ход
+    """
+    calls_before = openai_client.thread_calls()
+    try:
+        yield
+    finally:
+        TURN_OPENAI_CALLS.observe(openai_client.thread_calls() - calls_before, kind=kind)
+
+def finish_reply(reply, response):
+    """
+    Показывает окончательный ответ ассистента (или ошибку) в постепенно заполняемом сообщении
+    Если ошибка вызвана сбоем OpenAI (выключатель не замкнут), показывается понятное сообщение
+    """
+    if 'error' in response and openai_breaker.current_state() != CLOSED:
+        trace_result('unavailable')
+        reply.finish(bot_config.current().texts['unavailable'])
+    elif 'error' in response:
+        trace_result('error')
+        reply.finish(f"Error: {response['error']}")
+    else:
+        reply.finish(response['content'])
+    
+    logger.info("Ответ передан в очередь отправки", extra=fields(
+        duration=time.monotonic() - reply.started_at, first_text_latency=reply.first_text_latency,
+        chars=len(reply.text), messages=len(reply.messages)
+    ))
 
 
 @bot.message_handler(commands=['start'])
@@ -411,22 +1061,22 @@ def start_command(message):
     """
     Обработчик команды /start
     """
+    config = bot_config.current()
     try:
         user_id = message.from_user.id
-        session = create_session(user_id)
+        reset_log_context(user_id=user_id)
+        create_session(user_id)
         
-        welcome_text = "👋 Welcome to English Practice Bot! Let's chat in English to improve your skills. What would you like to talk about today?"
-        bot.send_message(message.chat.id, welcome_text, reply_markup=create_keyboard())
+        outbox.send_message(message.chat.id, config.texts['welcome'], reply_markup=config.keyboard_json)
         
         # Проверка на ошибки с API ключами
-        if 'fallback' in str(session.get('thread_id', '')):
-            warning_text = "⚠️ Warning: Could not establish connection with OpenAI API. Please check your API keys in .env file."
-            bot.send_message(message.chat.id, warning_text)
+        if not thread_prewarmer.healthy:
+            outbox.send_message(message.chat.id, config.texts['api_warning'])
     except Exception as e:
         error_message = f"An error occurred while starting: {str(e)}"
-        print(error_message)
+        logger.error(error_message, exc_info=True)
         try:
-            bot.send_message(message.chat.id, "Something went wrong. Please try again later.")
+            outbox.send_message(message.chat.id, config.texts['error'])
         except:
             pass
 
@@ -437,84 +1087,160 @@ def debug_command(message):
     """
     try:
         user_id = message.from_user.id
+        reset_log_context(user_id=user_id)
         session = get_session(user_id)
-        thread_id = session.get('thread_id', 'Not set')
+        thread_id = session.get('thread_id') or 'Not created yet'
         
-        debug_info = f"Thread ID: {thread_id}\n"
+        debug_info = f"Engine: {conversation_engine.name}\n"
+        debug_info += f"Config version: {bot_config.current().version}\n"
+        debug_info += f"Thread ID: {thread_id}\n"
         debug_info += f"Messages count: {len(session.get('messages', []))}\n"
         
+        stats = update_dispatcher.stats()
+        debug_info += f"Workers busy: {stats['active']}/{stats['workers']}, queued updates: {stats['pending']}\n"
+        outbox_stats = outbox.stats()
+        debug_info += (f"Outbox: {outbox_stats['pending']} pending in {outbox_stats['chats']} chats, "
+                       f"{outbox_stats['merged']} edits merged, {outbox_stats['flood_waits']} flood waits\n")
+        
+        if shard_router.enabled:
+            debug_info += f"Shard: {shard_router.index} of {shard_router.count}, forwarded updates: {shard_router.forwarded}\n"
+        
+        coalescer_stats = coalescer.stats()
+        debug_info += f"Coalesced messages: {coalescer_stats['coalesced']} of {coalescer_stats['messages']}\n"
+        
+        inflight_stats = inflight_runs.stats()
+        debug_info += f"Superseded runs: {inflight_stats['superseded']} of {inflight_stats['started']}\n"
+        
+        breaker_stats = openai_breaker.stats()
+        debug_info += (f"OpenAI circuit: {breaker_stats['state']}, failures in a row: {breaker_stats['failures']}, "
+                       f"opened {breaker_stats['opened']} times, rejected calls: {breaker_stats['rejected']}\n")
+        
+        for limiter in (openai_limiter, telegram_limiter):
+            limit_stats = limiter.stats()
+            debug_info += (f"Rate limit {limiter.name}: {limit_stats['throttled']} of {limit_stats['requests']} calls waited, "
+                           f"avg {limit_stats['avg_wait']:.2f}s, current wait {limit_stats['delay']:.2f}s\n")
+        
+        cache_stats = explanation_cache.stats()
+        debug_info += f"Explanation cache: {cache_stats['size']} items, hit rate {cache_stats['hit_rate']:.0%}\n"
+        
+        for endpoint, counters in sorted(openai_client.stats().items()):
+            debug_info += f"{endpoint}: {counters['count']} calls, avg {counters['avg']:.2f}s, max {counters['max']:.2f}s\n"
+        
         # Если id треда содержит 'fallback', показываем другую информацию
-        if 'fallback' in str(thread_id):
+        if conversation_engine.name == 'chat':
+            debug_info += f"Earlier messages summarized: {'Yes' if session.get('summary') else 'No'}\n"
+        elif 'fallback' in str(thread_id):
             debug_info += "Using fallback thread (API connection issues)\n"
+        elif not session.get('thread_id'):
+            debug_info += "Thread will be created with the first message\n"
+            if conversation_engine.combined_runs:
+                debug_info += "Message, thread and run are created in a single request\n"
         else:
             # Пытаемся получить информацию о треде из API
             try:
-                url = f"https://api.openai.com/v1/threads/{thread_id}"
-                headers = {
-                    "Authorization": f"Bearer {OPENAI_API_KEY}",
-                    "OpenAI-Beta": "assistants=v2"
-                }
-                response = requests.get(url, headers=headers)
+                path = f"/threads/{thread_id}"
+                response = openai_client.get(path)
                 if response.status_code == 200:
                     thread_info = response.json()
                     debug_info += f"Thread exists in API: Yes\n"
                     debug_info += f"Thread creation time: {thread_info.get('created_at', 'Unknown')}\n"
+                    debug_info += f"Messages in thread: {sync_thread_history(user_id, session)}\n"
                 else:
                     debug_info += f"Thread exists in API: No (Status code: {response.status_code})\n"
                     debug_info += f"API response: {response.text}\n"
             except Exception as e:
                 debug_info += f"Error getting thread info: {str(e)}\n"
         
-        bot.send_message(message.chat.id, debug_info, reply_markup=create_keyboard())
+        outbox.send_message(message.chat.id, debug_info, reply_markup=create_keyboard())
     except Exception as e:
-        bot.send_message(message.chat.id, f"Debug error: {str(e)}", reply_markup=create_keyboard())
+        outbox.send_message(message.chat.id, f"Debug error: {str(e)}", reply_markup=create_keyboard())
+
+def restart_conversation(call, user_id, button, config):
+    """
+    Кнопка рестарта диалога
+    """
+    create_session(user_id)
+    outbox.send_message(call.message.chat.id, config.texts['restarted'], reply_markup=config.keyboard_json)
+    
+    # Проверка на ошибки с API ключами
+    if not thread_prewarmer.healthy:
+        outbox.send_message(call.message.chat.id, config.texts['api_warning'])
+
+def explain_last_message(call, user_id, button, config):
+    """
+    Кнопка объяснения последнего сообщения с промптом кнопки
+    """
+    session = get_session(user_id)
+    
+    if not session.get('messages'):
+        outbox.send_message(call.message.chat.id, config.texts['no_messages'], reply_markup=config.keyboard_json)
+        return
+    
+    # Во время сбоя OpenAI отвечаем сразу, не занимая обработчик
+    if not openai_breaker.available():
+        outbox.send_message(call.message.chat.id, config.texts['unavailable'], reply_markup=config.keyboard_json)
+        return
+    
+    # Объяснения длинные, поэтому показываем их по мере генерации
+    reply = ProgressiveReply(outbox, call.message.chat.id, reply_markup=config.keyboard_json)
+    thread_id = conversation_engine.current_conversation(user_id, session)
+    bind_log_context(thread_id=thread_id)
+    prompt = config.prompts[button['prompt']]
+    
+    def explain():
+        reply.start()
+        
+        # Добавляем запрос на объяснение с промптом для бота и запускаем ассистента
+        with outbox.typing(call.message.chat.id):
+            return send_and_run(user_id, thread_id, session, prompt, on_delta=reply.feed)
+    
+    # Пока диалог не продолжился, повторное нажатие возвращает готовое объяснение
+    cache_key = (thread_id, session.get('last_message_id') or len(session['messages']), prompt)
+    with trace_recorder.turn('explain', user_id, chars=len(prompt)), TURN_SECONDS.time(kind='explain'), \
+            turn_profiler.watch('explain'), count_openai_calls('explain'):
+        response, source = explanation_cache.get_or_compute(
+            cache_key, explain, cacheable=lambda response: 'message_id' in response
+        )
+        if source != 'miss':
+            trace_result('cached')
+            logger.info("Объяснение взято из кэша", extra=fields(thread_id=thread_id, source=source))
+        if response.get('superseded'):
+            trace_result('superseded')
+            reply.discard()
+        else:
+            finish_reply(reply, response)
+
+# Обработчики действий кнопок (config.CALLBACK_ACTIONS); кнопка выбирает действие по своему callback_data
+CALLBACK_HANDLERS = {
+    'start': restart_conversation,
+    'desc': explain_last_message,
+}
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
     """
     Обработчик нажатий на кнопки клавиатуры
     """
+    config = bot_config.current()
     try:
         user_id = call.from_user.id
+        reset_log_context(user_id=user_id)
         
-        if call.data == 'start':
-            # Рестарт диалога
-            session = create_session(user_id)
-            bot.send_message(call.message.chat.id, "Conversation has been restarted! Let's practice your English.", reply_markup=create_keyboard())
-            
-            # Проверка на ошибки с API ключами
-            if 'fallback' in str(session.get('thread_id', '')):
-                warning_text = "⚠️ Warning: Could not establish connection with OpenAI API. Please check your API keys in .env file."
-                bot.send_message(call.message.chat.id, warning_text)
-        
-        elif call.data == 'desc':
-            # Объяснение последнего сообщения
-            session = get_session(user_id)
-            
-            if not session.get('messages'):
-                bot.send_message(call.message.chat.id, "There are no messages to explain yet.", reply_markup=create_keyboard())
-                return
-            
-            # Добавляем запрос на объяснение с промптом для бота
-            thread_id = session['thread_id']
-            add_message_to_thread(thread_id, PROMPTS['desc'])
-            
-            # Запускаем ассистента с инструкцией объяснить сообщение
-            response = run_assistant(thread_id)
-            
-            if 'error' in response:
-                bot.send_message(call.message.chat.id, f"Error: {response['error']}", reply_markup=create_keyboard())
-            else:
-                bot.send_message(call.message.chat.id, response['content'], reply_markup=create_keyboard())
+        button = config.button(call.data)
+        if button is None:
+            # Кнопка из сообщения, отправленного с прежней версией конфигурации
+            logger.info("Нажата неизвестная кнопка", extra=fields(callback_data=call.data))
+        else:
+            CALLBACK_HANDLERS[button['action']](call, user_id, button, config)
         
         # Убираем "загрузку" с кнопки
         bot.answer_callback_query(call.id)
     except Exception as e:
         error_message = f"An error occurred in callback: {str(e)}"
-        print(error_message)
+        logger.error(error_message, exc_info=True)
         try:
             bot.answer_callback_query(call.id)
-            bot.send_message(call.message.chat.id, "Something went wrong. Please try again later.")
+            outbox.send_message(call.message.chat.id, config.texts['error'])
         except:
             pass
 
@@ -523,58 +1249,121 @@ def handle_message(message):
     """
     Обработчик всех текстовых сообщений
     """
+    config = bot_config.current()
     try:
         user_id = message.from_user.id
-        user_message = message.text
-        
-        # Получаем или создаем сессию пользователя
-        session = get_session(user_id)
-        thread_id = session['thread_id']
+        reset_log_context(user_id=user_id)
         
-        # Проверка на проблемы с API
-        if 'fallback' in str(thread_id):
-            bot.send_message(message.chat.id, "Sorry, I'm having trouble connecting to the language model. Please check your API keys or try again later.", reply_markup=create_keyboard())
+        # Сообщения, отправленные подряд, получают один общий ответ
+        batch = coalescer.take(user_id, message)
+        if batch is None:
+            logger.debug("Сообщение вошло в ход, начатый более ранним сообщением")
             return
-            
-        # Добавляем сообщение в историю
-        session['messages'].append({"role": "user", "content": user_message})
-        
-        # Отправляем "печатает..." статус
-        bot.send_chat_action(message.chat.id, 'typing')
+        if len(batch) > 1:
+            logger.info("Сообщения объединены в один ход", extra=fields(messages=len(batch)))
+        user_message = '\n'.join(item.text for item in batch)
         
-        # Отправляем сообщение в OpenAI API
-        add_message_to_thread(thread_id, user_message)
-        
-        # Запускаем ассистента
-        response = run_assistant(thread_id)
-        
-        if 'error' in response:
-            bot.send_message(message.chat.id, f"Error: {response['error']}", reply_markup=create_keyboard())
-        else:
-            # Добавляем ответ в историю
-            assistant_message = response['content']
-            session['messages'].append({"role": "assistant", "content": assistant_message})
+        # Замеряем ход целиком, от получения сообщений до ответа
+        with trace_recorder.turn('message', user_id, chars=len(user_message), parts=len(batch)), \
+                TURN_SECONDS.time(kind='message'), turn_profiler.watch('message'), count_openai_calls('message'):
+            # Получаем или создаем сессию пользователя
+            session = get_session(user_id)
+            
+            # Во время сбоя OpenAI отвечаем сразу, не создавая временный тред и не ожидая таймаутов
+            if not openai_breaker.available():
+                trace_result('unavailable')
+                outbox.send_message(message.chat.id, config.texts['unavailable'], reply_markup=config.keyboard_json)
+                return
+            
+            thread_id = conversation_engine.ensure_conversation(user_id, session)
+            bind_log_context(thread_id=thread_id)
+            
+            # Проверка на проблемы с API
+            if 'fallback' in str(thread_id):
+                trace_result('unavailable')
+                outbox.send_message(message.chat.id, config.texts['unavailable'], reply_markup=config.keyboard_json)
+                return
+            
+            # Добавляем сообщение в историю
+            add_to_history(user_id, session, "user", user_message)
             
-            # Отправляем ответ пользователю
-            bot.send_message(message.chat.id, assistant_message, reply_markup=create_keyboard())
+            # Статус "печатает..." обновляется, пока идет запуск; заглушка заполняется ответом
+            with outbox.typing(message.chat.id):
+                reply = ProgressiveReply(outbox, message.chat.id, reply_markup=config.keyboard_json)
+                reply.start()
+                
+                # Отправляем сообщение в OpenAI API и запускаем ассистента,
+                # текст ответа появляется у пользователя по мере генерации
+                response = send_and_run(user_id, thread_id, session, user_message, on_delta=reply.feed)
+            if response.get('superseded'):
+                # Пользователь уже написал снова: устаревший ответ не показываем
+                trace_result('superseded')
+                reply.discard()
+                return
+            finish_reply(reply, response)
+            
+            if 'error' not in response:
+                # Запоминаем последнее сообщение треда (ключ кэша объяснений) и добавляем ответ в историю
+                session['last_message_id'] = response.get('message_id')
+                add_to_history(user_id, session, "assistant", response['content'])
+                
+                # Движок с локальной историей сворачивает старые сообщения уже после ответа
+                if conversation_engine.after_turn(session):
+                    session_store.put(user_id, session)
     except Exception as e:
         error_message = f"An error occurred while processing message: {str(e)}"
-        print(error_message)
+        logger.error(error_message, exc_info=True)
         try:
-            bot.send_message(message.chat.id, "Something went wrong. Please try again later.")
+            outbox.send_message(message.chat.id, config.texts['error'])
         except:
             pass
 
 
+def drain_updates(timeout):
+    """
+    Ждет обработки принятых обновлений и отправки ответов на них, всего не дольше timeout секунд
+    Обработчики только ставят сообщения в очередь отправки, поэтому ждать нужно и ее
+    """
+    deadline = time.monotonic() + timeout
+    if not update_dispatcher.join(timeout):
+        return False
+    return outbox.wait_idle(timeout=max(0.0, deadline - time.monotonic()))
+
+
 if __name__ == '__main__':
-    print("Checking API keys...")
-    if check_api_keys():
-        print("API keys validated successfully!")
-        print("Bot started...")
+    if FAST_START:
+        # Ключи проверяются в фоне, бот начинает принимать обновления сразу
+        keys_ok = check_required_keys()
+    else:
+        logger.info("Checking API keys...")
+        keys_ok = check_api_keys()
+        if keys_ok:
+            logger.info("API keys validated successfully!")
+    if keys_ok:
+        logger.info("Bot started...")
+        if FAST_START:
+            check_api_keys_in_background()
+        if conversation_engine.name == 'assistants':
+            thread_prewarmer.start()
+        start_metrics_server()
         try:
-            bot.polling(none_stop=True)
+            if BOT_MODE == 'webhook':
+                if WEBHOOK_URL:
+                    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+                run_webhook(accept_webhook_update, drain=drain_updates)
+            else:
+                bot.polling(none_stop=True)
+                # Смещение getUpdates уже сдвинуто: принятые обновления Telegram повторно не пришлет
+                if not drain_updates(WEBHOOK_DRAIN_TIMEOUT):
+                    logger.warning("Не все принятые обновления обработаны до остановки")
         except Exception as e:
-            print(f"Критическая ошибка при запуске бота: {e}")
+            logger.critical("Критическая ошибка при запуске бота: %s", e, exc_info=True)
+        finally:
+            thread_prewarmer.stop()
+            update_dispatcher.shutdown(wait=True, timeout=WEBHOOK_DRAIN_TIMEOUT)
+            outbox.shutdown(timeout=WEBHOOK_DRAIN_TIMEOUT)
+        if api_keys_rejected.is_set():
+            raise SystemExit(1)
     else:
-        print("Невозможно запустить бота из-за проблем с API ключами.")
-        print("Пожалуйста, проверьте ваш файл .env и убедитесь, что все ключи указаны корректно.")
\ No newline at end of file
+        logger.error("Невозможно запустить бота из-за проблем с API ключами.")
+        logger.error("Пожалуйста, проверьте ваш файл .env и убедитесь, что все ключи указаны корректно.")
\ No newline at end of file
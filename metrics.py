@@ -0,0 +1,354 @@
+"""
+Метрики бота в формате Prometheus
+
+Счетчики, измерители и гистограммы хранятся в памяти процесса и отдаются
+текстом в формате Prometheus (text exposition 0.0.4) с отдельного HTTP
+сервера на METRICS_PORT. Гистограмма bot_stage_seconds показывает, на
+какие этапы уходит время хода: добавление сообщения в тред, создание
+запуска, каждый опрос статуса, получение ответа и отправку в Telegram.
+
+Для медленных ходов есть выборочный профилировщик: если задан
+PROFILE_SLOW_TURN, стеки потоков, обрабатывающих ходы, снимаются каждые
+PROFILE_INTERVAL секунд, и для хода дольше порога в лог пишутся самые
+частые стеки. Быстрые ходы ничего не пишут.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bot_logging import fields
+
+logger = logging.getLogger(__name__)
+
+# Порт HTTP сервера метрик (0 — не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+
+# Ход дольше этого порога, секунды, профилируется (0 — профилировщик выключен)
+PROFILE_SLOW_TURN = float(os.getenv('PROFILE_SLOW_TURN', '0'))
+
+# Интервал снятия стеков профилировщиком, секунды
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))
+
+# Сколько самых частых стеков медленного хода писать в лог и сколько внутренних вызовов в каждом
+PROFILE_TOP_STACKS = 5
+PROFILE_STACK_DEPTH = 12
+
+# Границы корзин гистограмм длительности, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Общая часть метрик: имя, описание и значения по наборам меток
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, переданы {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        if not items and not self.labelnames:
+            items = [((), 0)]
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}" for key, value in items]
+
+
+class Counter(Metric):
+    """
+    Счетчик, который только растет
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    Измеритель текущего значения; значение можно считать функцией при каждом запросе метрик
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.debug("Не удалось вычислить метрику %s: %s", self.name, e)
+            return []
+        # Для метрики с метками функция возвращает словарь {значения меток: значение}
+        if self.labelnames:
+            return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(item)}"
+                    for key, item in sorted(value.items())]
+        return [f"{self.name} {format_value(value)}"]
+
+
+class Histogram(Metric):
+    """
+    Гистограмма: количество наблюдений по корзинам, их сумма и число
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][index] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Замеряет длительность блока with, в том числе завершившегося исключением
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, dict(state, buckets=list(state['buckets']))) for key, state in self.values.items())
+        lines = []
+        for key, state in items:
+            # В формате Prometheus корзины накопительные
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['buckets']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+
+class Registry:
+    """
+    Набор метрик процесса
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """
+        Возвращает все метрики текстом в формате Prometheus
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Этапы хода: add_message, run_create, run_poll, run_stream, get_messages, telegram_send, telegram_edit
+STAGE_SECONDS = registry.histogram('bot_stage_seconds', "Длительность этапов обработки хода", ('stage',))
+TURN_SECONDS = registry.histogram('bot_turn_seconds', "Длительность хода от получения сообщения до ответа", ('kind',))
+TURN_OPENAI_CALLS = registry.histogram('bot_turn_openai_calls', "Запросы к OpenAI за ход, включая повторы", ('kind',),
+                                       buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20))
+RUN_POLLS = registry.counter('bot_run_polls_total', "Запросы статуса запуска в режиме опроса")
+FALLBACK_THREADS = registry.counter('bot_fallback_threads_total', "Сессии, получившие временный fallback-тред")
+API_ERRORS = registry.counter('bot_api_errors_total', "Ошибки внешних API по коду ответа", ('api', 'status'))
+SLOW_TURNS = registry.counter('bot_slow_turns_total', "Ходы дольше порога профилировщика")
+OUTBOX_WAIT = registry.histogram('bot_outbox_wait_seconds', "Время от постановки операции в очередь отправки Telegram до ее выполнения", ('method',))
+RATE_LIMIT_WAIT = registry.histogram('bot_rate_limit_wait_seconds', "Ожидание очереди в ограничителе частоты запросов", ('api',))
+CIRCUIT_OPENED = registry.counter('bot_circuit_opened_total', "Размыкания выключателя из-за сбоев API", ('api',))
+CIRCUIT_REJECTED = registry.counter('bot_circuit_rejected_total', "Запросы, отклоненные разомкнутым выключателем", ('api',))
+
+
+def stage(name):
+    """
+    Замеряет этап хода: with stage('add_message'): ...
+    """
+    return STAGE_SECONDS.time(stage=name)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/healthz':
+            body, status, content_type = b'ok', 200, 'text/plain'
+        elif path == '/metrics':
+            body, status, content_type = self.registry.render().encode('utf-8'), 200, CONTENT_TYPE
+        else:
+            body, status, content_type = b'Not Found', 404, 'text/plain'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Запускает HTTP сервер метрик в фоновом потоке, возвращает сервер или None, если порт не задан
+    """
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info("Метрики доступны по HTTP", extra=fields(port=server.server_address[1], path='/metrics'))
+    return server
+
+
+class SlowTurnProfiler:
+    """
+    Выборочный профилировщик ходов: снимает стеки потоков-обработчиков и пишет в лог стеки медленных ходов
+    """
+
+    def __init__(self, threshold=PROFILE_SLOW_TURN, interval=PROFILE_INTERVAL, top=PROFILE_TOP_STACKS):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.sampler = None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    @contextmanager
+    def watch(self, kind):
+        """
+        Профилирует текущий поток на время блока with и пишет стеки, если блок длился дольше порога
+        """
+        if not self.enabled:
+            yield
+            return
+
+        ident = threading.get_ident()
+        samples = StackCounter()
+        with self.lock:
+            self.watched[ident] = samples
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample_loop, name='turn-profiler', daemon=True)
+                self.sampler.start()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            with self.lock:
+                self.watched.pop(ident, None)
+                samples = StackCounter(samples)
+            if duration >= self.threshold:
+                self.report(kind, duration, samples)
+
+    def report(self, kind, duration, samples):
+        SLOW_TURNS.inc()
+        total = sum(samples.values())
+        stacks = '\n'.join(
+            f"  {count / total:.0%} ({count}): {stack}" for stack, count in samples.most_common(self.top)
+        ) if total else "  (нет выборок)"
+        logger.warning("Медленный ход, самые частые стеки:\n%s", stacks,
+                       extra=fields(kind=kind, duration=duration, samples=total))
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, samples in self.watched.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[self._stack(frame)] += 1
+
+    @staticmethod
+    def _stack(frame):
+        # Свернутый стек от внешнего вызова к внутреннему, как во входных данных flamegraph
+        parts = []
+        while frame is not None and len(parts) < PROFILE_STACK_DEPTH:
+            code = frame.f_code
+            parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ';'.join(reversed(parts))
@@ -0,0 +1,237 @@
+"""
+Общий HTTP клиент для OpenAI API
+
+Все запросы к OpenAI идут через одну сессию requests с пулом keep-alive
+соединений, поэтому TCP и TLS рукопожатия не повторяются на каждом вызове.
+Клиент задает таймауты, повторяет запросы при 429 и 5xx с экспоненциальной
+задержкой со случайным разбросом и считает задержки по каждому эндпоинту.
+Если передан ограничитель из rate_limit.py, запросы ждут в нем своей очереди,
+а если передан выключатель из circuit_breaker.py, во время сбоя OpenAI
+запросы сразу завершаются ошибкой CircuitOpenError.
+"""
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import API_ERRORS
+from tracing import body_size, current_trace
+
+logger = logging.getLogger(__name__)
+
+# Таймауты установки соединения и ожидания данных, секунды
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', '60'))
+
+# Количество повторов при 429, 5xx и ошибках соединения
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '3'))
+
+# Размер пула соединений (не меньше числа потоков-обработчиков)
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', '16'))
+
+# Начальная и максимальная задержка между повторами, секунды
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def endpoint_name(method, path):
+    """
+    Приводит путь запроса к шаблону эндпоинта: GET /threads/{id}/runs/{id}
+    """
+    path = path.split('?', 1)[0]
+    return f"{method} {re.sub(r'/[a-z]+_[A-Za-z0-9]+', '/{id}', path)}"
+
+
+def iter_sse_events(lines):
+    """
+    Разбирает поток server-sent events и возвращает пары (event, data)
+    """
+    event_name = None
+    data_lines = []
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r')
+
+        # Пустая строка завершает событие
+        if not line:
+            if data_lines:
+                yield event_name or 'message', '\n'.join(data_lines)
+            event_name = None
+            data_lines = []
+            continue
+
+        # Строки-комментарии используются сервером для keep-alive
+        if line.startswith(':'):
+            continue
+
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+
+        if field == 'event':
+            event_name = value
+        elif field == 'data':
+            data_lines.append(value)
+
+    if data_lines:
+        yield event_name or 'message', '\n'.join(data_lines)
+
+
+class OpenAIClient:
+    """
+    Клиент OpenAI API с пулом соединений, таймаутами, повторами и счетчиками задержек
+    """
+
+    def __init__(self, api_key, base_url, connect_timeout=OPENAI_CONNECT_TIMEOUT,
+                 read_timeout=OPENAI_READ_TIMEOUT, max_retries=OPENAI_MAX_RETRIES,
+                 pool_size=OPENAI_POOL_SIZE, limiter=None, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.limiter = limiter
+        self.breaker = breaker
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "OpenAI-Beta": "assistants=v2"
+        })
+
+        self.lock = threading.Lock()
+        self.latency = {}
+        # Счетчик отправленных запросов в каждом потоке, чтобы считать запросы за ход
+        self.local = threading.local()
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def request(self, method, path, **kwargs):
+        """
+        Выполняет запрос к OpenAI API и возвращает объект requests.Response
+        Ответы 429 и 5xx повторяются до max_retries раз, после чего возвращается последний ответ
+        Если выключатель разомкнут, запрос (или очередной повтор) не отправляется: выбрасывается CircuitOpenError
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        url = f"{self.base_url}{path}"
+        endpoint = endpoint_name(method, path)
+        attempt = 0
+        # Трасса хода (TRACE_PATH): без нее размеры тел не считаются
+        trace = current_trace()
+
+        while True:
+            if self.breaker is not None:
+                self.breaker.before_call()
+            # Ожидание очереди в ограничителе не входит в задержку эндпоинта
+            if self.limiter is not None:
+                self.limiter.acquire(endpoint)
+            self.local.calls = getattr(self.local, 'calls', 0) + 1
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                duration = time.monotonic() - started
+                status = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection'
+                self.record(endpoint, duration, error=True)
+                if self.breaker is not None:
+                    self.breaker.record(False, duration)
+                API_ERRORS.inc(api='openai', status=status)
+                if trace is not None:
+                    trace.call('openai', endpoint, started, duration, status, body_size(kwargs.get('json')))
+                # Повторять чтение после таймаута безопасно только для GET
+                retriable = method == 'GET' or not isinstance(e, requests.exceptions.ReadTimeout)
+                if not retriable or attempt >= self.max_retries:
+                    raise
+                self.sleep_before_retry(attempt)
+                attempt += 1
+                continue
+            except BaseException:
+                # Обрыв или ошибка декодирования тела тоже неудача: иначе пробный запрос
+                # полуоткрытого выключателя не вернет свое место и выключатель не замкнется
+                duration = time.monotonic() - started
+                self.record(endpoint, duration, error=True)
+                if self.breaker is not None:
+                    self.breaker.record(False, duration)
+                API_ERRORS.inc(api='openai', status='error')
+                if trace is not None:
+                    trace.call('openai', endpoint, started, duration, 'error', body_size(kwargs.get('json')))
+                raise
+
+            duration = time.monotonic() - started
+            self.record(endpoint, duration, error=response.status_code >= 400)
+            if self.breaker is not None:
+                # 4xx (в том числе 429) — ответ работающего API, сбоем считаются только 5xx
+                self.breaker.record(response.status_code < 500, duration)
+            if response.status_code >= 400:
+                API_ERRORS.inc(api='openai', status=response.status_code)
+            if trace is not None:
+                # Потоковый ответ еще не прочитан, его размер неизвестен
+                trace.call('openai', endpoint, started, duration, response.status_code, body_size(kwargs.get('json')),
+                           None if kwargs.get('stream') else len(response.content))
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                return response
+
+            logger.warning("OpenAI вернул %s для %s, повтор %s из %s", response.status_code, endpoint, attempt + 1, self.max_retries)
+            retry_after = response.headers.get('Retry-After')
+            response.close()
+            if response.status_code == 429 and self.limiter is not None:
+                # Остальные потоки тоже подождут, вместо того чтобы получить такой же 429
+                try:
+                    self.limiter.pause(float(retry_after), endpoint)
+                except (TypeError, ValueError):
+                    pass
+            self.sleep_before_retry(attempt, retry_after)
+            attempt += 1
+
+    def thread_calls(self):
+        """
+        Число запросов (с повторами), отправленных из текущего потока
+        """
+        return getattr(self.local, 'calls', 0)
+
+    def sleep_before_retry(self, attempt, retry_after=None):
+        """
+        Ждет перед повтором: экспоненциальная задержка со случайным разбросом (full jitter)
+        """
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        time.sleep(delay)
+
+    def record(self, endpoint, duration, error=False):
+        """
+        Учитывает длительность запроса в счетчиках эндпоинта
+        """
+        with self.lock:
+            counters = self.latency.setdefault(endpoint, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            counters['count'] += 1
+            counters['errors'] += error
+            counters['total'] += duration
+            counters['max'] = max(counters['max'], duration)
+
+    def stats(self):
+        """
+        Возвращает количество запросов, ошибок, среднюю и максимальную задержку по эндпоинтам
+        """
+        with self.lock:
+            return {
+                endpoint: dict(counters, avg=counters['total'] / counters['count'])
+                for endpoint, counters in self.latency.items()
+            }
@@ -0,0 +1,347 @@
+"""
+Очередь исходящих сообщений Telegram
+
+Обработчики не ждут ответов Telegram: отправки, правки, удаления и статус
+«печатает...» ставятся в очередь своего чата и выполняются пулом потоков.
+Операции одного чата выполняются строго по порядку, разных чатов —
+параллельно. Пока операция ждет своей очереди, следующая правка того же
+сообщения не добавляется, а заменяет ее текст, поэтому при медленном
+Telegram в очереди не копятся устаревшие промежуточные версии ответа.
+Ответ 429 приостанавливает очередь чата на retry_after секунд, не занимая
+поток пула, а текст длиннее лимита Telegram делится на несколько сообщений.
+
+Пока идет запуск ассистента, фоновый поток раз в TYPING_INTERVAL секунд
+обновляет статус «печатает...», который Telegram показывает около 5 секунд.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+from delivery import split_message
+from metrics import API_ERRORS, OUTBOX_WAIT, stage
+from tracing import hold_trace
+
+logger = logging.getLogger(__name__)
+
+# Количество потоков, отправляющих сообщения в Telegram
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+
+# Сколько раз повторять операцию после 429 или ошибки соединения
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '5'))
+
+# Как часто обновлять статус «печатает...» во время запуска, секунды (0 — отправлять один раз)
+TYPING_INTERVAL = float(os.getenv('TYPING_INTERVAL', '4'))
+
+# Задержка перед повтором после ошибки соединения, секунды
+RETRY_DELAY = 1.0
+
+
+class OutboundMessage:
+    """
+    Сообщение, поставленное в очередь отправки
+    message_id становится известен после доставки; правки и удаление,
+    поставленные раньше, выполняются уже с ним, потому что очередь чата упорядочена
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.message_id = None
+        self.failed = False
+
+
+class OutboundOperation:
+    """
+    Операция очереди: send, edit, delete или action
+    """
+
+    def __init__(self, kind, message=None, chat_id=None, text=None, reply_markup=None, action=None):
+        self.kind = kind
+        self.message = message
+        self.chat_id = message.chat_id if message is not None else chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.action = action
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+        # Поля логов и трасса хода обработчика, поставившего операцию
+        self.context = contextvars.copy_context()
+        self.trace = hold_trace()
+
+    def done(self):
+        # Трасса хода записывается, когда выполнены все его операции
+        if self.trace is not None:
+            self.trace.release()
+            self.trace = None
+
+
+class TelegramOutbox:
+    """
+    Очереди исходящих операций по чатам с общим пулом потоков
+    """
+
+    def __init__(self, bot, workers=OUTBOX_WORKERS, max_retries=OUTBOX_MAX_RETRIES, typing_interval=TYPING_INTERVAL):
+        self.bot = bot
+        self.max_retries = max_retries
+        self.typing_interval = typing_interval
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='outbox')
+        self.condition = threading.Condition()
+        # chat_id -> очередь операций; чат есть в словаре, пока его очередь выполняется или ждет
+        self.queues = {}
+        # chat_id -> число активных блоков typing()
+        self.typing_chats = {}
+        self.keepalive = None
+        self.stopped = threading.Event()
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        self.flood_waits = 0
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        """
+        Ставит сообщение в очередь и возвращает OutboundMessage
+        Длинный текст делится на несколько сообщений, клавиатура добавляется к последнему
+        """
+        parts = split_message(text)
+        with self.condition:
+            for index, part in enumerate(parts):
+                message = OutboundMessage(chat_id)
+                markup = reply_markup if index == len(parts) - 1 else None
+                self._enqueue(OutboundOperation('send', message, text=part, reply_markup=markup))
+        return message
+
+    def edit_message_text(self, message, text, reply_markup=None):
+        """
+        Ставит в очередь правку сообщения
+        Если предыдущая правка (или сама отправка) еще ждет в очереди, она получает новый текст
+        """
+        with self.condition:
+            pending = next((op for op in reversed(self.queues.get(message.chat_id, ()))
+                            if op.message is message and op.kind in ('send', 'edit')), None)
+            if pending is not None and pending is not self._running(message.chat_id):
+                pending.text = text
+                if reply_markup is not None:
+                    pending.reply_markup = reply_markup
+                self.merged += 1
+                return
+            self._enqueue(OutboundOperation('edit', message, text=text, reply_markup=reply_markup))
+
+    def delete_message(self, message):
+        """
+        Ставит в очередь удаление сообщения; еще не отправленное сообщение просто убирается из очереди
+        """
+        with self.condition:
+            queue = self.queues.get(message.chat_id)
+            running = self._running(message.chat_id)
+            if queue and any(op.message is message and op.kind == 'send' and op is not running for op in queue):
+                for operation in [op for op in queue if op.message is message and op is not running]:
+                    queue.remove(operation)
+                    operation.done()
+                self.merged += 1
+                return
+            self._enqueue(OutboundOperation('delete', message))
+
+    def send_chat_action(self, chat_id, action='typing'):
+        """
+        Ставит в очередь статус чата, если такой же статус еще не ждет отправки
+        """
+        with self.condition:
+            running = self._running(chat_id)
+            if any(op.kind == 'action' and op.action == action and op is not running
+                   for op in self.queues.get(chat_id, ())):
+                return
+            self._enqueue(OutboundOperation('action', chat_id=chat_id, action=action))
+
+    @contextmanager
+    def typing(self, chat_id):
+        """
+        Показывает статус «печатает...» на время блока with, обновляя его в фоне
+        """
+        self.send_chat_action(chat_id, 'typing')
+        with self.condition:
+            self.typing_chats[chat_id] = self.typing_chats.get(chat_id, 0) + 1
+            if self.keepalive is None and self.typing_interval > 0:
+                self.keepalive = threading.Thread(target=self._keepalive_loop, name='outbox-typing', daemon=True)
+                self.keepalive.start()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.typing_chats[chat_id] -= 1
+                if not self.typing_chats[chat_id]:
+                    del self.typing_chats[chat_id]
+                    # Ответ готов: статус, еще не отправленный, больше не нужен
+                    queue = self.queues.get(chat_id)
+                    running = self._running(chat_id)
+                    for operation in [op for op in queue or () if op.kind == 'action' and op is not running]:
+                        queue.remove(operation)
+                        operation.done()
+
+    def _keepalive_loop(self):
+        while not self.stopped.wait(self.typing_interval):
+            with self.condition:
+                chats = list(self.typing_chats)
+            for chat_id in chats:
+                self.send_chat_action(chat_id, 'typing')
+
+    def _running(self, chat_id):
+        # Первая операция очереди уже выполняется (или ждет повтора), ее менять нельзя
+        queue = self.queues.get(chat_id)
+        return queue[0] if queue else None
+
+    def _enqueue(self, operation):
+        # Вызывается под self.condition
+        queue = self.queues.get(operation.chat_id)
+        if queue is None:
+            queue = self.queues[operation.chat_id] = deque()
+            queue.append(operation)
+            self._schedule(operation.chat_id)
+            return
+        queue.append(operation)
+
+    def _schedule(self, chat_id):
+        """
+        Передает следующую операцию очереди чата пулу потоков
+        Если пул уже остановлен, оставшиеся операции чата отбрасываются с предупреждением
+        """
+        try:
+            self.executor.submit(self._run_next, chat_id)
+        except RuntimeError:
+            with self.condition:
+                dropped = self.queues.pop(chat_id, ())
+                for operation in dropped:
+                    operation.done()
+                self.failed += len(dropped)
+                self.condition.notify_all()
+            logger.warning("Очередь отправки остановлена, операций чата %s не выполнено: %s", chat_id, len(dropped))
+
+    def _run_next(self, chat_id):
+        """
+        Выполняет первую операцию очереди чата и планирует следующую
+        """
+        with self.condition:
+            operation = self.queues[chat_id][0]
+        retry_after = operation.context.run(self._execute, operation)
+        if retry_after is None:
+            operation.done()
+
+        with self.condition:
+            queue = self.queues[chat_id]
+            if retry_after is None:
+                queue.popleft()
+                if not queue:
+                    del self.queues[chat_id]
+                    self.condition.notify_all()
+                    return
+        if retry_after:
+            # Очередь чата ждет, не занимая поток пула
+            timer = threading.Timer(retry_after, self._schedule, (chat_id,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._schedule(chat_id)
+
+    def _execute(self, operation):
+        """
+        Выполняет операцию; возвращает None, если она завершена, или задержку перед повтором
+        """
+        message = operation.message
+        if operation.kind in ('edit', 'delete') and (message.message_id is None or message.failed):
+            # Сообщение так и не было отправлено
+            return None
+        method = operation.kind if operation.kind != 'action' else 'send_chat_action'
+        try:
+            if operation.kind == 'send':
+                with stage('telegram_send'):
+                    sent = self.bot.send_message(operation.chat_id, operation.text, reply_markup=operation.reply_markup)
+                message.message_id = sent.message_id
+            elif operation.kind == 'edit':
+                with stage('telegram_edit'):
+                    self.bot.edit_message_text(operation.text, operation.chat_id, message.message_id,
+                                               reply_markup=operation.reply_markup)
+            elif operation.kind == 'delete':
+                self.bot.delete_message(operation.chat_id, message.message_id)
+            else:
+                self.bot.send_chat_action(operation.chat_id, operation.action)
+        except ApiTelegramException as e:
+            API_ERRORS.inc(api='telegram', status=e.error_code)
+            if e.error_code == 429 and operation.attempts < self.max_retries:
+                operation.attempts += 1
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                with self.condition:
+                    self.flood_waits += 1
+                logger.warning("Telegram просит подождать: очередь чата %s приостановлена на %s c", operation.chat_id, retry_after)
+                return retry_after
+            if operation.kind == 'edit' and 'message is not modified' in str(e.description):
+                return None
+            return self._fail(operation, e.description)
+        except requests.exceptions.RequestException as e:
+            if operation.attempts < self.max_retries:
+                operation.attempts += 1
+                logger.warning("Ошибка соединения с Telegram, повтор %s из %s: %s", operation.attempts, self.max_retries, e)
+                return RETRY_DELAY * operation.attempts
+            return self._fail(operation, e)
+        except Exception as e:
+            logger.error("Ошибка при отправке в Telegram: %s", e, exc_info=True)
+            return self._fail(operation, e)
+
+        OUTBOX_WAIT.observe(time.monotonic() - operation.enqueued_at, method=method)
+        with self.condition:
+            self.sent += 1
+        return None
+
+    def _fail(self, operation, error):
+        if operation.kind == 'send':
+            operation.message.failed = True
+        with self.condition:
+            self.failed += 1
+        logger.warning("Операция %s в чате %s не выполнена: %s", operation.kind, operation.chat_id, error)
+        return None
+
+    def wait_idle(self, chat_id=None, timeout=None):
+        """
+        Ждет, пока очередь чата (или всех чатов) опустеет
+        Возвращает False, если за timeout секунд операции не выполнены
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while (chat_id in self.queues) if chat_id is not None else self.queues:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def stats(self):
+        with self.condition:
+            return {
+                'pending': sum(len(queue) for queue in self.queues.values()),
+                'chats': len(self.queues),
+                'typing': len(self.typing_chats),
+                'sent': self.sent,
+                'merged': self.merged,
+                'failed': self.failed,
+                'flood_waits': self.flood_waits,
+            }
+
+    def stop(self):
+        self.stopped.set()
+
+    def shutdown(self, timeout=None):
+        """
+        Останавливает очередь: ждет выполнения поставленных операций (не дольше timeout секунд) и завершает пул
+        Возвращает False, если не все операции выполнены
+        """
+        self.stop()
+        drained = self.wait_idle(timeout=timeout)
+        if not drained:
+            logger.warning("Не все исходящие сообщения отправлены до остановки: %s", self.stats()['pending'])
+        self.executor.shutdown(wait=True)
+        return drained
@@ -0,0 +1,254 @@
+"""
+Ограничение частоты запросов к OpenAI и Telegram
+
+Перед каждым запросом вызывающий поток занимает место в корзине токенов
+(token bucket): если токенов нет, он получает время, когда его очередь
+наступит, и ждет. Места выдаются по порядку обращения, поэтому при всплеске
+запросы выстраиваются в очередь, а не падают с 429 и не устраивают шторм
+повторов. Ответ 429 приостанавливает корзину на Retry-After для всех
+потоков сразу.
+
+Для Telegram действуют общий лимит бота (около 30 сообщений в секунду) и
+лимит на чат (около одного сообщения в секунду с небольшим всплеском), для
+OpenAI — общий лимит и, при необходимости, отдельные лимиты эндпоинтов.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bot_logging import fields
+from metrics import RATE_LIMIT_WAIT
+from tracing import body_size, current_trace
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит запросов к OpenAI в секунду (0 — без ограничения)
+OPENAI_RATE_LIMIT = float(os.getenv('OPENAI_RATE_LIMIT', '50'))
+
+# Лимиты отдельных эндпоинтов OpenAI: 'GET /threads/{id}/runs/{id}=10,POST /threads/{id}/runs=5'
+OPENAI_ENDPOINT_RATE_LIMITS = os.getenv('OPENAI_ENDPOINT_RATE_LIMITS', '')
+
+# Общий лимит запросов бота к Telegram в секунду (0 — без ограничения) и допустимый всплеск;
+# всплеск меньше лимита оставляет запас на разброс сетевой задержки
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_GLOBAL_BURST = int(os.getenv('TELEGRAM_GLOBAL_BURST', '25'))
+
+# Лимит сообщений в один чат в секунду и допустимый всплеск
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+
+# Методы Telegram, на которые действует лимит чата (правки прореживает delivery.py)
+TELEGRAM_CHAT_METHODS = {'sendMessage'}
+
+# Методы Telegram без ограничений: long polling и служебные вызовы
+TELEGRAM_UNLIMITED_METHODS = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook'}
+
+# Сколько корзин чатов держать, прежде чем удалять простаивающие
+MAX_KEY_BUCKETS = 10000
+
+
+def parse_rate_limits(value):
+    """
+    Разбирает строку 'ключ=частота,ключ=частота' в словарь
+    """
+    limits = {}
+    for item in value.split(','):
+        key, _, rate = item.rpartition('=')
+        if key.strip():
+            limits[key.strip()] = float(rate)
+    return limits
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше burst в запасе
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """
+        Занимает токен и возвращает, сколько секунд ждать до своей очереди
+        Токенов может стать меньше нуля: это очередь ожидающих в порядке обращения
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(delay, self.blocked_until - now)
+
+    def delay(self):
+        """
+        Сколько секунд ждал бы новый запрос прямо сейчас
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            delay = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+            return max(delay, self.blocked_until - now)
+
+    def pause(self, seconds):
+        """
+        Приостанавливает выдачу токенов (например, по Retry-After из ответа 429)
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self.tokens >= self.burst and now >= self.blocked_until
+
+
+class RateLimiter:
+    """
+    Общая корзина и корзины по ключам (эндпоинт, чат) с ожиданием своей очереди
+    """
+
+    def __init__(self, name, rate=0, burst=None, key_rate=0, key_burst=None, key_rates=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.key_rate = key_rate
+        self.key_burst = key_burst
+        self.key_rates = key_rates or {}
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+
+    def key_bucket(self, key):
+        rate = self.key_rates.get(key, self.key_rate)
+        if key is None or rate <= 0:
+            return None
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= MAX_KEY_BUCKETS:
+                    self.buckets = {other: value for other, value in self.buckets.items() if not value.idle()}
+                bucket = self.buckets[key] = TokenBucket(rate, self.key_burst)
+            return bucket
+
+    def acquire(self, key=None):
+        """
+        Ждет своей очереди сначала в корзине ключа, затем в общей; возвращает время ожидания
+        """
+        waited = 0.0
+        for bucket in (self.key_bucket(key), self.bucket):
+            if bucket is None:
+                continue
+            delay = bucket.reserve()
+            if delay > 0:
+                time.sleep(delay)
+                waited += delay
+        RATE_LIMIT_WAIT.observe(waited, api=self.name)
+        with self.lock:
+            self.requests += 1
+            if waited > 0:
+                self.throttled += 1
+                self.waited += waited
+        return waited
+
+    def pause(self, seconds, key=None, fallback=True):
+        """
+        Приостанавливает запросы с этим ключом
+        Если у ключа нет своей корзины, с fallback приостанавливаются все запросы, без него — никакие
+        """
+        bucket = self.key_bucket(key) or (self.bucket if fallback else None)
+        if bucket is not None:
+            bucket.pause(seconds)
+            logger.warning("Лимит запросов превышен, запросы приостановлены",
+                           extra=fields(api=self.name, limit_key=key, pause=seconds))
+
+    def delay(self, key=None):
+        """
+        Текущее ожидание в корзине ключа или в общей корзине: признак насыщения
+        """
+        if key is None:
+            bucket = self.bucket
+        else:
+            with self.lock:
+                bucket = self.buckets.get(key)
+        return bucket.delay() if bucket is not None else 0.0
+
+    def stats(self):
+        delay = self.delay()
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'avg_wait': self.waited / self.throttled if self.throttled else 0.0,
+                'delay': delay,
+            }
+
+
+def create_openai_limiter():
+    """
+    Создает ограничитель запросов к OpenAI по настройкам OPENAI_RATE_LIMIT и OPENAI_ENDPOINT_RATE_LIMITS
+    """
+    return RateLimiter('openai', OPENAI_RATE_LIMIT, key_rates=parse_rate_limits(OPENAI_ENDPOINT_RATE_LIMITS))
+
+
+class TelegramRequestSender:
+    """
+    Отправка запросов telebot с ограничением частоты (apihelper.CUSTOM_REQUEST_SENDER)
+    """
+
+    def __init__(self, limiter, pool_size=16):
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def __call__(self, method, url, params=None, **kwargs):
+        method_name = url.rsplit('/', 1)[-1]
+        chat_id = (params or {}).get('chat_id')
+        key = str(chat_id) if chat_id is not None and method_name in TELEGRAM_CHAT_METHODS else None
+        if method_name not in TELEGRAM_UNLIMITED_METHODS:
+            self.limiter.acquire(key)
+
+        started = time.monotonic()
+        response = self.session.request(method, url, params=params, **kwargs)
+        trace = current_trace()
+        if trace is not None:
+            # В трассу попадает только имя метода: в адресе запроса токен бота
+            trace.call('telegram', method_name, started, time.monotonic() - started, response.status_code,
+                       body_size(params), len(response.content))
+        if response.status_code == 429:
+            try:
+                retry_after = json.loads(response.text).get('parameters', {}).get('retry_after', 1)
+            except ValueError:
+                retry_after = 1
+            if chat_id is None:
+                self.limiter.pause(retry_after)
+            else:
+                # Ожидание относится к одному чату: приостанавливается только его корзина, а повтор
+                # остальных методов откладывает очередь этого чата (outbox.py)
+                self.limiter.pause(retry_after, str(chat_id), fallback=False)
+        return response
+
+
+def create_telegram_limiter():
+    """
+    Создает ограничитель запросов к Telegram по настройкам TELEGRAM_GLOBAL_RATE и TELEGRAM_CHAT_RATE
+    """
+    return RateLimiter('telegram', TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST,
+                       key_rate=TELEGRAM_CHAT_RATE, key_burst=TELEGRAM_CHAT_BURST)
@@ -0,0 +1,95 @@
+"""
+Кэш объяснений для кнопки "Explain Last Message"
+
+Объяснение зависит только от треда и последнего сообщения в нем, поэтому
+повторное нажатие кнопки, пока диалог не продолжился, возвращает готовый
+ответ без нового запуска ассистента. Одновременные запросы с одним ключом
+ждут первый из них вместо того, чтобы запускать ассистента повторно.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Максимальное количество объяснений в кэше
+EXPLAIN_CACHE_SIZE = int(os.getenv('EXPLAIN_CACHE_SIZE', '1000'))
+
+# Время жизни объяснения в кэше, секунды
+EXPLAIN_CACHE_TTL = float(os.getenv('EXPLAIN_CACHE_TTL', '3600'))
+
+
+class ResponseCache:
+    """
+    LRU кэш с TTL и объединением одновременных вычислений одного ключа
+    """
+
+    def __init__(self, max_size=EXPLAIN_CACHE_SIZE, ttl=EXPLAIN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute, cacheable=lambda value: True):
+        """
+        Возвращает пару (значение, источник), где источник — 'hit', 'shared' или 'miss'
+        Значение вычисляется функцией compute только если его нет в кэше и никто не вычисляет его сейчас
+        В кэш попадают только значения, для которых cacheable возвращает True
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and time.monotonic() - item[1] <= self.ttl:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return item[0], 'hit'
+
+            waiter = self.in_flight.get(key)
+            if waiter is None:
+                waiter = self.in_flight[key] = {'event': threading.Event(), 'value': None}
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+
+        if not owner:
+            waiter['event'].wait()
+            if waiter['value'] is not None:
+                with self.lock:
+                    self.shared += 1
+                return waiter['value'], 'shared'
+            # Первый запрос завершился ошибкой: вычисляем самостоятельно
+            with self.lock:
+                self.misses += 1
+            return compute(), 'miss'
+
+        value = None
+        try:
+            value = compute()
+            return value, 'miss'
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if value is not None and cacheable(value):
+                    waiter['value'] = value
+                    self.items[key] = (value, time.monotonic())
+                    self.items.move_to_end(key)
+                    while len(self.items) > self.max_size:
+                        self.items.popitem(last=False)
+            waiter['event'].set()
+
+    def stats(self):
+        """
+        Возвращает количество попаданий, промахов и долю запросов, обслуженных без запуска ассистента
+        """
+        with self.lock:
+            requests_total = self.hits + self.shared + self.misses
+            return {
+                'size': len(self.items),
+                'hits': self.hits,
+                'shared': self.shared,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.shared) / requests_total if requests_total else 0.0,
+            }
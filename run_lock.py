@@ -0,0 +1,194 @@
+"""
+Блокировка запусков ассистента в треде
+
+OpenAI отклоняет новый запуск, пока в треде не завершен предыдущий, а
+сообщение, добавленное во время запуска, может попасть в чужой ответ. Внутри
+одного процесса это исключает очередь пользователя в диспетчере, а между
+процессами и узлами — аренда (lease) ключа треда: ее держит один владелец,
+и она сама истекает через RUN_LOCK_TTL, если процесс упал, не отпустив ее.
+Пока аренда удерживается, фоновый поток продлевает ее каждые RUN_LOCK_TTL / 3
+секунд, поэтому долгий запуск не теряет тред, а упавший процесс освобождает
+его не позже чем через RUN_LOCK_TTL.
+
+Бэкенды: 'memory' (только внутри процесса) и 'sqlite' (общий файл для
+нескольких процессов на одной машине).
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from bot_logging import fields
+from session_store import SESSION_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Бэкенд блокировки: 'memory' или 'sqlite'
+RUN_LOCK = os.getenv('RUN_LOCK', 'memory')
+
+# Путь к базе SQLite с арендами (по умолчанию та же база, что и у сессий)
+RUN_LOCK_DB_PATH = os.getenv('RUN_LOCK_DB_PATH', SESSION_DB_PATH)
+
+# Срок аренды, секунды: через столько тред освобождается, если процесс-владелец упал
+RUN_LOCK_TTL = float(os.getenv('RUN_LOCK_TTL', '120'))
+
+# Сколько секунд ждать освобождения треда, прежде чем отказать
+RUN_LOCK_WAIT = float(os.getenv('RUN_LOCK_WAIT', '30'))
+
+# Задержка между попытками взять занятую аренду, секунды
+RETRY_MIN_DELAY = 0.05
+RETRY_MAX_DELAY = 0.5
+
+# Удерживаемые аренды продлеваются с интервалом в эту долю RUN_LOCK_TTL
+RENEW_FRACTION = 1 / 3
+
+
+class MemoryLeaseStore:
+    """
+    Аренды в памяти процесса
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.leases = {}
+
+    def try_acquire(self, key, owner, ttl):
+        now = time.time()
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is not None and lease[0] != owner and lease[1] > now:
+                return False
+            self.leases[key] = (owner, now + ttl)
+            return True
+
+    def release(self, key, owner):
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is not None and lease[0] == owner:
+                del self.leases[key]
+
+
+class SQLiteLeaseStore:
+    """
+    Аренды в базе SQLite, общей для процессов на одной машине
+    """
+
+    def __init__(self, path=RUN_LOCK_DB_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS run_leases ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def try_acquire(self, key, owner, ttl):
+        now = time.time()
+        with self.lock:
+            # Одна атомарная запись: новая аренда, продление своей или захват истекшей чужой
+            cursor = self.connection.execute(
+                "INSERT INTO run_leases (key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE run_leases.owner = excluded.owner OR run_leases.expires_at <= ?",
+                (str(key), owner, now + ttl, now)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, key, owner):
+        with self.lock:
+            self.connection.execute("DELETE FROM run_leases WHERE key = ? AND owner = ?", (str(key), owner))
+
+
+class RunLock:
+    """
+    Аренда ключа с ожиданием освобождения поверх хранилища аренд
+    """
+
+    def __init__(self, store, ttl=RUN_LOCK_TTL, wait=RUN_LOCK_WAIT):
+        self.store = store
+        self.ttl = ttl
+        self.wait = wait
+        self.owner_prefix = f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.Lock()
+        # owner -> ключ удерживаемой аренды, которую продлевает фоновый поток
+        self.held = {}
+        self.renewer = None
+        self.contended = 0
+        self.timeouts = 0
+        self.lost = 0
+
+    @contextmanager
+    def hold(self, key, wait=None):
+        """
+        Берет аренду ключа на время блока with и отпускает ее по выходу
+        Возвращает True, если аренда получена, и False, если ключ не освободился за wait секунд
+        """
+        owner = f"{self.owner_prefix}:{uuid.uuid4().hex[:8]}"
+        deadline = time.monotonic() + (self.wait if wait is None else wait)
+        delay = RETRY_MIN_DELAY
+        acquired = self.store.try_acquire(key, owner, self.ttl)
+        if not acquired:
+            self.contended += 1
+            logger.info("Тред занят другим запуском, ждем освобождения", extra=fields(lock_key=key))
+        while not acquired:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.timeouts += 1
+                logger.warning("Тред не освободился вовремя", extra=fields(lock_key=key))
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+            acquired = self.store.try_acquire(key, owner, self.ttl)
+
+        if acquired:
+            self._track(key, owner)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with self.lock:
+                    del self.held[owner]
+                    self.store.release(key, owner)
+
+    def _track(self, key, owner):
+        with self.lock:
+            self.held[owner] = key
+            if self.renewer is None:
+                self.renewer = threading.Thread(target=self._renew_loop, name='run-lock-renew', daemon=True)
+                self.renewer.start()
+
+    def _renew_loop(self):
+        while True:
+            time.sleep(self.ttl * RENEW_FRACTION)
+            with self.lock:
+                owners = list(self.held)
+            for owner in owners:
+                # Под блокировкой: аренда, отпущенная во время продления, не должна возникнуть снова
+                with self.lock:
+                    key = self.held.get(owner)
+                    if key is None:
+                        continue
+                    try:
+                        renewed = self.store.try_acquire(key, owner, self.ttl)
+                    except Exception as e:
+                        logger.warning("Не удалось продлить аренду треда: %s", e, extra=fields(lock_key=key))
+                        continue
+                    if not renewed:
+                        self.lost += 1
+                if not renewed:
+                    logger.warning("Аренда треда истекла и занята другим владельцем", extra=fields(lock_key=key))
+
+
+def create_run_lock(kind=RUN_LOCK):
+    """
+    Создает блокировку запусков по настройке RUN_LOCK
+    """
+    if kind == 'memory':
+        return RunLock(MemoryLeaseStore())
+    if kind == 'sqlite':
+        return RunLock(SQLiteLeaseStore())
+    raise ValueError(f"Неизвестный тип блокировки запусков: {kind}")
@@ -0,0 +1,185 @@
+"""
+Хранилище сессий пользователей
+
+Сессии хранятся в ограниченном кэше в памяти (LRU с TTL), а при включенном
+SQLite — еще и на диске, поэтому после перезапуска бота пользователи
+продолжают диалог в своих тредах OpenAI. История сообщений в сессии
+обрезается до SESSION_HISTORY_LIMIT последних сообщений.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Тип хранилища: 'memory' или 'sqlite'
+SESSION_STORE = os.getenv('SESSION_STORE', 'sqlite')
+
+# Путь к файлу базы SQLite
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+
+# Максимальное количество сессий в памяти
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+
+# Время жизни неактивной сессии, секунды (по умолчанию 30 дней)
+SESSION_TTL = float(os.getenv('SESSION_TTL', str(30 * 24 * 3600)))
+
+# Как часто удалять из SQLite сессии старше SESSION_TTL, секунды
+SESSION_PURGE_INTERVAL = float(os.getenv('SESSION_PURGE_INTERVAL', '3600'))
+
+# Сколько последних сообщений хранить в истории сессии
+SESSION_HISTORY_LIMIT = int(os.getenv('SESSION_HISTORY_LIMIT', '20'))
+
+
+def trim_history(session, limit=SESSION_HISTORY_LIMIT):
+    """
+    Оставляет в истории сессии только limit последних сообщений
+    """
+    messages = session.get('messages')
+    if messages and len(messages) > limit:
+        del messages[:len(messages) - limit]
+    return session
+
+
+class MemorySessionStore:
+    """
+    Сессии в памяти с вытеснением давно неиспользуемых (LRU) и устаревших (TTL)
+    """
+
+    def __init__(self, max_size=SESSION_CACHE_SIZE, ttl=SESSION_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, user_id):
+        with self.lock:
+            item = self.items.get(user_id)
+            if item is None:
+                return None
+            session, touched_at = item
+            if time.time() - touched_at > self.ttl:
+                del self.items[user_id]
+                return None
+            self.items[user_id] = (session, time.time())
+            self.items.move_to_end(user_id)
+            return session
+
+    def put(self, user_id, session):
+        with self.lock:
+            now = time.time()
+            self.items[user_id] = (session, now)
+            self.items.move_to_end(user_id)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+            # Сессии упорядочены по последнему обращению: устаревшие — в начале
+            while self.items and now - next(iter(self.items.values()))[1] > self.ttl:
+                self.items.popitem(last=False)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.items.pop(user_id, None)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class SQLiteSessionStore:
+    """
+    Сессии в базе SQLite в режиме WAL
+    Устаревшие сессии удаляются при запуске и затем при записи, не чаще purge_interval секунд
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL, purge_interval=SESSION_PURGE_INTERVAL):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.purged_at = 0.0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self.purge_expired()
+
+    def get(self, user_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data, updated_at FROM sessions WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, user_id, session):
+        data = json.dumps(session, ensure_ascii=False)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (str(user_id), data, time.time())
+            )
+        if time.monotonic() - self.purged_at >= self.purge_interval:
+            self.purge_expired()
+
+    def delete(self, user_id):
+        with self.lock:
+            self.connection.execute("DELETE FROM sessions WHERE user_id = ?", (str(user_id),))
+
+    def purge_expired(self):
+        """
+        Удаляет сессии, которые не использовались дольше ttl
+        """
+        with self.lock:
+            self.purged_at = time.monotonic()
+            self.connection.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    def __len__(self):
+        # Устаревшие сессии, которые еще не удалены, не считаются
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM sessions WHERE updated_at >= ?", (time.time() - self.ttl,)
+            ).fetchone()[0]
+
+
+class TieredSessionStore:
+    """
+    Кэш в памяти перед постоянным хранилищем: чтение из кэша, запись в оба уровня
+    """
+
+    def __init__(self, cache, durable):
+        self.cache = cache
+        self.durable = durable
+
+    def get(self, user_id):
+        session = self.cache.get(user_id)
+        if session is None:
+            session = self.durable.get(user_id)
+            if session is not None:
+                self.cache.put(user_id, session)
+        return session
+
+    def put(self, user_id, session):
+        self.cache.put(user_id, session)
+        self.durable.put(user_id, session)
+
+    def delete(self, user_id):
+        self.cache.delete(user_id)
+        self.durable.delete(user_id)
+
+    def __len__(self):
+        return len(self.durable)
+
+
+def create_session_store(kind=SESSION_STORE):
+    """
+    Создает хранилище сессий по настройке SESSION_STORE
+    """
+    if kind == 'memory':
+        return MemorySessionStore()
+    if kind == 'sqlite':
+        return TieredSessionStore(MemorySessionStore(), SQLiteSessionStore())
+    raise ValueError(f"Неизвестный тип хранилища сессий: {kind}")
@@ -0,0 +1,115 @@
+"""
+Распределение пользователей между экземплярами бота
+
+Каждый пользователь закреплен за одним экземпляром (шардом): номер шарда —
+id пользователя по модулю SHARD_COUNT. Поэтому кэш сессий в памяти,
+очередь пользователя и пул тредов каждого экземпляра остаются согласованными.
+Обновление, пришедшее не в свой шард (балансировщик распределяет webhook
+запросы произвольно, а getUpdates читает только один экземпляр), пересылается
+на webhook экземпляра-владельца. Если владелец недоступен, обновление
+обрабатывается на месте — от параллельных запусков в одном треде защищает
+блокировка из run_lock.py.
+"""
+import logging
+import os
+import threading
+import zlib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from bot_logging import fields
+from webhook import FORWARDED_HEADER, SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+# Номер этого экземпляра и общее количество экземпляров
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+
+# Адреса webhook всех экземпляров через запятую, по порядку номеров шардов
+SHARD_PEERS = [peer.strip() for peer in os.getenv('SHARD_PEERS', '').split(',') if peer.strip()]
+
+# Таймаут пересылки обновления другому экземпляру, секунды
+SHARD_FORWARD_TIMEOUT = float(os.getenv('SHARD_FORWARD_TIMEOUT', '5'))
+
+
+def shard_for(key, count=SHARD_COUNT):
+    """
+    Возвращает номер шарда для ключа очереди (id пользователя)
+    """
+    if isinstance(key, int):
+        return key % count
+    # Для прочих ключей нужен хэш, одинаковый во всех процессах (встроенный hash() случаен)
+    return zlib.crc32(str(key).encode('utf-8')) % count
+
+
+def update_payload(update):
+    """
+    Восстанавливает JSON обновления telebot для пересылки
+    Исходный JSON telebot хранит у сообщений и нажатий кнопок, остальные обновления не пересылаются
+    """
+    data = {'update_id': update.update_id}
+    for field in ('message', 'edited_message', 'callback_query'):
+        event = getattr(update, field, None)
+        if event is not None and getattr(event, 'json', None) is not None:
+            data[field] = event.json
+    return data
+
+
+class ShardRouter:
+    """
+    Определяет владельца обновления и пересылает чужие обновления на его webhook
+    """
+
+    def __init__(self, index=SHARD_INDEX, count=SHARD_COUNT, peers=SHARD_PEERS, secret='',
+                 timeout=SHARD_FORWARD_TIMEOUT):
+        if count > 1 and len(peers) != count:
+            raise ValueError(f"SHARD_PEERS должен содержать {count} адресов, указано {len(peers)}")
+        self.index = index
+        self.count = count
+        self.peers = peers
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(count, 1), pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if secret:
+            self.session.headers[SECRET_HEADER] = secret
+        self.session.headers[FORWARDED_HEADER] = str(index)
+
+        self.lock = threading.Lock()
+        self.forwarded = 0
+        self.forward_errors = 0
+
+    @property
+    def enabled(self):
+        return self.count > 1
+
+    def owns(self, key):
+        """
+        True, если обновление с этим ключом обрабатывается в этом экземпляре
+        """
+        return not self.enabled or shard_for(key, self.count) == self.index
+
+    def forward(self, key, data):
+        """
+        Пересылает обновление экземпляру-владельцу, возвращает True при успехе
+        """
+        shard = shard_for(key, self.count)
+        try:
+            response = self.session.post(self.peers[shard], json=data, timeout=self.timeout)
+            ok = response.status_code == 200
+        except requests.exceptions.RequestException as e:
+            logger.warning("Не удалось переслать обновление: %s", e, extra=fields(shard=shard))
+            ok = False
+        else:
+            if not ok:
+                logger.warning("Экземпляр не принял обновление", extra=fields(shard=shard, status=response.status_code))
+        with self.lock:
+            if ok:
+                self.forwarded += 1
+            else:
+                self.forward_errors += 1
+        return ok
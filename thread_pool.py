@@ -0,0 +1,102 @@
+"""
+Пул заранее созданных тредов OpenAI
+
+Треды создаются в фоновом потоке, поэтому первое сообщение пользователя
+не ждет запроса POST /threads. Если API недоступен, пул повторяет попытки
+с растущей задержкой и запоминает последнюю ошибку.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Сколько тредов держать наготове (0 — отключить пул)
+THREAD_POOL_SIZE = int(os.getenv('THREAD_POOL_SIZE', '4'))
+
+# Задержка между неудачными попытками пополнения пула, секунды
+REFILL_RETRY_MIN = 1.0
+REFILL_RETRY_MAX = 60.0
+
+
+class ThreadPrewarmer:
+    """
+    Держит наготове size тредов и пополняет их в фоне
+    create_thread — функция, которая создает тред и возвращает его id или None при ошибке
+    """
+
+    def __init__(self, create_thread, size=THREAD_POOL_SIZE):
+        self.create_thread = create_thread
+        self.size = size
+        self.ready = deque()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.worker = None
+        self.last_error_at = None
+
+    @property
+    def healthy(self):
+        """
+        False, если последняя попытка создать тред закончилась ошибкой
+        """
+        return self.last_error_at is None
+
+    def start(self):
+        """
+        Запускает фоновое пополнение пула
+        """
+        if self.size <= 0 or self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self._refill_loop, name='thread-prewarmer', daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def take(self):
+        """
+        Возвращает id готового треда или None, если пул пуст
+        """
+        with self.lock:
+            thread_id = self.ready.popleft() if self.ready else None
+        # Во время сбоя API пул сам повторяет попытки с задержкой, не будим его на каждом запросе
+        if self.healthy:
+            self.wakeup.set()
+        return thread_id
+
+    def report(self, ok):
+        """
+        Учитывает результат создания треда вне пула, чтобы пул сразу узнал о восстановлении API
+        """
+        if ok:
+            self.last_error_at = None
+            self.wakeup.set()
+        else:
+            self.last_error_at = time.time()
+
+    def _refill_loop(self):
+        delay = REFILL_RETRY_MIN
+        while not self.stopped.is_set():
+            with self.lock:
+                missing = self.size - len(self.ready)
+            if missing <= 0:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            thread_id = self.create_thread()
+            if thread_id:
+                with self.lock:
+                    self.ready.append(thread_id)
+                self.last_error_at = None
+                delay = REFILL_RETRY_MIN
+            else:
+                self.last_error_at = time.time()
+                logger.warning("Не удалось пополнить пул тредов, следующая попытка через %.0f с", delay)
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+                delay = min(delay * 2, REFILL_RETRY_MAX)
@@ -0,0 +1,121 @@
+"""
+Замер объединения сообщений, отправленных подряд
+
+Пользователи пишут сериями по несколько коротких сообщений с небольшим
+интервалом, обновления проходят через тот же прием, что и при polling
+(process_updates_concurrently). Сравниваются режимы без объединения,
+с объединением сообщений, пришедших во время ответа, с отменой запуска,
+который заменило сообщение серии (SUPERSEDE_RUNS с паузой SUPERSEDE_WINDOW),
+и с окном ожидания: количество запусков ассистента, отмененных из них,
+ответов и время обработки.
+
+Запуск:
+    python -m tools.bench_burst --users 10 --bursts 3 --burst-size 3 --gap 0.3
+"""
+import argparse
+import itertools
+import threading
+import time
+
+from telebot.types import Update
+
+from tools import mock_openai, mock_telegram
+from tools.loadtest import load_bot, start_server
+
+update_ids = itertools.count(1)
+
+
+def make_update(user_id, text):
+    return Update.de_json({
+        "update_id": next(update_ids),
+        "message": {
+            "message_id": next(update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": text,
+        },
+    })
+
+
+def runs_count(bot_module):
+    return sum(counters['count'] for endpoint, counters in bot_module.openai_client.stats().items()
+               if endpoint in ('POST /threads/{id}/runs', 'POST /threads/runs'))
+
+
+def cancelled_count(openai_state):
+    return sum(1 for run in list(openai_state.runs.values()) if run['status'] == 'cancelled')
+
+
+def run_mode(bot_module, openai_state, telegram_state, first_user, args):
+    """
+    Проигрывает серии сообщений всех пользователей, возвращает (запуски, отмененные, ответы, время)
+    """
+    runs_before = runs_count(bot_module)
+    cancelled_before = cancelled_count(openai_state)
+    replies_before = telegram_state.snapshot().get('sendMessage', 0)
+
+    def user(user_id):
+        for burst in range(args.bursts):
+            for index in range(args.burst_size):
+                bot_module.process_updates_concurrently([make_update(user_id, f"Part {index} of my story number {burst}.")])
+                time.sleep(args.gap)
+            time.sleep(args.pause)
+
+    threads = [threading.Thread(target=user, args=(first_user + index,)) for index in range(args.users)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    bot_module.update_dispatcher.join()
+    bot_module.outbox.wait_idle()
+    elapsed = time.monotonic() - started
+
+    return (runs_count(bot_module) - runs_before,
+            cancelled_count(openai_state) - cancelled_before,
+            telegram_state.snapshot().get('sendMessage', 0) - replies_before,
+            elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Объединение сообщений, отправленных подряд")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--bursts', type=int, default=3, help="Серий сообщений от каждого пользователя")
+    parser.add_argument('--burst-size', type=int, default=3, help="Сообщений в серии")
+    parser.add_argument('--gap', type=float, default=0.3, help="Интервал между сообщениями серии, секунды")
+    parser.add_argument('--pause', type=float, default=2.0, help="Пауза после серии, секунды")
+    parser.add_argument('--window', type=float, default=1.0, help="Окно ожидания для третьего режима, секунды")
+    parser.add_argument('--run-duration', type=float, default=1.0)
+    args = parser.parse_args()
+
+    openai_server = mock_openai.create_server(port=0, run_duration=args.run_duration)
+    telegram_server = mock_telegram.create_server(port=0)
+    bot_module = load_bot(start_server(openai_server), start_server(telegram_server), workers=args.users)
+    openai_state = openai_server.RequestHandlerClass.state
+    telegram_state = telegram_server.RequestHandlerClass.state
+
+    # (название, объединение, окно, отмена запуска)
+    modes = [
+        ("без объединения", False, 0.0, False),
+        ("во время ответа", True, 0.0, False),
+        ("с отменой", True, 0.0, True),
+        (f"окно {args.window:g} c", True, args.window, True),
+    ]
+    messages = args.users * args.bursts * args.burst_size
+    print(f"Пользователей: {args.users}, сообщений: {messages}, серии по {args.burst_size} с интервалом {args.gap:g} c")
+    print(f"{'режим':<18} {'запусков':>9} {'отменено':>9} {'ответов':>8} {'время, c':>9}")
+    for index, (label, enabled, window, supersede) in enumerate(modes):
+        bot_module.coalescer.enabled = enabled
+        bot_module.coalescer.window = window
+        bot_module.inflight_runs.enabled = supersede
+        runs, cancelled, replies, elapsed = run_mode(bot_module, openai_state, telegram_state, 10000 * (index + 1), args)
+        print(f"{label:<18} {runs:>9} {cancelled:>9} {replies:>8} {elapsed:>9.2f}")
+
+    bot_module.update_dispatcher.shutdown()
+    openai_server.shutdown()
+    telegram_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Сравнение приема обновлений через polling и webhook
+
+Обновления отправляются несколькими параллельными отправителями: в режиме
+polling они попадают в очередь стенда tools.mock_telegram и забираются ботом
+через getUpdates, в режиме webhook — отправляются POST запросами на webhook.py,
+как это делает Telegram. Обработчик заменен записью времени получения, поэтому
+измеряется только прием: обновлений в секунду и задержка от отправки до начала
+обработки.
+
+Запуск:
+    python -m tools.bench_ingest --updates 2000 --senders 8
+    python -m tools.bench_ingest --updates 2000 --rate 500
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import threading
+import time
+
+from tools import mock_telegram
+from tools.loadtest import load_bot, percentile, start_server
+
+WEBHOOK_SECRET = 'bench-secret'
+
+
+def make_update(sequence, users):
+    user_id = 1000 + sequence % users
+    return {
+        "message": {
+            "message_id": sequence,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+            "text": f"Message {sequence}",
+        },
+    }
+
+
+class Recorder:
+    """
+    Подменяет обработку обновлений записью задержки приема
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.sent_at = {}
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def sent(self, sequence):
+        self.sent_at[sequence] = time.monotonic()
+
+    def __call__(self, updates):
+        now = time.monotonic()
+        with self.lock:
+            for update in updates:
+                self.latencies.append(now - self.sent_at[update.message.message_id])
+            if len(self.latencies) >= self.total:
+                self.done.set()
+
+
+def run_senders(count, senders, send, rate=0):
+    """
+    Раздает отправку count обновлений между senders потоками, возвращает время начала
+    Если rate больше нуля, обновления отправляются равномерно с этой частотой в секунду
+    """
+    def sender(index):
+        for sequence in range(index, count, senders):
+            if rate:
+                delay = started + sequence / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            send(index, sequence)
+
+    threads = [threading.Thread(target=sender, args=(index,)) for index in range(senders)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return started
+
+
+def bench_polling(bot_module, telegram_state, args):
+    recorder = Recorder(args.updates)
+    bot_module.process_updates_inline = recorder
+    poller = threading.Thread(
+        target=bot_module.bot.polling, kwargs={'non_stop': True, 'interval': 0, 'long_polling_timeout': 1}, daemon=True
+    )
+    poller.start()
+
+    def send(index, sequence):
+        recorder.sent(sequence)
+        telegram_state.push_update(make_update(sequence, args.users))
+
+    started = run_senders(args.updates, args.senders, send, args.rate)
+    recorder.done.wait(60)
+    elapsed = time.monotonic() - started
+    bot_module.bot.stop_polling()
+    poller.join()
+    return recorder, elapsed
+
+
+def bench_webhook(bot_module, args):
+    from webhook_server import WebhookServer
+
+    recorder = Recorder(args.updates)
+    bot_module.process_updates_inline = recorder
+    server = WebhookServer(bot_module.accept_webhook_update, host='127.0.0.1', port=0, secret=WEBHOOK_SECRET)
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+
+    async def serve():
+        await server.start()
+        ready.set()
+        await server.stopped.wait()
+        await server.shutdown()
+
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve(),), daemon=True)
+    thread.start()
+    ready.wait()
+    host, port = server.address
+
+    # У каждого отправителя свое keep-alive соединение, как у Telegram (max_connections)
+    connections = [http.client.HTTPConnection(host, port) for _ in range(args.senders)]
+    headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+
+    def send(index, sequence):
+        body = json.dumps(dict(make_update(sequence, args.users), update_id=sequence + 1))
+        recorder.sent(sequence)
+        connections[index].request('POST', server.path, body, headers)
+        response = connections[index].getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"webhook ответил {response.status}")
+
+    started = run_senders(args.updates, args.senders, send, args.rate)
+    recorder.done.wait(60)
+    elapsed = time.monotonic() - started
+    for connection in connections:
+        connection.close()
+    loop.call_soon_threadsafe(server.stop)
+    thread.join()
+    return recorder, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прием обновлений: polling против webhook")
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--senders', type=int, default=8, help="Параллельных отправителей (соединений Telegram)")
+    parser.add_argument('--users', type=int, default=100, help="Разных пользователей среди обновлений")
+    parser.add_argument('--rate', type=float, default=0, help="Частота отправки, обновлений в секунду (0 — максимальная)")
+    args = parser.parse_args()
+
+    telegram_server = mock_telegram.create_server(port=0)
+    telegram_url = start_server(telegram_server)
+    # OpenAI в этом замере не вызывается: обработчики заменены записью задержки
+    bot_module = load_bot('http://127.0.0.1:9', telegram_url)
+
+    results = {
+        'polling': bench_polling(bot_module, telegram_server.RequestHandlerClass.state, args),
+        'webhook': bench_webhook(bot_module, args),
+    }
+
+    print(f"Обновлений: {args.updates}, отправителей: {args.senders}, частота: {args.rate or 'максимальная'}")
+    print(f"{'режим':<8} {'обн/с':>9} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8}")
+    for mode, (recorder, elapsed) in results.items():
+        values = recorder.latencies
+        print(f"{mode:<8} {len(values) / elapsed:>9.0f} {percentile(values, 0.50) * 1000:>8.2f} "
+              f"{percentile(values, 0.95) * 1000:>8.2f} {percentile(values, 0.99) * 1000:>8.2f}")
+
+    bot_module.update_dispatcher.shutdown()
+    telegram_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Замер накладных расходов на логирование одного сообщения
+
+Сравнивает прежнюю отладочную печать (print + json.dumps(indent=2) всех
+ответов API) с логированием через bot_logging на уровнях INFO и DEBUG.
+Вывод направляется в /dev/null, поэтому измеряется только работа процессора.
+
+Запуск:
+    python -m tools.bench_logging --messages 2000 --history 20
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import time
+
+from bot_logging import bind_log_context, fields, setup_logging
+
+
+def make_message(index, role, text):
+    return {
+        "id": f"msg_{index:024d}",
+        "object": "thread.message",
+        "created_at": 1700000000 + index,
+        "thread_id": "thread_000000000000000000000001",
+        "role": role,
+        "run_id": None,
+        "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+    }
+
+
+def make_payloads(history):
+    user_text = "I have went to the cinema yesterday and watched a very interesting film about space."
+    reply_text = "Great! Just a small note: we say 'I went to the cinema yesterday'. " * 4
+    message = make_message(0, "user", user_text)
+    run = {"id": "run_000000000000000000000001", "object": "thread.run", "status": "queued", "assistant_id": "asst_1"}
+    listing = {
+        "object": "list",
+        "data": [make_message(i, "assistant" if i % 2 else "user", reply_text if i % 2 else user_text) for i in range(history)],
+    }
+    return user_text, message, run, listing
+
+
+def legacy_turn(user_text, message, run, listing):
+    """
+    Отладочная печать, которая выполнялась на каждом сообщении до перехода на logging
+    """
+    print(f"Отправляем сообщение в тред: {user_text}")
+    print(f"Ответ на добавление сообщения: {json.dumps(message, indent=2)}")
+    print(f"Отправляем запрос на запуск ассистента с данными: {json.dumps({'assistant_id': 'asst_1'}, indent=2)}")
+    print(f"Ответ на запуск ассистента: {json.dumps(run, indent=2)}")
+    print(f"Полученные сообщения: {json.dumps(listing, indent=2)}")
+
+
+def structured_turn(logger, user_text, message, run, listing, body_size):
+    """
+    Записи, которые делаются на каждом сообщении теперь
+    """
+    bind_log_context(user_id=42, thread_id=message['thread_id'])
+    logger.debug("Сообщение добавлено в тред", extra=fields(
+        thread_id=message['thread_id'], message_id=message['id'], chars=len(user_text), bytes=body_size, duration=0.05
+    ))
+    bind_log_context(run_id=run['id'])
+    logger.debug("Запуск создан", extra=fields(thread_id=message['thread_id'], status=run['status']))
+    logger.debug("Получены сообщения треда", extra=fields(
+        thread_id=message['thread_id'], count=len(listing['data']), bytes=body_size
+    ))
+    logger.info("Ответ доставлен", extra=fields(duration=1.2, first_text_latency=0.4, chars=280, messages=1))
+
+
+def measure(fn, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Накладные расходы логирования на одно сообщение")
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--history', type=int, default=20, help="Сообщений в ответе списка сообщений треда")
+    args = parser.parse_args()
+
+    user_text, message, run, listing = make_payloads(args.history)
+    body_size = len(json.dumps(listing))
+    logger = logging.getLogger('bench')
+    results = {}
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            results['before'] = measure(lambda: legacy_turn(user_text, message, run, listing), args.messages)
+
+        for level in ('INFO', 'DEBUG'):
+            setup_logging(level=level, log_format='text', stream=devnull)
+            results[level] = measure(
+                lambda: structured_turn(logger, user_text, message, run, listing, body_size), args.messages
+            )
+            setup_logging(level=level, log_format='json', stream=devnull)
+            results[f"{level} json"] = measure(
+                lambda: structured_turn(logger, user_text, message, run, listing, body_size), args.messages
+            )
+
+    print(f"Сообщений: {args.messages}, сообщений в треде: {args.history}, размер списка: {body_size} байт")
+    print(f"{'print + json.dumps (до)':<28} {results['before'] * 1e6:10.1f} мкс/сообщение")
+    for key in ('INFO', 'INFO json', 'DEBUG', 'DEBUG json'):
+        print(f"{'logging ' + key:<28} {results[key] * 1e6:10.1f} мкс/сообщение")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Замер получения ответа ассистента на длинных тредах
+
+На локальном стенде создаются треды с синтетической историей, после чего
+сравниваются размер ответа и задержка для прежнего запроса списка сообщений
+(страница по умолчанию) и нового (limit=1, order=desc, run_id), а также
+полной и инкрементальной (по курсору after) синхронизации истории.
+
+Запуск:
+    python -m tools.bench_messages --sizes 20 200 2000 --repeat 50
+"""
+import argparse
+import threading
+import time
+
+from openai_client import OpenAIClient
+from tools.mock_openai import create_server
+
+
+def fill_thread(state, turns):
+    """
+    Создает тред с turns парами сообщений пользователя и ассистента
+    Возвращает id треда и id последнего запуска
+    """
+    thread_id = state.create_thread()['id']
+    run_id = None
+    for index in range(turns):
+        state.add_message(thread_id, 'user', f"Message number {index}: I like to learn English every day.")
+        run = state.create_run(thread_id, 'asst_bench')
+        with state.lock:
+            state.complete_run(run)
+        run_id = run['id']
+    return thread_id, run_id
+
+
+def measure(client, path, params, repeat):
+    """
+    Возвращает средний размер ответа в байтах и среднюю задержку в миллисекундах
+    """
+    total_bytes = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        response = client.get(path, params=params)
+        response.raise_for_status()
+        data = response.json()
+        total_bytes += len(response.content)
+        # Как и бот, ищем первое сообщение ассистента
+        next((message for message in data['data'] if message['role'] == 'assistant'), None)
+    return total_bytes / repeat, (time.perf_counter() - started) / repeat * 1000
+
+
+def sync(client, path, after=None, page_size=100):
+    """
+    Загружает сообщения после курсора after, возвращает (байты, запросы, новый курсор)
+    """
+    total_bytes = requests_made = 0
+    while True:
+        params = {"limit": page_size, "order": "asc"}
+        if after:
+            params["after"] = after
+        response = client.get(path, params=params)
+        page = response.json()
+        total_bytes += len(response.content)
+        requests_made += 1
+        if page['data']:
+            after = page['data'][-1]['id']
+        if not page['has_more'] or not page['data']:
+            return total_bytes, requests_made, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Размер и задержка получения ответа на длинных тредах")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 200, 2000], help="Количество пар сообщений в треде")
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    server = create_server(port=0, run_duration=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state = server.RequestHandlerClass.state
+    client = OpenAIClient('bench', f"http://127.0.0.1:{server.server_address[1]}/v1")
+
+    print(f"{'сообщений':>10} {'запрос':<28} {'байт':>10} {'мс':>8}")
+    for turns in args.sizes:
+        thread_id, run_id = fill_thread(state, turns)
+        path = f"/threads/{thread_id}/messages"
+        cases = [
+            ("список по умолчанию (было)", {}),
+            ("limit=1, order=desc", {"limit": 1, "order": "desc"}),
+            ("limit=1, desc, run_id", {"limit": 1, "order": "desc", "run_id": run_id}),
+        ]
+        for label, params in cases:
+            size, latency = measure(client, path, params, args.repeat)
+            print(f"{turns * 2:>10} {label:<28} {size:>10.0f} {latency:>8.2f}")
+
+        started = time.perf_counter()
+        full_bytes, full_requests, cursor = sync(client, path)
+        full_ms = (time.perf_counter() - started) * 1000
+
+        # Новый ход диалога: синхронизация по курсору догружает только его
+        state.add_message(thread_id, 'user', "One more message")
+        run = state.create_run(thread_id, 'asst_bench')
+        with state.lock:
+            state.complete_run(run)
+        started = time.perf_counter()
+        delta_bytes, delta_requests, _ = sync(client, path, after=cursor)
+        delta_ms = (time.perf_counter() - started) * 1000
+
+        print(f"{turns * 2:>10} {'полная синхронизация':<28} {full_bytes:>10} {full_ms:>8.2f}  ({full_requests} запр.)")
+        print(f"{turns * 2:>10} {'синхронизация по курсору':<28} {delta_bytes:>10} {delta_ms:>8.2f}  ({delta_requests} запр.)")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
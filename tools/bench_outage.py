@@ -0,0 +1,119 @@
+"""
+Замер поведения бота во время сбоя OpenAI и после восстановления
+
+Пользователи сначала проводят по одному ходу при работающем API, затем стенд
+OpenAI начинает отвечать 503 на все запросы, и каждый пользователь отправляет
+еще несколько сообщений. Без выключателя (BREAKER_FAILURES=0) каждый ход
+проходит через повторы с задержкой и держит обработчик секундами; с
+выключателем после нескольких неудач ходы сразу получают понятный ответ.
+Затем API восстанавливается, и проверяется, что пробный запрос снова
+замыкает выключатель и ходы проходят.
+
+Запуск:
+    python -m tools.bench_outage --users 10 --messages 3 --latency 0.2
+"""
+import argparse
+import threading
+import time
+
+from circuit_breaker import CircuitBreaker
+from tools import mock_openai, mock_telegram
+from tools.loadtest import load_bot, make_message, percentile, start_server
+
+
+def play(bot_module, user_ids, messages, first_message_id):
+    """
+    Каждый пользователь отправляет messages сообщений подряд, возвращает длительности ходов и общее время
+    """
+    durations = []
+    lock = threading.Lock()
+
+    def user(user_id):
+        for index in range(messages):
+            started = time.monotonic()
+            bot_module.handle_message(make_message(user_id, first_message_id + index, f"Message {index}: I has a question."))
+            bot_module.outbox.wait_idle(user_id)
+            with lock:
+                durations.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=user, args=(user_id,)) for user_id in user_ids]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return durations, time.monotonic() - started
+
+
+def count_replies(telegram_state, text):
+    with telegram_state.lock:
+        return sum(1 for message in telegram_state.messages.values() if message['text'] == text)
+
+
+def count_raw_errors(telegram_state):
+    # Ответы с текстом ошибки API вместо понятного сообщения
+    with telegram_state.lock:
+        return sum(1 for message in telegram_state.messages.values() if message['text'].startswith('Error:'))
+
+
+def openai_calls(bot_module):
+    return sum(counters['count'] for counters in bot_module.openai_client.stats().values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сбой OpenAI с выключателем и без него")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=3, help="Сообщений от каждого пользователя во время сбоя")
+    parser.add_argument('--latency', type=float, default=0.2, help="Задержка ответов стенда OpenAI, секунды")
+    parser.add_argument('--reset-timeout', type=float, default=2.0, help="Время до пробного запроса, секунды")
+    parser.add_argument('--run-mode', choices=['stream', 'poll'], default='stream')
+    args = parser.parse_args()
+
+    openai_server = mock_openai.create_server(port=0, run_duration=0.2, latency=args.latency)
+    telegram_server = mock_telegram.create_server(port=0)
+    bot_module = load_bot(start_server(openai_server), start_server(telegram_server), args.run_mode, workers=args.users)
+    openai_state = openai_server.RequestHandlerClass.state
+    telegram_state = telegram_server.RequestHandlerClass.state
+    unavailable_text = bot_module.bot_config.current().texts['unavailable']
+
+    print(f"Пользователей: {args.users}, сообщений во время сбоя: {args.users * args.messages}, "
+          f"задержка OpenAI {args.latency:g} c")
+    print(f"{'режим':<16} {'p50, c':>8} {'max, c':>8} {'время, c':>9} {'вызовов':>8} {'понятных':>9} {'ошибок':>7}")
+    for index, (label, failures) in enumerate([("без выключателя", 0), ("с выключателем", 5)]):
+        breaker = CircuitBreaker('openai', failures=failures, reset_timeout=args.reset_timeout)
+        bot_module.openai_breaker = bot_module.openai_client.breaker = breaker
+        user_ids = [10000 * (index + 1) + user for user in range(args.users)]
+
+        # Треды пользователей создаются до сбоя
+        play(bot_module, user_ids, 1, 0)
+
+        unavailable_before = count_replies(telegram_state, unavailable_text)
+        errors_before = count_raw_errors(telegram_state)
+        calls_before = openai_calls(bot_module)
+        openai_state.outage = True
+        durations, elapsed = play(bot_module, user_ids, args.messages, 100)
+        openai_state.outage = False
+        print(f"{label:<16} {percentile(durations, 0.5):>8.2f} {max(durations):>8.2f} {elapsed:>9.2f} "
+              f"{openai_calls(bot_module) - calls_before:>8} "
+              f"{count_replies(telegram_state, unavailable_text) - unavailable_before:>9} "
+              f"{count_raw_errors(telegram_state) - errors_before:>7}")
+
+        if failures:
+            # Восстановление: после таймаута пробный запрос замыкает выключатель
+            print(f"Выключатель после сбоя: {breaker.current_state()}, отклонено запросов: {breaker.rejected}")
+            time.sleep(args.reset_timeout)
+            # Первый ход становится пробным запросом, остальные идут уже через замкнутый выключатель
+            play(bot_module, user_ids[:1], 1, 1000)
+            errors_before = count_raw_errors(telegram_state)
+            unavailable_before = count_replies(telegram_state, unavailable_text)
+            play(bot_module, user_ids, 1, 1001)
+            failed = (count_raw_errors(telegram_state) - errors_before
+                      + count_replies(telegram_state, unavailable_text) - unavailable_before)
+            print(f"После восстановления: выключатель {breaker.current_state()}, неудачных ходов: {failed} из {args.users}")
+
+    openai_server.shutdown()
+    telegram_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Замер холодного запуска бота: от старта процесса до обработки первого обновления
+
+Запускает main.py отдельным процессом, направив его на локальные стенды
+tools.mock_openai и tools.mock_telegram, в которых уже ждет сообщение
+пользователя. Замеряется время до первого запроса getUpdates (бот готов
+принимать обновления) и до первого ответа пользователю (sendMessage), с
+проверкой ключей до запуска (FAST_START=0) и в фоне (FAST_START=1).
+Задержка стенда OpenAI имитирует сетевую задержку до настоящего API.
+
+Запуск:
+    python -m tools.bench_startup --runs 5 --openai-latency 0.3
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from tools import mock_openai, mock_telegram
+from tools.loadtest import start_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def launch(openai_url, telegram_url, telegram_state, chat_id, fast_start, timeout):
+    """
+    Запускает бота и возвращает (время до getUpdates, время до первого ответа) в секундах
+    """
+    telegram_state.push_update({"message": {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"},
+        "text": "Hello! I want to practice my English.",
+    }})
+    env = dict(os.environ, **{
+        'OPENAI_API_BASE': f"{openai_url}/v1",
+        'TELEGRAM_API_URL': telegram_url,
+        'OPENAI_API_KEY': 'sk-startup',
+        'TELEGRAM_API_KEY': '1:startup',
+        'OPENAI_ASSISTANT_ID': 'asst_startup',
+        'SESSION_STORE': 'memory',
+        'LOG_LEVEL': 'WARNING',
+        'FAST_START': '1' if fast_start else '0',
+    })
+    polls_before = telegram_state.snapshot().get('getUpdates', 0)
+
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, 'main.py'], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ready = replied = None
+    try:
+        while replied is None and time.monotonic() - started < timeout:
+            if ready is None and telegram_state.snapshot().get('getUpdates', 0) > polls_before:
+                ready = time.monotonic() - started
+            with telegram_state.lock:
+                if any(key[0] == chat_id for key in telegram_state.messages):
+                    replied = time.monotonic() - started
+            time.sleep(0.002)
+    finally:
+        process.terminate()
+        process.wait()
+    if replied is None:
+        raise RuntimeError(f"Бот не ответил за {timeout} c")
+    return ready, replied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Холодный запуск бота до обработки первого обновления")
+    parser.add_argument('--runs', type=int, default=5, help="Запусков в каждом режиме")
+    parser.add_argument('--openai-latency', type=float, default=0.3, help="Задержка ответов стенда OpenAI, секунды")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    openai_server = mock_openai.create_server(port=0, run_duration=0.2, latency=args.openai_latency)
+    telegram_server = mock_telegram.create_server(port=0)
+    openai_url, telegram_url = start_server(openai_server), start_server(telegram_server)
+    telegram_state = telegram_server.RequestHandlerClass.state
+
+    print(f"Запусков: {args.runs}, задержка OpenAI {args.openai_latency:g} c (медиана)")
+    print(f"{'режим':<14} {'до getUpdates, c':>17} {'до ответа, c':>13}")
+    chat_id = 5000
+    for label, fast_start in (("FAST_START=0", False), ("FAST_START=1", True)):
+        ready, replied = [], []
+        for _ in range(args.runs):
+            chat_id += 1
+            first_poll, first_reply = launch(openai_url, telegram_url, telegram_state, chat_id, fast_start, args.timeout)
+            ready.append(first_poll)
+            replied.append(first_reply)
+        print(f"{label:<14} {statistics.median(ready):>17.3f} {statistics.median(replied):>13.3f}")
+
+    openai_server.shutdown()
+    telegram_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Замер отмены запусков, которые заменило новое сообщение пользователя
+
+Каждый пользователь отправляет сообщение и, пока ассистент еще отвечает,
+уточняет его следующим сообщением. Без отмены первый запуск доводится до
+конца, его устаревший ответ показывается, а ответ на уточнение ждет в
+очереди пользователя. С отменой (SUPERSEDE_RUNS=1) первый запуск
+останавливается, а его заглушка удаляется. Сравниваются запуски, доведенные
+до конца, показанные ответы и время до ответа на последнее сообщение.
+
+Запуск:
+    python -m tools.bench_supersede --users 10 --messages 3 --gap 1.0 --run-duration 3
+    python -m tools.bench_supersede --run-mode poll
+"""
+import argparse
+import threading
+import time
+from collections import Counter
+
+from tools import mock_openai, mock_telegram
+from tools.bench_burst import make_update
+from tools.loadtest import load_bot, start_server
+
+
+def run_mode(bot_module, openai_state, telegram_state, first_user, args):
+    """
+    Проигрывает сообщения всех пользователей, возвращает (завершенные, отмененные запуски, ответы, время)
+    """
+    runs_before = Counter(run['status'] for run in openai_state.runs.values())
+    calls_before = telegram_state.snapshot()
+
+    def user(user_id):
+        for index in range(args.messages):
+            bot_module.process_updates_concurrently([make_update(user_id, f"Let me rephrase it, attempt {index}.")])
+            time.sleep(args.gap)
+
+    threads = [threading.Thread(target=user, args=(first_user + index,)) for index in range(args.users)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    bot_module.update_dispatcher.join()
+    bot_module.outbox.wait_idle()
+    elapsed = time.monotonic() - started
+
+    runs = Counter(run['status'] for run in openai_state.runs.values())
+    calls = telegram_state.snapshot()
+    shown = (calls.get('sendMessage', 0) - calls_before.get('sendMessage', 0)
+             - calls.get('deleteMessage', 0) + calls_before.get('deleteMessage', 0))
+    return (runs['completed'] - runs_before['completed'],
+            runs['cancelled'] - runs_before['cancelled'],
+            shown, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Отмена запусков, замененных новым сообщением")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=3, help="Сообщений от каждого пользователя")
+    parser.add_argument('--gap', type=float, default=1.0, help="Интервал между сообщениями, секунды")
+    parser.add_argument('--run-duration', type=float, default=3.0)
+    parser.add_argument('--run-mode', choices=['stream', 'poll'], default='stream')
+    args = parser.parse_args()
+
+    openai_server = mock_openai.create_server(port=0, run_duration=args.run_duration)
+    telegram_server = mock_telegram.create_server(port=0)
+    bot_module = load_bot(start_server(openai_server), start_server(telegram_server), args.run_mode, workers=args.users)
+    openai_state = openai_server.RequestHandlerClass.state
+    telegram_state = telegram_server.RequestHandlerClass.state
+
+    # Замеряется только отмена: сообщения не объединяются, ответ начинается сразу
+    bot_module.coalescer.enabled = False
+    print(f"Пользователей: {args.users}, сообщений: {args.users * args.messages}, "
+          f"интервал {args.gap:g} c, запуск {args.run_duration:g} c")
+    print(f"{'режим':<12} {'завершено':>10} {'отменено':>9} {'ответов':>8} {'время, c':>9}")
+    for index, (label, enabled) in enumerate([("без отмены", False), ("с отменой", True)]):
+        bot_module.inflight_runs.enabled = enabled
+        completed, cancelled, shown, elapsed = run_mode(bot_module, openai_state, telegram_state, 10000 * (index + 1), args)
+        print(f"{label:<12} {completed:>10} {cancelled:>9} {shown:>8} {elapsed:>9.2f}")
+
+    bot_module.update_dispatcher.shutdown()
+    openai_server.shutdown()
+    telegram_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
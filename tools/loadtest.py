@@ -0,0 +1,201 @@
+"""
+Нагрузочный тест бота на локальных стендах OpenAI и Telegram
+
+Запускает в одном процессе стенды tools.mock_openai и tools.mock_telegram,
+импортирует main.py с адресами стендов и проигрывает N одновременных
+пользователей: каждый отправляет сообщения (handle_message) и время от времени
+нажимает «Explain Last Message» (handle_callback). В отчете — задержка ответа
+p50/p95/p99, пропускная способность и количество вызовов API на один ход.
+
+Запуск:
+    python -m tools.loadtest --users 50 --turns 5 --explain-every 3
+    python -m tools.loadtest --users 20 --openai-latency 0.05 --openai-error-rate 0.02
+    python -m tools.loadtest --users 40 --telegram-limits --no-rate-limit
+    python -m tools.loadtest --users 20 --legacy-api
+"""
+import argparse
+import importlib
+import os
+import threading
+import time
+
+from telebot.types import CallbackQuery, Message
+
+from tools import mock_openai, mock_telegram
+
+# Тексты ответов, которыми бот сообщает об ошибке обработки
+ERROR_PREFIXES = ("Error:", "Something went wrong", "Sorry, I'm having trouble")
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def load_bot(openai_url, telegram_url, run_mode='stream', workers=16):
+    """
+    Импортирует main.py, направив его на локальные стенды
+    """
+    os.environ.update({
+        'OPENAI_API_BASE': f"{openai_url}/v1",
+        'TELEGRAM_API_URL': telegram_url,
+        'OPENAI_RUN_MODE': run_mode,
+    })
+    # Каждый пользователь теста — отдельный поток, пул соединений должен вместить их всех
+    os.environ.setdefault('OPENAI_POOL_SIZE', str(max(16, workers)))
+    for name, value in (('OPENAI_API_KEY', 'sk-loadtest'), ('TELEGRAM_API_KEY', '1:loadtest'),
+                        ('OPENAI_ASSISTANT_ID', 'asst_loadtest'), ('SESSION_STORE', 'memory'),
+                        ('LOG_LEVEL', 'WARNING')):
+        os.environ.setdefault(name, value)
+    return importlib.import_module('main')
+
+
+def make_message(user_id, message_id, text):
+    return Message.de_json({
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+        "text": text,
+    })
+
+
+def make_callback(user_id, message_id, data):
+    return CallbackQuery.de_json({
+        "id": f"{user_id}-{message_id}",
+        "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+        "chat_instance": str(user_id),
+        "data": data,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "text": "...",
+        },
+    })
+
+
+def simulate_user(bot_module, user_id, args, latencies, lock):
+    """
+    Проигрывает диалог одного пользователя и записывает задержки ответов
+    Ход считается завершенным, когда очередь отправки чата опустела
+    """
+    for turn in range(args.turns):
+        text = f"Turn {turn}: yesterday I have went to the park with my friends."
+        started = time.monotonic()
+        bot_module.handle_message(make_message(user_id, turn, text))
+        bot_module.outbox.wait_idle(user_id)
+        elapsed = time.monotonic() - started
+        with lock:
+            latencies['message'].append(elapsed)
+
+        if args.explain_every and (turn + 1) % args.explain_every == 0:
+            started = time.monotonic()
+            bot_module.handle_callback(make_callback(user_id, turn, 'desc'))
+            bot_module.outbox.wait_idle(user_id)
+            elapsed = time.monotonic() - started
+            with lock:
+                latencies['explain'].append(elapsed)
+
+        if args.think:
+            time.sleep(args.think)
+
+
+def percentile(values, fraction):
+    """
+    Перцентиль методом ближайшего ранга
+    """
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def count_error_replies(state):
+    with state.lock:
+        return sum(1 for message in state.messages.values() if message['text'].startswith(ERROR_PREFIXES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных стендах")
+    parser.add_argument('--users', type=int, default=20, help="Количество одновременных пользователей")
+    parser.add_argument('--turns', type=int, default=5, help="Сообщений от каждого пользователя")
+    parser.add_argument('--explain-every', type=int, default=3, help="Нажимать «Explain» после каждого N-го сообщения (0 — никогда)")
+    parser.add_argument('--think', type=float, default=0.0, help="Пауза пользователя между сообщениями, секунды")
+    parser.add_argument('--run-mode', choices=('stream', 'poll'), default='stream')
+    parser.add_argument('--run-duration', type=float, default=0.5, help="Длительность запуска ассистента, секунды")
+    parser.add_argument('--openai-latency', type=float, default=0.0)
+    parser.add_argument('--openai-jitter', type=float, default=0.0)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--telegram-jitter', type=float, default=0.0)
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-limits', action='store_true', help="Стенд Telegram отвечает 429 при превышении лимитов")
+    parser.add_argument('--no-rate-limit', action='store_true', help="Отключить ограничитель частоты запросов бота")
+    parser.add_argument('--legacy-api', action='store_true',
+                        help="Стенд OpenAI не поддерживает additional_messages и POST /threads/runs")
+    args = parser.parse_args()
+
+    openai_server = mock_openai.create_server(
+        port=0, run_duration=args.run_duration, latency=args.openai_latency,
+        jitter=args.openai_jitter, error_rate=args.openai_error_rate,
+    )
+    telegram_server = mock_telegram.create_server(
+        port=0, latency=args.telegram_latency, jitter=args.telegram_jitter, error_rate=args.telegram_error_rate,
+        enforce_limits=args.telegram_limits,
+    )
+    bot_module = load_bot(start_server(openai_server), start_server(telegram_server), args.run_mode, args.users)
+    if args.no_rate_limit:
+        for limiter in (bot_module.openai_limiter, bot_module.telegram_limiter):
+            limiter.bucket = None
+            limiter.key_rate = 0
+            limiter.key_rates = {}
+    telegram_state = telegram_server.RequestHandlerClass.state
+    openai_server.RequestHandlerClass.state.combined_runs = not args.legacy_api
+
+    bot_module.thread_prewarmer.start()
+    latencies = {'message': [], 'explain': []}
+    lock = threading.Lock()
+    users = [
+        threading.Thread(target=simulate_user, args=(bot_module, 1000 + index, args, latencies, lock))
+        for index in range(args.users)
+    ]
+
+    started = time.monotonic()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.monotonic() - started
+    bot_module.thread_prewarmer.stop()
+
+    turns = len(latencies['message']) + len(latencies['explain'])
+    openai_calls = sum(counters['count'] for counters in bot_module.openai_client.stats().values())
+    telegram_calls = sum(telegram_state.snapshot().values())
+
+    print(f"Пользователей: {args.users}, ходов: {turns}, режим: {args.run_mode}, время: {elapsed:.2f} c")
+    print(f"{'':<10} {'кол-во':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for kind, values in latencies.items():
+        if values:
+            print(f"{kind:<10} {len(values):>7} {percentile(values, 0.50):>8.3f} {percentile(values, 0.95):>8.3f} "
+                  f"{percentile(values, 0.99):>8.3f} {max(values):>8.3f}")
+    print(f"Пропускная способность: {turns / elapsed:.1f} ходов/с")
+    print(f"Вызовов OpenAI на ход: {openai_calls / turns:.2f}, Telegram на ход: {telegram_calls / turns:.2f}")
+    # Запросы из обработчиков хода, без фонового пополнения пула тредов
+    for (kind,), state in sorted(bot_module.TURN_OPENAI_CALLS.values.items()):
+        print(f"  вызовов OpenAI за ход {kind:<8} {state['sum'] / state['count']:>6.2f}")
+    for endpoint, counters in sorted(bot_module.openai_client.stats().items()):
+        print(f"  {endpoint:<40} {counters['count']:>6} avg {counters['avg'] * 1000:7.1f} мс, ошибок {counters['errors']}")
+    for method, count in sorted(telegram_state.snapshot().items()):
+        print(f"  {'Telegram ' + method:<40} {count:>6}")
+    print(f"Ответов с ошибкой: {count_error_replies(telegram_state)}, отказов Telegram 429: {telegram_state.rejected}")
+    for limiter in (bot_module.openai_limiter, bot_module.telegram_limiter):
+        limit_stats = limiter.stats()
+        print(f"Ожидание в ограничителе {limiter.name}: {limit_stats['throttled']} из {limit_stats['requests']} запросов, "
+              f"в среднем {limit_stats['avg_wait']:.3f} c")
+
+    openai_server.shutdown()
+    telegram_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
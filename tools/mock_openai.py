@@ -0,0 +1,477 @@
+"""
+Локальный стенд OpenAI Assistants API v2 для проверки бота без сети
+
+Эмулирует эндпоинты, которые использует main.py: создание тредов, сообщений
+и запусков (в том числе одним запросом: additional_messages и
+POST /threads/runs), опрос статуса запуска, потоковый режим запуска (SSE), а также
+Chat Completions для движка CONVERSATION_ENGINE=chat (см. engines.py).
+Ассистент отвечает эхом на последнее сообщение пользователя. Задержку ответов
+и долю ошибок (429 и 5xx) можно настроить, чтобы проверить поведение бота под
+нагрузкой и при сбоях API, а флаг outage эмулирует полный сбой: каждый запрос
+завершается ответом 503.
+
+Запуск:
+    python -m tools.mock_openai --port 8800 --run-duration 0.5 --latency 0.05 --error-rate 0.01
+
+После этого боту достаточно указать OPENAI_API_BASE=http://127.0.0.1:8800/v1
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def new_id(prefix):
+    """
+    Генерирует идентификатор в формате OpenAI
+    """
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def make_reply(text):
+    """
+    Формирует ответ ассистента на сообщение пользователя
+    """
+    return f"You wrote: {text}. That sounds great! Could you tell me more about it?"
+
+
+# Список моделей размером с настоящий (около сотни записей)
+MODELS = [{"id": "gpt-4o-mini", "object": "model", "created": 1721172741, "owned_by": "system"}] + [
+    {"id": f"model-{index:03d}-preview", "object": "model", "created": 1700000000 + index, "owned_by": "system"}
+    for index in range(120)
+]
+
+
+class MockOpenAIState:
+    """
+    Хранит треды, сообщения и запуски стенда
+    """
+
+    def __init__(self, run_duration=0.5, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.run_duration = run_duration
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.outage = False
+        # Поддерживает ли стенд запуск вместе с сообщениями (additional_messages) и POST /threads/runs
+        self.combined_runs = True
+        self.lock = threading.RLock()
+        self.threads = {}
+        self.messages = {}
+        self.runs = {}
+        self.chat_completions = 0
+        self.prompt_chars = 0
+
+    def create_thread(self):
+        thread = {"id": new_id("thread"), "object": "thread", "created_at": int(time.time()), "metadata": {}}
+        with self.lock:
+            self.threads[thread['id']] = thread
+            self.messages[thread['id']] = []
+        return thread
+
+    def add_message(self, thread_id, role, content, run_id=None):
+        message = {
+            "id": new_id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "run_id": run_id,
+            "content": [{"type": "text", "text": {"value": content, "annotations": []}}],
+        }
+        with self.lock:
+            self.messages[thread_id].append(message)
+        return message
+
+    def last_user_text(self, thread_id):
+        with self.lock:
+            for message in reversed(self.messages.get(thread_id, [])):
+                if message['role'] == 'user':
+                    return message['content'][0]['text']['value']
+        return ''
+
+    def create_run(self, thread_id, assistant_id):
+        now = time.time()
+        run = {
+            "id": new_id("run"),
+            "object": "thread.run",
+            "created_at": int(now),
+            "thread_id": thread_id,
+            "assistant_id": assistant_id,
+            "status": "queued",
+            "last_error": None,
+            "_started": now,
+            "_reply": make_reply(self.last_user_text(thread_id)),
+        }
+        with self.lock:
+            self.runs[run['id']] = run
+        return run
+
+    def refresh_run(self, run_id):
+        """
+        Переводит запуск в следующий статус в зависимости от прошедшего времени
+        """
+        run = self.runs[run_id]
+        if run['status'] == 'cancelling':
+            run['status'] = 'cancelled'
+        elif run['status'] in ('queued', 'in_progress'):
+            if time.time() - run['_started'] >= self.run_duration:
+                self.complete_run(run)
+            else:
+                run['status'] = 'in_progress'
+        return run
+
+    def cancel_run(self, run_id):
+        """
+        Отменяет запуск; завершенный запуск отменить нельзя, как и в OpenAI
+        """
+        with self.lock:
+            run = self.runs[run_id]
+            if run['status'] not in ('queued', 'in_progress'):
+                return None
+            run['status'] = 'cancelling'
+            return run
+
+    def complete_run(self, run):
+        if run['status'] not in ('queued', 'in_progress'):
+            return None
+        run['status'] = 'completed'
+        return self.add_message(run['thread_id'], 'assistant', run['_reply'], run_id=run['id'])
+
+
+def public(obj):
+    """
+    Убирает служебные поля стенда из объекта перед отправкой
+    """
+    return {key: value for key, value in obj.items() if not key.startswith('_')}
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик HTTP запросов стенда
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент закрыл соединение, не дождавшись ответа
+            self.close_connection = True
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_data(self, data):
+        """
+        Отправляет событие SSE без имени, как в потоке Chat Completions
+        """
+        payload = data if isinstance(data, str) else json.dumps(data)
+        chunk = f"data: {payload}\n\n".encode('utf-8')
+        self.wfile.write(f"{len(chunk):x}\r\n".encode('ascii') + chunk + b"\r\n")
+        self.wfile.flush()
+
+    def send_event(self, event, data):
+        """
+        Отправляет событие SSE отдельным чанком (Transfer-Encoding: chunked)
+        """
+        payload = data if isinstance(data, str) else json.dumps(data)
+        chunk = f"event: {event}\ndata: {payload}\n\n".encode('utf-8')
+        self.wfile.write(f"{len(chunk):x}\r\n".encode('ascii') + chunk + b"\r\n")
+        self.wfile.flush()
+
+    def end_chunks(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def inject_faults(self):
+        """
+        Добавляет сетевую задержку и с вероятностью error_rate (или всегда во время outage) отвечает ошибкой
+        Возвращает True, если запрос уже завершен ошибкой
+        """
+        state = self.state
+        delay = state.latency + random.uniform(0, state.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if state.outage or (state.error_rate and random.random() < state.error_rate):
+            status = 503 if state.outage else random.choice((429, 500, 503))
+            body = json.dumps({"error": {"message": "Injected failure", "type": "server_error"}}).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+        return False
+
+    def not_found(self):
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        state = self.state
+        if self.inject_faults():
+            return
+
+        if path == '/v1/models':
+            return self.send_json(200, {"object": "list", "data": MODELS})
+
+        match = re.fullmatch(r'/v1/models/([^/]+)', path)
+        if match:
+            model = next((model for model in MODELS if model['id'] == match.group(1)), None)
+            return self.send_json(200, model) if model else self.not_found()
+
+        match = re.fullmatch(r'/v1/assistants/([^/]+)', path)
+        if match:
+            return self.send_json(200, {"id": match.group(1), "object": "assistant", "model": "gpt-4o-mini",
+                                        "created_at": int(time.time()), "tools": []})
+
+        match = re.fullmatch(r'/v1/threads/([^/]+)', path)
+        if match:
+            thread = state.threads.get(match.group(1))
+            return self.send_json(200, thread) if thread else self.not_found()
+
+        match = re.fullmatch(r'/v1/threads/([^/]+)/runs/([^/]+)', path)
+        if match and match.group(2) in state.runs:
+            with state.lock:
+                run = public(state.refresh_run(match.group(2)))
+            return self.send_json(200, run)
+
+        match = re.fullmatch(r'/v1/threads/([^/]+)/messages', path)
+        if match and match.group(1) in state.messages:
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            limit = int(query.get('limit', '20'))
+            with state.lock:
+                messages = list(state.messages[match.group(1)])
+            if 'run_id' in query:
+                messages = [message for message in messages if message['run_id'] == query['run_id']]
+            if query.get('order', 'desc') == 'desc':
+                messages.reverse()
+            # Курсоры after/before задаются id сообщения в текущем порядке сортировки
+            ids = [message['id'] for message in messages]
+            if query.get('after') in ids:
+                messages = messages[ids.index(query['after']) + 1:]
+            elif query.get('before') in ids:
+                messages = messages[:ids.index(query['before'])]
+            page = messages[:limit]
+            return self.send_json(200, {
+                "object": "list",
+                "data": page,
+                "first_id": page[0]['id'] if page else None,
+                "last_id": page[-1]['id'] if page else None,
+                "has_more": len(messages) > limit,
+            })
+
+        self.not_found()
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        state = self.state
+        # Тело читается до ответа ошибкой, чтобы соединение keep-alive оставалось пригодным
+        data = self.read_json()
+        if self.inject_faults():
+            return
+
+        if path == '/v1/threads':
+            return self.send_json(200, state.create_thread())
+
+        if path == '/v1/chat/completions':
+            return self.chat_completion(data)
+
+        match = re.fullmatch(r'/v1/threads/([^/]+)/messages', path)
+        if match and match.group(1) in state.threads:
+            content = data.get('content', '')
+            return self.send_json(200, state.add_message(match.group(1), data.get('role', 'user'), content))
+
+        if path == '/v1/threads/runs':
+            # Тред, его сообщения и запуск создаются одним запросом
+            if not state.combined_runs:
+                return self.not_found()
+            thread = state.create_thread()
+            for message in (data.get('thread') or {}).get('messages') or []:
+                state.add_message(thread['id'], message.get('role', 'user'), message.get('content', ''))
+            run = state.create_run(thread['id'], data.get('assistant_id'))
+            if data.get('stream'):
+                return self.stream_run(run, thread)
+            return self.send_json(200, public(run))
+
+        match = re.fullmatch(r'/v1/threads/([^/]+)/runs', path)
+        if match and match.group(1) in state.threads:
+            if data.get('additional_messages') and not state.combined_runs:
+                return self.send_json(400, {"error": {
+                    "message": "Unrecognized request argument supplied: additional_messages",
+                    "type": "invalid_request_error", "param": "additional_messages",
+                }})
+            for message in data.get('additional_messages') or []:
+                state.add_message(match.group(1), message.get('role', 'user'), message.get('content', ''))
+            run = state.create_run(match.group(1), data.get('assistant_id'))
+            if data.get('stream'):
+                return self.stream_run(run)
+            return self.send_json(200, public(run))
+
+        match = re.fullmatch(r'/v1/threads/([^/]+)/runs/([^/]+)/cancel', path)
+        if match and match.group(2) in state.runs:
+            run = state.cancel_run(match.group(2))
+            if run is None:
+                status = state.runs[match.group(2)]['status']
+                return self.send_json(400, {"error": {
+                    "message": f"Cannot cancel run with status '{status}'.", "type": "invalid_request_error"
+                }})
+            return self.send_json(200, public(run))
+
+        self.not_found()
+
+    def chat_completion(self, data):
+        """
+        Отвечает на запрос Chat Completions целиком или потоком (stream=true)
+        """
+        state = self.state
+        messages = data.get('messages') or []
+        last_user = next((message.get('content', '') for message in reversed(messages) if message.get('role') == 'user'), '')
+        reply = make_reply(last_user)
+        completion_id = new_id("chatcmpl")
+        with state.lock:
+            state.chat_completions += 1
+            state.prompt_chars += sum(len(message.get('content') or '') for message in messages)
+
+        if not data.get('stream'):
+            time.sleep(state.run_duration)
+            return self.send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "model": data.get('model'),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+            })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            words = reply.split(' ')
+            step = state.run_duration / max(len(words), 1)
+            for index, word in enumerate(words):
+                time.sleep(step)
+                self.send_data({
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": word if index == 0 else ' ' + word}, "finish_reason": None}],
+                })
+            self.send_data({"id": completion_id, "object": "chat.completion.chunk",
+                            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            self.send_data('[DONE]')
+            self.end_chunks()
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент закрыл поток: генерация, как и в OpenAI, прекращается
+            self.close_connection = True
+
+    def stream_run(self, run, thread=None):
+        """
+        Отдает запуск потоком событий SSE, как это делает OpenAI при stream=true
+        Если тред создан тем же запросом, поток начинается с события thread.created
+        """
+        state = self.state
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        try:
+            if thread is not None:
+                self.send_event('thread.created', thread)
+            self.send_event('thread.run.created', public(run))
+            run['status'] = 'in_progress'
+            self.send_event('thread.run.in_progress', public(run))
+
+            message_id = new_id("msg")
+            self.send_event('thread.message.created', {"id": message_id, "object": "thread.message", "role": "assistant", "content": []})
+
+            words = run['_reply'].split(' ')
+            step = state.run_duration / max(len(words), 1)
+            for index, word in enumerate(words):
+                time.sleep(step)
+                if run['status'] == 'cancelling':
+                    run['status'] = 'cancelled'
+                    self.send_event('thread.run.cancelled', public(run))
+                    self.send_event('done', '[DONE]')
+                    self.end_chunks()
+                    return
+                chunk = word if index == 0 else ' ' + word
+                self.send_event('thread.message.delta', {
+                    "id": message_id,
+                    "object": "thread.message.delta",
+                    "delta": {"content": [{"index": 0, "type": "text", "text": {"value": chunk}}]},
+                })
+
+            with state.lock:
+                message = state.complete_run(run)
+            self.send_event('thread.message.completed', message)
+            self.send_event('thread.run.completed', public(run))
+            self.send_event('done', '[DONE]')
+            self.end_chunks()
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент закрыл поток раньше времени, а запуск, как и в OpenAI, доводится до конца
+            # (если его не отменили)
+            self.close_connection = True
+            with state.lock:
+                if run['status'] == 'cancelling':
+                    run['status'] = 'cancelled'
+                state.complete_run(run)
+
+
+def create_server(host='127.0.0.1', port=8800, run_duration=0.5, latency=0.0, jitter=0.0, error_rate=0.0):
+    """
+    Создает HTTP сервер стенда (запускается через serve_forever)
+    """
+    state = MockOpenAIState(run_duration, latency, jitter, error_rate)
+    handler = type('BoundMockOpenAIHandler', (MockOpenAIHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный стенд OpenAI Assistants API v2")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--run-duration', type=float, default=0.5, help="Длительность запуска ассистента, секунды")
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка каждого ответа, секунды")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке, до указанного значения")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля запросов, которые завершаются ошибкой 429/5xx")
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.run_duration, args.latency, args.jitter, args.error_rate)
+    print(f"Стенд OpenAI запущен: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Локальный стенд Telegram Bot API для проверки бота без сети
+
+Эмулирует методы, которые использует бот: отправку и редактирование сообщений,
+статус "печатает", ответ на нажатие кнопки и получение обновлений (getUpdates).
+Все вызовы записываются, чтобы нагрузочный тест мог посчитать их количество.
+Задержку ответов и долю ошибок 429 можно настроить, а с --enforce-limits стенд,
+как и Telegram, отвечает 429 при превышении общего лимита бота и лимита чата.
+
+Запуск:
+    python -m tools.mock_telegram --port 8801 --latency 0.03
+
+После этого боту достаточно указать TELEGRAM_API_URL=http://127.0.0.1:8801
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Talkmaster", "username": "talkmaster_bot"}
+
+# Лимиты Telegram для --enforce-limits: запросов бота в секунду и сообщений в чат (с всплеском)
+GLOBAL_LIMIT = 30
+CHAT_LIMIT = 1
+CHAT_BURST = 4
+
+
+class MockTelegramState:
+    """
+    Хранит отправленные сообщения, очередь обновлений и счетчики вызовов стенда
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, enforce_limits=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.enforce_limits = enforce_limits
+        self.allowance = {}
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.updates_ready = threading.Condition(self.lock)
+        self.next_message_id = 1
+        self.next_update_id = 1
+        self.messages = {}
+        self.updates = []
+        self.calls = Counter()
+
+    def make_message(self, chat_id, text, message_id=None):
+        with self.lock:
+            if message_id is None:
+                message_id = self.next_message_id
+                self.next_message_id += 1
+            message = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": text,
+            }
+            self.messages[(chat_id, message_id)] = message
+        return message
+
+    def push_update(self, update):
+        """
+        Ставит обновление в очередь getUpdates и возвращает его update_id
+        """
+        with self.lock:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.updates_ready.notify_all()
+        return update['update_id']
+
+    def get_updates(self, offset, limit, timeout):
+        """
+        Возвращает обновления начиная с offset, ожидая их не дольше timeout секунд
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            # Обновления до offset подтверждены ботом и больше не нужны
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.updates_ready.wait(remaining)
+            return self.updates[:limit]
+
+    def over_limit(self, method, chat_id):
+        """
+        Проверяет лимиты Telegram (корзины токенов без ожидания), True — запрос нужно отклонить
+        """
+        buckets = [('global', GLOBAL_LIMIT, GLOBAL_LIMIT)]
+        if method == 'sendMessage' and chat_id is not None:
+            buckets.append((('chat', str(chat_id)), CHAT_LIMIT, CHAT_BURST))
+        now = time.monotonic()
+        with self.lock:
+            for key, rate, burst in buckets:
+                tokens, updated = self.allowance.get(key, (burst, now))
+                if min(burst, tokens + (now - updated) * rate) < 1:
+                    self.rejected += 1
+                    return True
+            for key, rate, burst in buckets:
+                tokens, updated = self.allowance.get(key, (burst, now))
+                self.allowance[key] = (min(burst, tokens + (now - updated) * rate) - 1, now)
+        return False
+
+    def snapshot(self):
+        """
+        Возвращает копию счетчиков вызовов по методам
+        """
+        with self.lock:
+            return dict(self.calls)
+
+
+class MockTelegramHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик HTTP запросов стенда
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Бот остановлен, не дождавшись ответа (например, на long polling)
+            self.close_connection = True
+
+    def read_params(self):
+        """
+        Собирает параметры метода из строки запроса и тела (form или JSON)
+        """
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params.update(json.loads(body or '{}'))
+            else:
+                params.update({key: values[0] for key, values in parse_qs(body).items()})
+        return params
+
+    def do_GET(self):
+        self.handle_method()
+
+    def do_POST(self):
+        self.handle_method()
+
+    def handle_method(self):
+        match = re.fullmatch(r'/bot([^/]+)/([A-Za-z]+)', urlparse(self.path).path)
+        params = self.read_params()
+        if not match:
+            return self.send_json(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+
+        state = self.state
+        method = match.group(2)
+        with state.lock:
+            state.calls[method] += 1
+
+        # getUpdates не задерживается и не сбоит: его задержку задает long polling
+        if method != 'getUpdates':
+            delay = state.latency + random.uniform(0, state.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            limited = state.enforce_limits and state.over_limit(method, params.get('chat_id'))
+            if limited or (state.error_rate and random.random() < state.error_rate):
+                return self.send_json(429, {
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                })
+
+        handler = getattr(self, f"method_{method}", None)
+        if handler is None:
+            return self.send_json(200, {"ok": True, "result": True})
+        result = handler(params)
+        if result is None:
+            target = "to delete" if method == 'deleteMessage' else "to edit"
+            return self.send_json(400, {"ok": False, "error_code": 400, "description": f"Bad Request: message {target} not found"})
+        self.send_json(200, {"ok": True, "result": result})
+
+    def method_getMe(self, params):
+        return BOT_USER
+
+    def method_sendMessage(self, params):
+        return self.state.make_message(int(params['chat_id']), params.get('text', ''))
+
+    def method_editMessageText(self, params):
+        chat_id = int(params['chat_id'])
+        message_id = int(params['message_id'])
+        with self.state.lock:
+            known = (chat_id, message_id) in self.state.messages
+        if not known:
+            return None
+        return self.state.make_message(chat_id, params.get('text', ''), message_id)
+
+    def method_deleteMessage(self, params):
+        with self.state.lock:
+            deleted = self.state.messages.pop((int(params['chat_id']), int(params['message_id'])), None)
+        return None if deleted is None else True
+
+    def method_getUpdates(self, params):
+        return self.state.get_updates(
+            int(params.get('offset') or 0), int(params.get('limit') or 100), float(params.get('timeout') or 0)
+        )
+
+
+def create_server(host='127.0.0.1', port=8801, latency=0.0, jitter=0.0, error_rate=0.0, enforce_limits=False):
+    """
+    Создает HTTP сервер стенда (запускается через serve_forever)
+    """
+    state = MockTelegramState(latency, jitter, error_rate, enforce_limits)
+    handler = type('BoundMockTelegramHandler', (MockTelegramHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный стенд Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8801)
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка каждого ответа, секунды")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке, до указанного значения")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля запросов, которые завершаются ошибкой 429")
+    parser.add_argument('--enforce-limits', action='store_true', help="Отвечать 429 при превышении лимитов Telegram")
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.latency, args.jitter, args.error_rate, args.enforce_limits)
+    print(f"Стенд Telegram запущен: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Проигрывание записанных трасс ходов (TRACE_PATH, см. tracing.py) на локальных стендах
+
+Каждый ход трассы повторяется через handle_message или кнопку «Explain» в
+том же порядке и от того же (псевдонимного) пользователя. Текст сообщения
+заменяется детерминированным текстом той же длины. Стенды OpenAI и
+Telegram отвечают с задержками, записанными в трассе: медиана запросов
+хода, а длительность запуска ассистента — время запуска без его запросов
+(в режиме опроса — между двумя последними опросами статуса).
+Ходы идут по одному, без случайного разброса, поэтому два проигрывания
+одной трассы на разных версиях бота сравнимы между собой.
+
+Отчет сравнивает записанные и проигранные длительности и число запросов
+на ход. С --profile горячие функции обработчиков выводятся профилировщиком
+cProfile. С --save итоги сохраняются в файл, а с --baseline сравниваются
+с сохраненными ранее: если p95 выросла больше чем на --max-regression
+или на ход стало больше запросов, инструмент завершается с кодом 1.
+
+Запуск:
+    TRACE_PATH=traces.jsonl python main.py
+    python -m tools.replay traces.jsonl --save replay-before.json
+    python -m tools.replay traces.jsonl --baseline replay-before.json --max-regression 0.2
+    python -m tools.replay traces.jsonl --limit 50 --profile --sort tottime
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import statistics
+import sys
+import time
+
+from tools import mock_openai, mock_telegram
+from tools.loadtest import load_bot, make_callback, make_message, percentile, start_server
+
+# Эндпоинт опроса статуса запуска
+POLL_ENDPOINT = 'GET /threads/{id}/runs/{id}'
+
+# Слова для текста сообщения той же длины, что и записанное
+FILLER = "I would like to practice my English about travelling books music and work today "
+
+
+def load_traces(path, limit=0):
+    """
+    Читает трассы из файла; строки другого формата пропускаются
+    """
+    traces = []
+    with open(path, encoding='utf-8') as trace_file:
+        for line in trace_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get('v') == 1 and record.get('kind') in ('message', 'explain'):
+                traces.append(record)
+            if limit and len(traces) >= limit:
+                break
+    return traces
+
+
+def filler_text(chars):
+    return (FILLER * (chars // len(FILLER) + 1))[:max(chars, 1)]
+
+
+def calls_by_api(record, api):
+    return [call for call in record.get('calls', []) if call['api'] == api]
+
+
+def stand_settings(record):
+    """
+    Задержки стендов для хода: (задержка OpenAI, длительность запуска, задержка Telegram), секунды
+    """
+    openai_calls = calls_by_api(record, 'openai')
+    telegram_calls = calls_by_api(record, 'telegram')
+    openai_latency = statistics.median(call['d'] for call in openai_calls) if openai_calls else 0.0
+    telegram_latency = statistics.median(call['d'] for call in telegram_calls) if telegram_calls else 0.0
+    polls = [call for call in openai_calls if call['ep'] == POLL_ENDPOINT]
+    creates = [call for call in openai_calls if call['ep'].startswith('POST') and call['ep'].endswith('/runs')]
+    if polls and creates:
+        # Запуск завершился между двумя последними опросами: стенд отвечает в момент окончания запроса
+        created = creates[0]['t'] + creates[0]['d']
+        before_last = polls[-2]['t'] + polls[-2]['d'] if len(polls) > 1 else created
+        run_duration = (before_last + polls[-1]['t'] + polls[-1]['d']) / 2 - created
+    else:
+        run_duration = (record.get('run') or 0.0) - sum(call['d'] for call in openai_calls)
+    return openai_latency, max(0.0, run_duration), telegram_latency
+
+
+def replay(bot_module, openai_state, telegram_state, traces, profiler=None):
+    """
+    Проигрывает ходы по очереди, возвращает результаты ходов
+    """
+    users = {}
+    results = []
+    for index, record in enumerate(traces):
+        user_id = users.setdefault(record['user'], 900000 + len(users))
+        openai_state.latency, openai_state.run_duration, telegram_state.latency = stand_settings(record)
+        bot_module.OPENAI_RUN_MODE = record.get('mode', bot_module.OPENAI_RUN_MODE)
+
+        openai_before = bot_module.openai_client.thread_calls()
+        telegram_before = sum(telegram_state.snapshot().values())
+        started = time.monotonic()
+        if profiler is not None:
+            profiler.enable()
+        if record['kind'] == 'message':
+            bot_module.handle_message(make_message(user_id, index, filler_text(record['update'].get('chars', 1))))
+        else:
+            bot_module.handle_callback(make_callback(user_id, index, 'desc'))
+        if profiler is not None:
+            profiler.disable()
+        duration = time.monotonic() - started
+        bot_module.outbox.wait_idle(user_id)
+        delivered = time.monotonic() - started
+
+        results.append({
+            'kind': record['kind'],
+            'recorded': record['duration'],
+            'duration': duration,
+            'delivered': delivered,
+            'recorded_openai': len(calls_by_api(record, 'openai')),
+            'recorded_telegram': len(calls_by_api(record, 'telegram')),
+            'openai': bot_module.openai_client.thread_calls() - openai_before,
+            'telegram': sum(telegram_state.snapshot().values()) - telegram_before,
+        })
+    return results
+
+
+def summarize(results):
+    """
+    Итоги проигрывания по видам ходов и по всем ходам вместе
+    """
+    summary = {}
+    for kind in ('message', 'explain', 'all'):
+        items = [item for item in results if kind == 'all' or item['kind'] == kind]
+        if not items:
+            continue
+        summary[kind] = {
+            'turns': len(items),
+            'recorded_p50': percentile([item['recorded'] for item in items], 0.50),
+            'recorded_p95': percentile([item['recorded'] for item in items], 0.95),
+            'p50': percentile([item['duration'] for item in items], 0.50),
+            'p95': percentile([item['duration'] for item in items], 0.95),
+            'delivered_p95': percentile([item['delivered'] for item in items], 0.95),
+            'recorded_openai_calls': sum(item['recorded_openai'] for item in items) / len(items),
+            'openai_calls': sum(item['openai'] for item in items) / len(items),
+            'recorded_telegram_calls': sum(item['recorded_telegram'] for item in items) / len(items),
+            'telegram_calls': sum(item['telegram'] for item in items) / len(items),
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'ход':<8} {'кол-во':>6} {'запись p50':>11} {'p95':>7} {'повтор p50':>11} {'p95':>7} "
+          f"{'доставка p95':>13} {'OpenAI':>11} {'Telegram':>11}")
+    for kind, item in summary.items():
+        print(f"{kind:<8} {item['turns']:>6} {item['recorded_p50']:>11.3f} {item['recorded_p95']:>7.3f} "
+              f"{item['p50']:>11.3f} {item['p95']:>7.3f} {item['delivered_p95']:>13.3f} "
+              f"{item['recorded_openai_calls']:>5.2f}/{item['openai_calls']:<5.2f} "
+              f"{item['recorded_telegram_calls']:>5.2f}/{item['telegram_calls']:<5.2f}")
+    print("OpenAI и Telegram — запросов на ход: записано/при проигрывании")
+
+
+def compare(summary, baseline, max_regression):
+    """
+    Сравнивает итоги с сохраненными, возвращает список регрессий
+    """
+    regressions = []
+    for kind, item in summary.items():
+        before = baseline.get(kind)
+        if not before:
+            continue
+        change = item['p95'] / before['p95'] - 1 if before['p95'] else 0.0
+        print(f"{kind:<8} p95 {before['p95']:.3f} -> {item['p95']:.3f} c ({change:+.0%}), "
+              f"OpenAI на ход {before['openai_calls']:.2f} -> {item['openai_calls']:.2f}")
+        if change > max_regression:
+            regressions.append(f"{kind}: p95 выросла на {change:.0%}")
+        if item['openai_calls'] > before['openai_calls'] + 0.01:
+            regressions.append(f"{kind}: запросов к OpenAI на ход стало больше")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проигрывание трасс ходов на локальных стендах")
+    parser.add_argument('path', help="Файл трасс (TRACE_PATH)")
+    parser.add_argument('--limit', type=int, default=0, help="Проиграть только первые N ходов")
+    parser.add_argument('--profile', action='store_true', help="Профилировать обработчики и вывести горячие функции")
+    parser.add_argument('--top', type=int, default=20, help="Сколько функций профиля выводить")
+    parser.add_argument('--sort', choices=('cumulative', 'tottime'), default='cumulative',
+                        help="Порядок профиля: cumulative — с ожиданием ввода-вывода, tottime — собственное время функций")
+    parser.add_argument('--save', help="Сохранить итоги в файл JSON")
+    parser.add_argument('--baseline', help="Сравнить с итогами, сохраненными ранее через --save")
+    parser.add_argument('--max-regression', type=float, default=0.2, help="Допустимый рост p95, доля")
+    args = parser.parse_args()
+
+    traces = load_traces(args.path, args.limit)
+    if not traces:
+        sys.exit(f"В {args.path} нет трасс ходов")
+
+    # Проигрывание само не пишет трассы
+    os.environ['TRACE_PATH'] = ''
+    openai_server = mock_openai.create_server(port=0)
+    telegram_server = mock_telegram.create_server(port=0)
+    bot_module = load_bot(start_server(openai_server), start_server(telegram_server))
+    openai_state = openai_server.RequestHandlerClass.state
+    telegram_state = telegram_server.RequestHandlerClass.state
+
+    profiler = cProfile.Profile() if args.profile else None
+    results = replay(bot_module, openai_state, telegram_state, traces, profiler)
+    summary = summarize(results)
+
+    print(f"Ходов: {len(results)} из {args.path}")
+    print_summary(summary)
+    if profiler is not None:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats(args.sort).print_stats(args.top)
+        print(output.getvalue())
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as summary_file:
+            json.dump(summary, summary_file, ensure_ascii=False, indent=2)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare(summary, json.load(baseline_file), args.max_regression)
+        for regression in regressions:
+            print(f"Регрессия: {regression}")
+
+    openai_server.shutdown()
+    telegram_server.shutdown()
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Запись трасс ходов для разбора медленных ответов
+
+Если задан TRACE_PATH, каждый ход (сообщение или объяснение) дописывается в
+файл одной строкой JSON: вид хода, размер обновления, длительность обработки
+и доставки, результат, число опросов запуска, длительность запуска и список
+запросов к OpenAI и Telegram с эндпоинтом, временем, кодом ответа и размерами
+тел. Тексты пользователя и ассистента, id тредов и запусков и токен бота в
+трассу не попадают, а id пользователя заменяется псевдонимом, который
+действует только в пределах процесса.
+
+Запись хода завершается, когда обработчик закончил работу и очередь отправки
+(outbox.py) выполнила поставленные им операции. Трассы проигрываются на
+локальных стендах инструментом tools/replay.py.
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Файл трасс, в который дописываются ходы (пусто — запись выключена)
+TRACE_PATH = os.getenv('TRACE_PATH', '')
+
+# Доля ходов, которые попадают в трассу (от 0 до 1)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+
+# Версия формата записи
+TRACE_VERSION = 1
+
+_current = contextvars.ContextVar('turn_trace', default=None)
+
+
+class TurnTrace:
+    """
+    Трасса одного хода
+    Запись уходит в файл, когда отпущены все ссылки: обработчика и операций очереди отправки
+    """
+
+    def __init__(self, recorder, kind, user, update):
+        self.recorder = recorder
+        self.kind = kind
+        self.user = user
+        self.update = update
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration = None
+        self.lock = threading.Lock()
+        self.holds = 1
+        self.calls = []
+        self.polls = 0
+        self.notes = {}
+        self.result = 'ok'
+
+    def call(self, api, endpoint, started, duration, status, bytes_out=None, bytes_in=None):
+        """
+        Добавляет запрос к внешнему API; started — time.monotonic() начала запроса
+        """
+        call = {'api': api, 'ep': endpoint, 't': round(started - self.started, 4),
+                'd': round(duration, 4), 's': status}
+        if bytes_out is not None:
+            call['out'] = bytes_out
+        if bytes_in is not None:
+            call['in'] = bytes_in
+        with self.lock:
+            self.calls.append(call)
+
+    def poll(self):
+        with self.lock:
+            self.polls += 1
+
+    def note(self, **values):
+        with self.lock:
+            self.notes.update(values)
+
+    def hold(self):
+        with self.lock:
+            self.holds += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+            if self.holds:
+                return
+        self.recorder.write(self.record())
+
+    def record(self):
+        with self.lock:
+            record = {
+                'v': TRACE_VERSION,
+                'ts': round(self.started_at, 3),
+                'kind': self.kind,
+                'user': self.user,
+                'update': self.update,
+                'duration': round(self.duration if self.duration is not None else time.monotonic() - self.started, 4),
+                'delivered': round(time.monotonic() - self.started, 4),
+                'result': self.result,
+                'polls': self.polls,
+                'calls': sorted(self.calls, key=lambda call: call['t']),
+            }
+            record.update(self.notes)
+        return record
+
+
+class TraceRecorder:
+    """
+    Дописывает трассы ходов в файл, по одной строке JSON на ход
+    """
+
+    def __init__(self, path=TRACE_PATH, sample_rate=TRACE_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.file = None
+        self.written = 0
+        # Псевдонимы пользователей нельзя сопоставить с id за пределами процесса
+        self.salt = os.urandom(8).hex()
+
+    @property
+    def enabled(self):
+        return bool(self.path) and self.sample_rate > 0
+
+    def pseudonym(self, user_id):
+        return hashlib.sha256(f"{self.salt}:{user_id}".encode()).hexdigest()[:12]
+
+    @contextmanager
+    def turn(self, kind, user_id, **update):
+        """
+        Записывает ход, выполняемый в блоке with; внутри доступна трасса (или None, если ход не записывается)
+        """
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            yield None
+            return
+        trace = TurnTrace(self, kind, self.pseudonym(user_id), update)
+        token = _current.set(trace)
+        try:
+            yield trace
+        except Exception:
+            trace.result = 'exception'
+            raise
+        finally:
+            _current.reset(token)
+            trace.duration = time.monotonic() - trace.started
+            trace.release()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self.lock:
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a', encoding='utf-8')
+                self.file.write(line)
+                self.file.flush()
+                self.written += 1
+            except OSError as e:
+                logger.warning("Не удалось записать трассу хода в %s: %s", self.path, e)
+
+
+def current_trace():
+    """
+    Трасса хода, который выполняется в текущем контексте, или None
+    """
+    return _current.get()
+
+
+def hold_trace():
+    """
+    Продлевает трассу текущего хода, пока не будет вызван ее release(); без трассы возвращает None
+    """
+    trace = _current.get()
+    return trace.hold() if trace is not None else None
+
+
+def trace_result(result):
+    """
+    Отмечает результат текущего хода: ok, error, superseded, unavailable, cached
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.result = result
+
+
+def trace_note(**values):
+    """
+    Добавляет поля в запись текущего хода
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.note(**values)
+
+
+def trace_poll():
+    """
+    Учитывает опрос статуса запуска в текущем ходе
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.poll()
+
+
+def body_size(body):
+    """
+    Размер тела запроса в байтах (JSON или параметры формы)
+    """
+    if body is None:
+        return None
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return len(json.dumps(body, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+# Запись трасс ходов (TRACE_PATH)
+trace_recorder = TraceRecorder()
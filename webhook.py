@@ -0,0 +1,53 @@
+"""
+Прием обновлений Telegram через webhook
+
+Легкий асинхронный HTTP сервер на asyncio: проверяет секретный токен из
+заголовка X-Telegram-Bot-Api-Secret-Token, передает обновление в очередь
+обработчиков и сразу отвечает 200, не дожидаясь ответа ассистента. Поэтому
+одно соединение обслуживает много обновлений подряд, а несколько экземпляров
+бота можно поставить за балансировщиком (проверка готовности — GET /healthz).
+
+При остановке сервер перестает принимать запросы, закрывает соединения и
+дожидается обработки уже принятых обновлений (не дольше WEBHOOK_DRAIN_TIMEOUT).
+
+Здесь только настройки: сам сервер (webhook_server.py) загружается при
+запуске в режиме webhook, чтобы режим polling не импортировал asyncio.
+"""
+import os
+
+# Адрес и порт, на которых слушает сервер
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+
+# Путь, на который Telegram присылает обновления
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Сколько секунд ждать обработки принятых обновлений при остановке
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '30'))
+
+# Заголовок с секретом и заголовок обновления, пересланного другим экземпляром бота (см. sharding.py)
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+FORWARDED_HEADER = 'X-Bot-Forwarded-From-Shard'
+
+# Обновления Telegram небольшие, тело больше этого размера не принимается
+MAX_BODY_SIZE = 1024 * 1024
+
+REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 503: 'Service Unavailable',
+}
+
+
+def run_webhook(on_update, drain=None, **options):
+    """
+    Запускает webhook сервер и блокирует поток до остановки
+    """
+    # Сервер и asyncio нужны только в режиме webhook
+    import asyncio
+    from webhook_server import WebhookServer
+    
+    server = WebhookServer(on_update, drain, **options)
+    asyncio.run(server.serve_until_stopped())
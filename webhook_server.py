@@ -0,0 +1,184 @@
+"""
+Асинхронный HTTP сервер webhook (см. webhook.py)
+
+Модуль импортируется только при запуске в режиме webhook, поэтому asyncio
+не загружается, когда бот получает обновления через polling.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from bot_logging import fields
+from webhook import (FORWARDED_HEADER, MAX_BODY_SIZE, REASONS, SECRET_HEADER, WEBHOOK_DRAIN_TIMEOUT,
+                     WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET)
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """
+    HTTP сервер, принимающий обновления Telegram
+
+    on_update(data, forwarded) получает разобранный JSON обновления и признак
+    пересылки от другого экземпляра и возвращает False, если обновление сейчас
+    принять нельзя (очередь заполнена): тогда Telegram получает 503 и повторит
+    доставку позже. drain(timeout) вызывается при
+    остановке и ждет обработки принятых обновлений.
+    """
+
+    def __init__(self, on_update, drain=None, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, drain_timeout=WEBHOOK_DRAIN_TIMEOUT):
+        self.on_update = on_update
+        self.drain = drain
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.drain_timeout = drain_timeout
+        self.server = None
+        self.connections = set()
+        self.closing = False
+        self.stopped = None
+        self.received = 0
+        self.rejected = 0
+
+    @property
+    def address(self):
+        """
+        Фактический (host, port) сервера, полезно при port=0
+        """
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        self.stopped = asyncio.Event()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        logger.info("Webhook сервер запущен", extra=fields(address='%s:%s' % self.address, path=self.path))
+        if not self.secret:
+            logger.warning("WEBHOOK_SECRET не задан: webhook принимает запросы без проверки отправителя")
+
+    async def serve_until_stopped(self):
+        """
+        Запускает сервер и работает до вызова stop() или сигнала SIGTERM/SIGINT
+        """
+        await self.start()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # Сигналы недоступны вне главного потока и в Windows
+                pass
+        await self.stopped.wait()
+        await self.shutdown()
+
+    def stop(self):
+        """
+        Просит сервер остановиться (можно вызывать из обработчика сигнала)
+        """
+        if self.stopped is not None:
+            self.stopped.set()
+
+    async def shutdown(self):
+        """
+        Перестает принимать запросы и дожидается обработки принятых обновлений
+        """
+        self.closing = True
+        self.server.close()
+        # Соединения keep-alive без запроса в обработке закрываются сразу
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+
+        if self.drain:
+            loop = asyncio.get_running_loop()
+            drained = await loop.run_in_executor(None, self.drain, self.drain_timeout)
+            if not drained:
+                logger.warning("Не все принятые обновления обработаны до остановки", extra=fields(timeout=self.drain_timeout))
+        logger.info("Webhook сервер остановлен", extra=fields(received=self.received, rejected=self.rejected))
+
+    async def handle_connection(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while not self.closing:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_SIZE:
+                    await self.respond(writer, 413, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                status = self.dispatch(method, target, headers, body)
+                keep_alive = (version.strip() == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                              and not self.closing)
+                await self.respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def dispatch(self, method, target, headers, body):
+        """
+        Обрабатывает запрос и возвращает HTTP статус ответа
+        """
+        path = target.split('?', 1)[0]
+        if path == '/healthz':
+            return 503 if self.closing else 200
+        if path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+
+        token = headers.get(SECRET_HEADER.lower(), '')
+        if self.secret and not hmac.compare_digest(token.encode('utf-8'), self.secret.encode('utf-8')):
+            logger.warning("Запрос к webhook с неверным секретным токеном")
+            return 403
+        if self.closing:
+            return 503
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return 400
+
+        try:
+            accepted = self.on_update(data, FORWARDED_HEADER.lower() in headers)
+        except Exception as e:
+            logger.error("Не удалось принять обновление из webhook: %s", e, exc_info=True)
+            return 400
+        if not accepted:
+            self.rejected += 1
+            return 503
+        self.received += 1
+        return 200
+
+    async def respond(self, writer, status, keep_alive=True):
+        body = b'ok' if status == 200 else REASONS.get(status, '').encode('ascii')
+        head = [
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+            "Content-Type: text/plain",
+            f"Content-Length: {len(body)}",
+            "Connection: keep-alive" if keep_alive else "Connection: close",
+        ]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('ascii') + body)
+        await writer.drain()